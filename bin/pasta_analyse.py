@@ -103,10 +103,56 @@ def analyse(config, prog, argv):
     parser.add_argument('-adi', dest='thres_adi', metavar='days', type=int,
                         default=config.thresholds.author_date_interval,
                         help='Author date interval (default: %(default)s)')
+    parser.add_argument('-ldf', dest='large_diff_files', metavar='files',
+                        type=int, default=config.thresholds.large_diff_files,
+                        help='Treat patches that affect more files as large '
+                             'diffs. 0 disables the large diff policy '
+                             '(default: %(default)s)')
+    parser.add_argument('-ldc', dest='large_diff_candidates',
+                        metavar='candidates', type=int,
+                        default=config.thresholds.large_diff_candidates,
+                        help='Maximum number of candidates of large diffs '
+                             '(default: %(default)s)')
+    parser.add_argument('-ldm', dest='large_diff_mapping', metavar='pairs',
+                        type=int, default=config.thresholds.large_diff_mapping,
+                        help='Maximum number of file pairs that are compared '
+                             'for large diffs (default: %(default)s)')
+
+    parser.add_argument('-sf', dest='shared_fingerprints', metavar='number',
+                        type=int, default=config.thresholds.shared_fingerprints,
+                        help='Minimum number of shared fingerprints for '
+                             'winnowing preevaluation (default: %(default)s)')
+
+    parser.add_argument('-pre', dest='preevaluation', default='files',
+                        choices=['files', 'winnowing', 'series'],
+                        help='Preevaluation strategy. files: '
+                             'compare patches that touch similar files - '
+                             'winnowing: '
+                             'compare patches that share hunk fingerprints - '
+                             'series: '
+                             'compare revisions of patch series (mbox rep '
+                             'only) (default: %(default)s)')
+
+    parser.add_argument('-subjects', dest='subjects', default=False,
+                        action='store_true',
+                        help='Additionally compare patches with equal '
+                             'normalised subjects')
+    parser.add_argument('-autolink', dest='autolink', default=False,
+                        action='store_true',
+                        help='Link patches with equal normalised subjects '
+                             'and equal diffs without evaluating them '
+                             '(implies -subjects)')
 
     parser.add_argument('-er', dest='er_filename', metavar='filename',
                         default=config.f_evaluation_result,
                         help='Evaluation result PKL filename')
+    parser.add_argument('-record', dest='record_filename', metavar='filename',
+                        default=None,
+                        help='Record the intermediate similarities of all '
+                             'pairs. Results of stricter filename and '
+                             'heading thresholds can be derived from the '
+                             'record with derive_result (rep and upstream '
+                             'mode only)')
 
     parser.add_argument('-cpu', dest='cpu_factor', metavar='cpu', type=float,
                         default=1.0, help='CPU factor for parallelisation '
@@ -149,6 +195,10 @@ def analyse(config, prog, argv):
     config.thresholds.filename = args.thres_filename
     config.thresholds.diff_lines_ratio = args.thres_diff_lines
     config.thresholds.author_date_interval = args.thres_adi
+    config.thresholds.large_diff_files = args.large_diff_files
+    config.thresholds.large_diff_candidates = args.large_diff_candidates
+    config.thresholds.large_diff_mapping = args.large_diff_mapping
+    config.thresholds.shared_fingerprints = args.shared_fingerprints
 
     repo = config.repo
     mbox = args.mbox
@@ -168,11 +218,10 @@ def analyse(config, prog, argv):
         if mbox:
             victims = config.repo.mbox.message_ids(mbox_time_window)
 
-            # we have to temporarily cache those commits to filter out invalid
-            # emails. Commit cache is already loaded, so evict everything except
-            # victims and then cache all victims.
-            repo.cache_evict_except(victims)
-            victims, _ = repo.cache_commits(victims)
+            # Filter out invalid emails. Only headers and the diff boundary
+            # are checked here, mails are fully parsed once they are compared.
+            victims, _ = repo.mbox.validate(victims,
+                                            cpu_factor=args.cpu_factor)
         else:
             victims = config.psd.commits_on_stacks
 
@@ -185,10 +234,14 @@ def analyse(config, prog, argv):
         return
 
     cherries = EvaluationResult()
+    record = None
     if mode == 'succ':
         if mbox:
             log.error('Analysis mode succ is not available in mailbox mode!')
             quit(-1)
+        if args.record_filename:
+            log.error('Recording is not available in analysis mode succ!')
+            quit(-1)
 
         num_cpus = int(cpu_count() * args.cpu_factor)
 
@@ -238,7 +291,12 @@ def analyse(config, prog, argv):
         # The lambda compares two patches of an equivalence class and chooses
         # the one with the later release version
         if mbox:
-            repo.cache_commits(patch_groups.get_untagged())
+            # Mails that passed validation may still fail to parse
+            _, invalid = repo.cache_commits(patch_groups.get_untagged())
+            for message_id in invalid:
+                patch_groups.remove_key(message_id)
+            if invalid:
+                patch_groups.save(f_patch_groups)
             representatives = patch_groups.get_representative_system(
                 lambda x, y:
                     repo.get_commit(x).author_date >
@@ -274,17 +332,31 @@ def analyse(config, prog, argv):
 
             type = EvaluationType.PatchStack
 
+        if args.record_filename:
+            record = EvaluationRecord(mbox, type, config.thresholds,
+                                      args.preevaluation)
+
         log.info('Starting evaluation')
         evaluation_result = evaluate_commit_list(repo, config.thresholds,
                                                  mbox, type,
                                                  representatives, candidates,
                                                  parallelise=True, verbose=True,
-                                                 cpu_factor=args.cpu_factor)
+                                                 cpu_factor=args.cpu_factor,
+                                                 preevaluation=args.preevaluation,
+                                                 subjects=args.subjects,
+                                                 autolink=args.autolink,
+                                                 record=record)
         log.info('  ↪ done.')
 
     evaluation_result.merge(cherries)
     evaluation_result.to_file(args.er_filename)
 
+    if record is not None:
+        record.add_fixed(cherries)
+        log.info('Writing record of %d pairs to %s' %
+                 (len(record), args.record_filename))
+        record.to_file(args.record_filename)
+
 
 if __name__ == '__main__':
     config = Config(sys.argv[1])
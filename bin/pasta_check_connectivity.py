@@ -50,7 +50,7 @@ def check_connectivity(config, prog, argv):
 
     if args.d:
         patch_groups.optimize()
-        patch_groups.to_file(f_patch_groups)
+        patch_groups.save(f_patch_groups)
 
 
 if __name__ == '__main__':
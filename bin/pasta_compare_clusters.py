@@ -11,63 +11,236 @@ Author:
 This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
+import functools
+import numpy as np
 import os
+import re
 import sys
 
+from itertools import chain
 from logging import getLogger
+from multiprocessing import Pool, cpu_count
 from sklearn import metrics
-from itertools import combinations
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from pypasta import *
 
 log = getLogger(__name__[-15:])
 
+# Parameters of a prediction are encoded in its path, e.g., ta-0.950/w-0.300
+PARAMETER_REGEX = re.compile(r'^([a-z]+)-(\d+(?:\.\d+)?)$')
+
+
+def class_ids(cluster, keys):
+    """
+    Returns the class ID of each key as array. Keys that are not part of the
+    cluster form their own single-element classes.
+    """
+    lookup = cluster.lookup
+    ids = np.array([lookup.get(key, -1) for key in keys], dtype=np.int64)
+
+    missing = ids < 0
+    ids[missing] = max(lookup.values(), default=-1) + 1 + \
+                   np.arange(np.count_nonzero(missing))
+    return ids
+
+
+def contingency(truth_ids, pred_ids):
+    """
+    Returns the non-zero cells n_ij of the contingency table of two class
+    assignments, ordered by the class of the ground truth, and the respective
+    ground truth classes
+    """
+    width = int(pred_ids.max(initial=0)) + 1
+    cells, counts = np.unique(truth_ids * width + pred_ids, return_counts=True)
+    return counts, cells // width
+
+
+def num_pairs(counts):
+    return int((counts * (counts - 1) // 2).sum())
+
+
+def purity(truth_ids, pred_ids):
+    counts, truth = contingency(truth_ids, pred_ids)
+    if not len(counts):
+        return 0
+
+    # Every ground truth class contributes its largest overlap
+    starts = np.flatnonzero(np.r_[True, truth[1:] != truth[:-1]])
+    return int(np.maximum.reduceat(counts, starts).sum()) / len(truth_ids)
+
+
+def pair_counts(truth_ids, pred_ids):
+    """
+    Returns the number of all pairs, and the number of true positive, true
+    negative, false positive and false negative pairs of the prediction
+    """
+    # Pairs that are related in both clusterings are pairs within the same
+    # cell of the contingency table. Pairs related in the ground truth resp.
+    # prediction are pairs within the same row resp. column.
+    counts, _ = contingency(truth_ids, pred_ids)
+    combs = num_pairs(np.array([len(truth_ids)]))
+    true_positives = num_pairs(counts)
+    false_positives = num_pairs(np.bincount(pred_ids)) - true_positives
+    false_negatives = num_pairs(np.bincount(truth_ids)) - true_positives
+    true_negatives = combs - true_positives - false_positives - \
+                     false_negatives
+
+    return combs, true_positives, true_negatives, false_positives, \
+        false_negatives
 
-def prec_rec(ground_truth, prediction):
-    ground_truth_keys = ground_truth.get_keys()
-    prediction_keys = prediction.get_keys()
 
-    combs = list(combinations(ground_truth_keys | prediction_keys, 2))
-    false_positives = 0
-    true_positives = 0
-    false_negatives = 0
-    true_negatives = 0
-
-    for source, dest in combs:
-        truth = ground_truth.is_related(source, dest)
-        pred = prediction.is_related(source, dest)
-
-        if (truth, pred) == (True, True):
-            true_positives += 1
-        elif (truth, pred) == (False, False):
-            true_negatives += 1
-        elif (truth, pred) == (False, True):
-            false_positives += 1
-        elif (truth, pred) == (True, False):
-            false_negatives += 1
+def precision_recall(true_positives, false_positives, false_negatives):
+    precision = true_positives / (true_positives + false_positives) \
+        if true_positives + false_positives else 0
+    recall = true_positives / (true_positives + false_negatives) \
+        if true_positives + false_negatives else 0
+    fmeasure = 2 * precision * recall / (precision + recall) \
+        if precision + recall else 0
+
+    return precision, recall, fmeasure
+
+
+def prec_rec(ground_truth, prediction):
+    keys = list(ground_truth.get_keys() | prediction.get_keys())
+    combs, true_positives, true_negatives, false_positives, false_negatives = \
+        pair_counts(class_ids(ground_truth, keys), class_ids(prediction, keys))
 
     log.info('')
-    log.info('Comparisons: %d' % len(combs))
+    log.info('Comparisons: %d' % combs)
     log.info('True Positives: %d' % true_positives)
     log.info('True Negatives: %d' % true_negatives)
     log.info('False Positives: %d' % false_positives)
     log.info('False Negatives: %d' % false_negatives)
 
-    precision = true_positives / (true_positives + false_positives)
-    recall = true_positives / (true_positives + false_negatives)
-    fmeasure = 2 * precision * recall / (precision + recall)
+    precision, recall, fmeasure = \
+        precision_recall(true_positives, false_positives, false_negatives)
 
     log.info('  Precision: %f' % precision)
     log.info('  Recall: %f' % recall)
     log.info('  F-Measure: %f' % fmeasure)
 
 
+# Optional scores, in the order of the output
+SCORES = [('ar', 'Adjusted rand score', metrics.adjusted_rand_score),
+          ('mi', 'Mutual info score', metrics.mutual_info_score),
+          ('nmi', 'Normalised mutual info score',
+           metrics.normalized_mutual_info_score),
+          ('ami', 'Adjusted mutual info score',
+           metrics.adjusted_mutual_info_score),
+          ('pur', 'Purity', purity),
+          ('fm', 'Fowlkes-Mallows score', metrics.fowlkes_mallows_score)]
+
+
+def scores(truth_ids, pred_ids, selected, pr=False):
+    """
+    Returns a list of (name, description, value) of homogeneity, completeness,
+    V-measure, all selected SCORES and, if pr is set, precision, recall and
+    F-measure of the prediction
+    """
+    homo, comp, vm = metrics.homogeneity_completeness_v_measure(truth_ids,
+                                                                pred_ids)
+    retval = [('homo', 'Homogeneity', homo), ('comp', 'Completeness', comp),
+              ('vm', 'V-measure', vm)]
+
+    for name, description, score in SCORES:
+        if name in selected:
+            retval.append((name, description, score(truth_ids, pred_ids)))
+
+    if pr:
+        _, true_positives, _, false_positives, false_negatives = \
+            pair_counts(truth_ids, pred_ids)
+        retval += zip(['prec', 'rec', 'f'],
+                      ['Precision', 'Recall', 'F-Measure'],
+                      precision_recall(true_positives, false_positives,
+                                       false_negatives))
+
+    return retval
+
+
+# Integer encoded ground truth of the batch mode: keys, their index and their
+# class IDs
+_truth_keys = None
+_truth_index = None
+_truth_ids = None
+
+
+def _compare_prediction(selected, pr, filename):
+    try:
+        prediction = Cluster.from_file(filename, must_exist=True)
+    except Exception as e:
+        log.warning('Unable to load %s: %s' % (filename, str(e)))
+        return filename, None
+
+    # Keys that are missing in the ground truth form their own single-element
+    # classes there
+    extra = [x for x in prediction.get_keys() if x not in _truth_index]
+    truth_ids = np.concatenate((_truth_ids, int(_truth_ids.max(initial=-1)) +
+                                1 + np.arange(len(extra), dtype=np.int64)))
+    pred_ids = class_ids(prediction, chain(_truth_keys, extra))
+
+    return filename, scores(truth_ids, pred_ids, selected, pr)
+
+
+def parameters(filename):
+    """
+    Returns the parameters of a prediction, as they are encoded in its path:
+    all components of the form name-value (e.g., ta-0.950/w-0.300)
+    """
+    retval = []
+    for component in os.path.normpath(filename).split(os.sep):
+        match = PARAMETER_REGEX.match(component)
+        if match:
+            retval.append((match.group(1), match.group(2)))
+    return retval
+
+
+def compare_batch(ground_truth, predictions, selected, pr, cpu_factor, dst):
+    global _truth_keys, _truth_index, _truth_ids
+
+    _truth_keys = sorted(ground_truth.get_keys())
+    _truth_index = {key: i for i, key in enumerate(_truth_keys)}
+    _truth_ids = class_ids(ground_truth, _truth_keys)
+    log.info('Comparing %d predictions against %d keys of the ground truth' %
+             (len(predictions), len(_truth_keys)))
+
+    header = None
+    processes = int(cpu_count() * cpu_factor)
+    f = functools.partial(_compare_prediction, selected, pr)
+    if processes > 1:
+        p = Pool(processes=processes)
+        results = p.imap(f, predictions, chunksize=4)
+    else:
+        results = map(f, predictions)
+
+    done = 0
+    for filename, result in results:
+        if result is None:
+            continue
+
+        params = dict(parameters(filename))
+        if header is None:
+            header = [x for x, _ in parameters(filename)]
+            dst.write('\t'.join(['prediction'] + header +
+                                [x[0] for x in result]) + '\n')
+
+        dst.write('\t'.join([filename] + [params.get(x, '') for x in header] +
+                            ['%0.6f' % x[2] for x in result]) + '\n')
+        done += 1
+
+    if processes > 1:
+        p.close()
+        p.join()
+
+    log.info('  ↪ compared %d predictions' % done)
+
+
 def compare_clusters(prog, argv):
     parser = argparse.ArgumentParser(prog=prog,
                                      description='Compare Equivalence Classes')
-    parser.add_argument('classes', metavar='eqclass', type=str, nargs=2,
-                        help='Ground Truth / Prediction')
+    parser.add_argument('classes', metavar='eqclass', type=str, nargs='+',
+                        help='Ground Truth / Prediction. Only the ground '
+                             'truth in batch mode')
     parser.add_argument('-ar', action='store_true', default=False,
                         help='Adjusted rand score')
     parser.add_argument('-mi', action='store_true', default=False,
@@ -85,10 +258,42 @@ def compare_clusters(prog, argv):
     parser.add_argument('-remove-identical', action='store_true', default=False,
                         help='Remove identical clusters before comparing')
     parser.add_argument('-f', type=str, help='Write results to filename')
+    parser.add_argument('-batch', metavar='list', type=str,
+                        help='Batch mode: compare all predictions that are '
+                             'listed in file list (- for stdin) against the '
+                             'ground truth, and write one tab-separated row '
+                             'per prediction to stdout resp. -f')
+    parser.add_argument('-cpu', dest='cpu_factor', metavar='cpu', type=float,
+                        default=1, help='CPU factor for the batch mode '
+                                        '(default: %(default)s)')
     parser.add_argument('-test', action='store_true', default=False,
                         help='run tests')
 
     args = parser.parse_args(argv)
+    if len(args.classes) != (1 if args.batch else 2):
+        parser.error('specify the ground truth and %s' %
+                     ('-batch' if args.batch else 'the prediction'))
+    if args.batch and args.remove_identical:
+        parser.error('-remove-identical is not supported in batch mode')
+
+    if args.batch:
+        ground_truth = Cluster.from_file(args.classes[0], must_exist=True)
+        if args.batch == '-':
+            predictions = sys.stdin.read().split('\n')
+        else:
+            with open(args.batch) as f:
+                predictions = f.read().split('\n')
+        predictions = list(filter(None, predictions))
+
+        selected = {name for name, _, _ in SCORES if getattr(args, name)}
+        if args.f:
+            with open(args.f, 'w') as f:
+                compare_batch(ground_truth, predictions, selected, args.pr,
+                              args.cpu_factor, f)
+        else:
+            compare_batch(ground_truth, predictions, selected, args.pr,
+                          args.cpu_factor, sys.stdout)
+        return 0
 
     # These are the converted example from:
     # https://nlp.stanford.edu/IR-book/html/htmledition/evaluation-of-clustering-1.html
@@ -143,65 +348,21 @@ def compare_clusters(prog, argv):
     for key in missing:
         ground_truth.insert_single(key)
 
-    gt = list(sorted(ground_truth.lookup.items()))
-    t = list(sorted(prediction.lookup.items()))
-
-    gt = [x[1] for x in gt]
-    t = [x[1] for x in t]
+    keys = sorted(ground_truth.get_keys())
+    gt = class_ids(ground_truth, keys)
+    t = class_ids(prediction, keys)
 
     log.info('Number of equiv classes: %d' % len(ground_truth))
 
-    homo, comp, vm = metrics.homogeneity_completeness_v_measure(gt, t)
-    log.info("Homogeneity: %0.3f" % homo)
-    log.info("Completeness: %0.3f" % comp)
-    log.info("V-measure: %0.3f" % vm)
-
-    if args.ar:
-        ar = metrics.adjusted_rand_score(gt, t)
-        log.info("Adjusted rand score: %0.3f" % ar)
-    if args.mi:
-        mi = metrics.mutual_info_score(gt, t)
-        log.info("Mutual info score: %0.3f" % mi)
-    if args.ami:
-        ami = metrics.adjusted_mutual_info_score(gt, t)
-        log.info("Adjusted mutual info score: %0.3f" % ami)
-    if args.nmi:
-        nmi = metrics.normalized_mutual_info_score(gt, t)
-        log.info("Normalised mutual info score: %0.3f" % nmi)
-    if args.pur:
-        elements = len(gt)
-        hits = 0
-        for w in ground_truth:
-            this = 0
-            for element in w:
-                tmp = prediction[element]
-                foo = len(w & tmp)
-                if foo > this:
-                    this = foo
-            hits += this
-        purity = hits / elements
-        log.info('Purity: %0.3f' % purity)
-    if args.fm:
-        fm = metrics.fowlkes_mallows_score(gt, t)
-        log.info("Fowlkes-Mallows score: %0.3f" % fm)
+    selected = {name for name, _, _ in SCORES if getattr(args, name)}
+    result = scores(gt, t, selected)
+    for _, description, value in result:
+        log.info('%s: %0.3f' % (description, value))
 
     if args.f:
         with open(args.f, 'w') as f:
-            f.write("homo: %0.3f\n" % homo)
-            f.write("comp: %0.3f\n" % comp)
-            f.write("vm: %0.3f\n" % vm)
-            if args.ar:
-                f.write("ar: %0.3f\n" % ar)
-            if args.mi:
-                f.write("mi: %0.3f\n" % mi)
-            if args.nmi:
-                f.write("nmi: %0.3f\n" % nmi)
-            if args.ami:
-                f.write("ami: %0.3f\n" % ami)
-            if args.pur:
-                f.write("pur: %0.3f\n" % purity)
-            if args.fm:
-                f.write("fm: %0.3f\n" % fm)
+            for name, _, value in result:
+                f.write('%s: %0.3f\n' % (name, value))
 
     return 0
 
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import sys
+
+from logging import getLogger
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from pypasta import *
+
+log = getLogger(__name__[-15:])
+
+
+def convert_result(prog, argv):
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Convert an evaluation result '
+                                                 'to the columnar format')
+    parser.add_argument('result', metavar='result', type=str,
+                        help='Evaluation result')
+    parser.add_argument('-o', dest='destination', metavar='filename',
+                        type=str, help='Destination (default: overwrite the '
+                                       'result)')
+    parser.add_argument('-pickle', action='store_true', default=False,
+                        help='Convert back to a pickled result')
+
+    args = parser.parse_args(argv)
+    destination = args.destination or args.result
+
+    columnar = EvaluationResult.is_columnar(args.result)
+    if columnar != args.pickle and destination == args.result:
+        log.info('%s is already in the desired format' % args.result)
+        return 0
+
+    result = EvaluationResult.from_file(args.result)
+    if columnar:
+        result = result.to_evaluation_result()
+
+    log.info('Writing %s' % destination)
+    result.to_file(destination, columnar=not args.pickle)
+    log.info('  ↪ done')
+
+    return 0
+
+
+if __name__ == '__main__':
+    ret = convert_result(sys.argv[0], sys.argv[1:])
+    sys.exit(ret)
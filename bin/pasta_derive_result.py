@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import sys
+
+from logging import getLogger
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from pypasta import *
+
+log = getLogger(__name__[-15:])
+
+
+def derive_result(prog, argv):
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Derive evaluation results of '
+                                                 'stricter thresholds from a '
+                                                 'record of analyse')
+    parser.add_argument('record', metavar='record', type=str,
+                        help='Record of analyse -record')
+    parser.add_argument('-tf', dest='thres_filename', metavar='threshold',
+                        type=float, nargs='+', required=True,
+                        help='Minimum filename similarity')
+    parser.add_argument('-th', dest='thres_heading', metavar='threshold',
+                        type=float, nargs='+', required=True,
+                        help='Minimum diff hunk section heading similarity')
+    parser.add_argument('-dlr', dest='thres_diff_lines', metavar='threshold',
+                        type=float, default=None,
+                        help='Diff lines ratio threshold (default: recorded '
+                             'threshold)')
+    parser.add_argument('-er', dest='er_filename', metavar='filename',
+                        type=str, required=True,
+                        help='Evaluation result filename. If several '
+                             'thresholds are given, it is formatted with tf '
+                             'and th, e.g., result-%%0.2f-%%0.2f.pkl')
+
+    args = parser.parse_args(argv)
+
+    log.info('Loading record %s' % args.record)
+    record = EvaluationRecord.from_file(args.record)
+    log.info('  ↪ %d pairs' % len(record))
+
+    points = [(tf, th) for tf in args.thres_filename
+              for th in args.thres_heading]
+    for tf, th in points:
+        if len(points) > 1:
+            destination = args.er_filename % (tf, th)
+        else:
+            destination = args.er_filename
+
+        result = record.derive(tf, th, args.thres_diff_lines)
+        log.info('Writing %s' % destination)
+        result.to_file(destination)
+
+    log.info('  ↪ done')
+
+    return 0
+
+
+if __name__ == '__main__':
+    ret = derive_result(sys.argv[0], sys.argv[1:])
+    sys.exit(ret)
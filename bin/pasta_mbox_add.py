@@ -16,7 +16,6 @@ import os
 import sys
 
 from logging import getLogger
-from subprocess import call
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
                                                 '..')))
@@ -32,7 +31,14 @@ def mbox_add(config, prog, argv):
     parser.add_argument('listname', metavar='listname', type=str,
                         help='List name')
     parser.add_argument('filename', metavar='filename', type=str,
-                        help='Mailbox filename / Maildir directory')
+                        help='Mailbox filename / Maildir directory / '
+                             'public-inbox directory')
+    parser.add_argument('-cpu', dest='cpu_factor', metavar='cpu', type=float,
+                        default=1.0, help='CPU factor for parallelisation '
+                                          '(default: %(default)s)')
+    parser.add_argument('-public-inbox', action='store_true', default=False,
+                        help='filename is a public-inbox (v2). Mails are '
+                             'read from its git repositories and not copied')
 
     args = parser.parse_args(argv)
     filename = os.path.realpath(args.filename)
@@ -42,15 +48,13 @@ def mbox_add(config, prog, argv):
         log.error('not a file or direcotry: %s' % filename)
         quit(-1)
 
-    log.info('Processing Mailbox / Maildir')
-    cwd = os.getcwd()
-    os.chdir(os.path.join(cwd, 'tools'))
-    ret = call(['./process_mailbox_maildir.sh', listname, filename, config.d_mbox])
-    os.chdir(cwd)
-    if ret == 0:
-        log.info('  ↪ done')
+    if args.public_inbox:
+        log.info('Processing public-inbox')
+        import_public_inbox(config.d_mbox, listname, filename,
+                            args.cpu_factor)
     else:
-        log.error('Mail processor failed!')
+        log.info('Processing Mailbox / Maildir')
+        import_mails(config.d_mbox, listname, filename, args.cpu_factor)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import sys
+
+from logging import getLogger
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+from pypasta import *
+
+log = getLogger(__name__[-15:])
+
+
+def mbox_compact(config, prog, argv):
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Merge the invalidation '
+                                                 'journal into the mailbox '
+                                                 'index')
+    parser.parse_args(argv)
+
+    repo = config.repo
+    repo.register_mailbox(config.d_mbox)
+
+    log.info('Compacting mailbox index')
+    repo.mbox.compact()
+    log.info('  ↪ done')
+
+
+if __name__ == '__main__':
+    config = Config(sys.argv[1])
+    mbox_compact(config, sys.argv[0], sys.argv[2:])
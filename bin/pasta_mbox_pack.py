@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import re
+import sys
+
+from logging import getLogger
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+from pypasta import *
+
+from pypasta.Repository.MboxPack import MailPack
+
+log = getLogger(__name__[-15:])
+
+
+def mbox_pack(config, prog, argv):
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Move single mail files of '
+                                                 'the mailbox to monthly packs')
+
+    parser.add_argument('-keep', dest='keep', default=False,
+                        action='store_true',
+                        help='Keep single mail files after packing them')
+
+    args = parser.parse_args(argv)
+    d_mbox = config.d_mbox
+
+    if not os.path.isdir(d_mbox):
+        log.error('not a directory: %s' % d_mbox)
+        quit(-1)
+
+    log.info('Packing mailbox %s' % d_mbox)
+    packed = 0
+    for year in sorted(os.listdir(d_mbox)):
+        if not (re.match(r'^\d{4}$', year) and
+                os.path.isdir(os.path.join(d_mbox, year))):
+            continue
+        for month in sorted(os.listdir(os.path.join(d_mbox, year))):
+            if not (re.match(r'^\d{2}$', month) and
+                    os.path.isdir(os.path.join(d_mbox, year, month))):
+                continue
+            this_packed = MailPack.pack_month(d_mbox, year, month, args.keep)
+            log.info('  ↪ %s/%s: packed %d mails' % (year, month, this_packed))
+            packed += this_packed
+    log.info('  ↪ done. Packed %d mails' % packed)
+
+
+if __name__ == '__main__':
+    config = Config(sys.argv[1])
+    mbox_pack(config, sys.argv[0], sys.argv[2:])
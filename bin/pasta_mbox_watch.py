@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import re
+import select
+import sys
+
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from time import sleep
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+from pypasta import *
+
+log = getLogger(__name__[-15:])
+
+# Mails of a Unix mbox stream start with a 'From ' line after an empty line
+MBOX_SEPARATOR_REGEX = re.compile(rb'(?<=\n\n)(?=From )')
+
+
+def strip_unixfrom(raw):
+    if raw.startswith(b'From '):
+        raw = raw.split(b'\n', 1)[1] if b'\n' in raw else b''
+    return raw
+
+
+def maildir_batches(maildir, interval):
+    """
+    Polls a Maildir (or any directory of mails) and yields the filenames of
+    all mails that appeared since the last poll
+    """
+    seen = set()
+    while True:
+        batch = []
+        for root, _, files in os.walk(maildir):
+            # Mails in tmp/ are still being delivered
+            if os.path.basename(root) == 'tmp':
+                continue
+            for file in files:
+                filename = os.path.join(root, file)
+                if filename not in seen:
+                    seen.add(filename)
+                    batch.append(filename)
+        yield batch
+        sleep(interval)
+
+
+def pipe_batches(pipe, interval):
+    """
+    Reads a stream of mails in Unix mbox format (or one single mail, as piped
+    by procmail). A mail is complete once the next mail starts, the stream
+    ends, or the writer is idle for interval seconds.
+    """
+    buf = b''
+    while True:
+        ready, _, _ = select.select([pipe], [], [], interval)
+        if not ready:
+            if buf.strip():
+                yield [strip_unixfrom(buf)]
+                buf = b''
+            continue
+
+        data = os.read(pipe.fileno(), 1 << 16)
+        if not data:
+            if buf.strip():
+                yield [strip_unixfrom(buf)]
+            return
+
+        buf += data
+        mails = MBOX_SEPARATOR_REGEX.split(buf)
+        buf = mails.pop()
+        if mails:
+            yield [strip_unixfrom(x) for x in mails if x.strip()]
+
+
+def recent_upstream(repo, upstream_hashes, days):
+    """
+    Returns all upstream commits that were committed within the last days.
+    upstream_hashes are ordered from new to old.
+    """
+    if not days:
+        return set()
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    retval = set()
+    for commit_hash in upstream_hashes:
+        if repo[commit_hash].commit_date < cutoff:
+            break
+        retval.add(commit_hash)
+    return retval
+
+
+def mbox_watch(config, prog, argv):
+    parser = argparse.ArgumentParser(prog=prog, description='Watch for new '
+                                     'mails, and link them to the mailbox '
+                                     'result')
+
+    parser.add_argument('listname', metavar='listname', type=str,
+                        help='List name')
+    parser.add_argument('source', metavar='source', type=str,
+                        help='Maildir directory, or - to read mails in Unix '
+                             'mbox format from stdin (e.g., piped by '
+                             'procmail)')
+    parser.add_argument('-interval', dest='interval', metavar='seconds',
+                        type=float, default=10,
+                        help='Polling interval (default: %(default)s)')
+    parser.add_argument('-upstream-days', dest='upstream_days', metavar='days',
+                        type=int, default=30,
+                        help='Compare new mails against upstream commits of '
+                             'the last days. 0 disables comparisons against '
+                             'upstream (default: %(default)s)')
+    parser.add_argument('-ta', dest='thres_accept', metavar='threshold',
+                        type=float, default=config.thresholds.autoaccept,
+                        help='Autoaccept threshold (default: %(default)s)')
+    parser.add_argument('-pre', dest='preevaluation', default='files',
+                        choices=['files', 'winnowing', 'series'],
+                        help='Preevaluation strategy (default: %(default)s)')
+    parser.add_argument('-cpu', dest='cpu_factor', metavar='cpu', type=float,
+                        default=0, help='CPU factor for parallelisation. 0 '
+                                        'evaluates in-process '
+                                        '(default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    config.thresholds.autoaccept = args.thres_accept
+    thresholds = config.thresholds
+
+    repo = config.repo
+    f_patch_groups, patch_groups = config.load_patch_groups(True)
+    repo.load_ccache(config.f_ccache_mbox)
+
+    upstream = set()
+    if args.upstream_days:
+        repo.load_ccache(config.f_ccache_upstream)
+        upstream = recent_upstream(repo, config.psd.upstream_hashes,
+                                   args.upstream_days)
+        log.info('Comparing against %d recent upstream commits' %
+                 len(upstream))
+
+    repo.cache_commits(patch_groups.get_untagged())
+    representatives = patch_groups.get_representative_system(
+        lambda x, y: repo[x].author_date > repo[y].author_date)
+
+    # False positives and the file maps of the candidates are loaded once,
+    # and are kept up to date while new mails are linked
+    false_positives = {x: FalsePositives(True, x, config.d_false_positives)
+                       for x in EvaluationType}
+    file_maps = {x: None for x in EvaluationType}
+    if args.preevaluation == 'files':
+        file_maps[EvaluationType.PatchStack] = \
+            file_commit_map(repo, representatives)
+        file_maps[EvaluationType.Upstream] = file_commit_map(repo, upstream)
+
+    if args.source == '-':
+        batches = pipe_batches(sys.stdin.buffer, args.interval)
+    else:
+        batches = maildir_batches(os.path.realpath(args.source), args.interval)
+
+    log.info('Watching %s' % args.source)
+    for batch in batches:
+        if not batch:
+            continue
+
+        new, failed = import_mail_batch(config.d_mbox, args.listname, batch)
+        repo.mbox.add_mails(new, args.listname)
+        log.info('Imported %d new mails (%d failed)' % (len(new), failed))
+        if not new:
+            continue
+
+        # Fully parse the new mails. Invalid mails are dropped.
+        valid, _ = repo.cache_commits([x[1] for x in new],
+                                      parallelise=args.cpu_factor > 0,
+                                      cpu_factor=args.cpu_factor)
+        if not valid:
+            continue
+
+        for message_id in valid:
+            patch_groups.insert_single(message_id)
+        representatives |= valid
+        if file_maps[EvaluationType.PatchStack] is not None:
+            file_commit_map(repo, valid, file_maps[EvaluationType.PatchStack])
+
+        evaluations = [(EvaluationType.PatchStack, representatives)]
+        if upstream:
+            evaluations.append((EvaluationType.Upstream, upstream))
+
+        for eval_type, candidates in evaluations:
+            result = evaluate_commit_list(repo, thresholds, True, eval_type,
+                                          valid, candidates,
+                                          parallelise=args.cpu_factor > 0,
+                                          cpu_factor=args.cpu_factor,
+                                          preevaluation=args.preevaluation,
+                                          candidate_files=file_maps[eval_type])
+            result.fp = false_positives[eval_type]
+
+            for orig, candidates in result.items():
+                for cand, sim_rating in candidates:
+                    if orig == cand or \
+                       sim_rating.diff_lines_ratio < \
+                       thresholds.diff_lines_ratio or \
+                       sim_rating.weighted(thresholds.message_diff_weight) < \
+                       thresholds.autoaccept or \
+                       patch_groups.is_related(orig, cand) or \
+                       result.fp.is_false_positive(patch_groups, orig, cand):
+                        continue
+
+                    log.info('  ↪ linking %s to %s' % (orig, cand))
+                    patch_groups.insert(orig, cand)
+                    if eval_type == EvaluationType.Upstream:
+                        patch_groups.tag(cand)
+
+                    # Only the latest mail of a cluster represents it
+                    cluster = patch_groups.get_untagged(orig)
+                    latest = max(cluster, key=lambda x: repo[x].author_date)
+                    obsolete = (cluster & representatives) - {latest}
+                    representatives -= obsolete
+                    representatives.add(latest)
+                    file_map = file_maps[EvaluationType.PatchStack]
+                    if file_map is not None:
+                        file_commit_map_discard(repo, file_map, obsolete)
+                        file_commit_map(repo, [latest], file_map)
+
+        patch_groups.save(f_patch_groups)
+        log.info('  ↪ saved %s' % f_patch_groups)
+
+
+if __name__ == '__main__':
+    config = Config(sys.argv[1])
+    mbox_watch(config, sys.argv[0], sys.argv[2:])
@@ -23,12 +23,17 @@ def optimise_cluster(prog, argv):
                                      description='Optimise an equiv\' class')
     parser.add_argument('eqclass', metavar='eqclass', type=str,
                         help='Equivalence class file')
+    format = parser.add_mutually_exclusive_group()
+    format.add_argument('-binary', dest='binary', action='store_true',
+                        default=None, help='Convert to binary format')
+    format.add_argument('-text', dest='binary', action='store_false',
+                        help='Convert to text format')
 
     args = parser.parse_args(argv)
 
     res = Cluster.from_file(args.eqclass, must_exist=True)
     res.optimize()
-    res.to_file(args.eqclass)
+    res.to_file(args.eqclass, binary=args.binary)
 
 
 if __name__ == '__main__':
@@ -15,7 +15,9 @@ the COPYING file in the top-level directory.
 import os
 import sys
 
+from itertools import product
 from logging import getLogger
+from multiprocessing import cpu_count
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
                                                 '..')))
@@ -24,14 +26,41 @@ from pypasta import *
 log = getLogger(__name__[-15:])
 
 
+def rate_batch(config, args):
+    results = [EvaluationResult.from_file(x, config.d_false_positives)
+               for x in args.er_filename]
+
+    _, patch_groups = config.load_patch_groups(results[0].is_mbox,
+                                               must_exist=True,
+                                               f_patch_groups=args.pg_filename)
+
+    def destination(point):
+        return os.path.join(args.batch, 'ta-%0.3f' % point[0],
+                            'dlr-%0.3f' % point[1], 'w-%0.3f' % point[2])
+
+    grid = [x for x in product(args.grid_ta, args.grid_dlr, args.grid_weight)
+            if not os.path.isfile(destination(x))]
+    log.info('Rating %d combinations of thresholds' % len(grid))
+
+    batch = BatchRating(results, patch_groups, config.repo,
+                        args.resp_commit_date)
+    for point, clustering in batch.rate_grid(grid):
+        filename = destination(point)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        clustering.to_file(filename)
+    log.info('  ↪ done')
+
+
 def rate(config, prog, argv):
     parser = argparse.ArgumentParser(prog=prog,
                                      description='classify results of analysis')
 
     # evaluation result and patch groups
     parser.add_argument('-er', dest='er_filename', metavar='filename',
-                        default=config.f_evaluation_result,
-                        help='Evaluation result PKL filename')
+                        nargs='+', default=[config.f_evaluation_result],
+                        help='Evaluation result filename. Batch mode accepts '
+                             'several results (e.g., patch stack and '
+                             'upstream), they are rated together')
     parser.add_argument('-pg', dest='pg_filename', metavar='filename',
                         default=None, help='Filename for patch groups')
 
@@ -47,19 +76,59 @@ def rate(config, prog, argv):
                         help='Heuristic factor for message to diff rating. '
                              '(default: %(default)s)')
 
+    # Batch mode
+    parser.add_argument('-batch', dest='batch', metavar='directory',
+                        type=str, default=None,
+                        help='Rate non-interactively for all combinations of '
+                             '-grid-ta, -grid-dlr and -grid-weight. Results '
+                             'are written to directory/ta-X/dlr-Y/w-Z, '
+                             'existing results are skipped. The patch groups '
+                             'are not modified.')
+    parser.add_argument('-grid-ta', dest='grid_ta', metavar='threshold',
+                        type=float, nargs='+',
+                        default=[config.thresholds.autoaccept],
+                        help='Autoaccept thresholds (default: %(default)s)')
+    parser.add_argument('-grid-dlr', dest='grid_dlr', metavar='threshold',
+                        type=float, nargs='+',
+                        default=[config.thresholds.diff_lines_ratio],
+                        help='Diff lines ratio thresholds '
+                             '(default: %(default)s)')
+    parser.add_argument('-grid-weight', dest='grid_weight', metavar='weight',
+                        type=float, nargs='+',
+                        default=[config.thresholds.message_diff_weight],
+                        help='Message to diff weights (default: %(default)s)')
+
     parser.add_argument('-rcd', dest='resp_commit_date', action='store_true',
                         default=False, help='Respect commit date')
     parser.add_argument('-p', dest='enable_pager', action='store_true',
                         default=False, help='Enable pager')
+    parser.add_argument('-prefetch', dest='prefetch', metavar='pairs',
+                        type=int, default=4,
+                        help='Number of pairs that are loaded and rendered '
+                             'ahead during interactive rating '
+                             '(default: %(default)s)')
+    parser.add_argument('-cpu', dest='cpu_factor', metavar='cpu', type=float,
+                        default=0, help='CPU factor for parallelisation of '
+                                        'auto-accepted pairs. Independent '
+                                        'components of the candidate graph '
+                                        'are rated in parallel, e.g., for '
+                                        'non-interactive runs with -ti equal '
+                                        'to -ta. 0 rates in-process '
+                                        '(default: %(default)s)')
 
     args = parser.parse_args(argv)
+    if not args.batch and len(args.er_filename) != 1:
+        parser.error('multiple results are only supported in batch mode')
 
     config.thresholds.autoaccept = args.thres_accept
     config.thresholds.interactive = args.thres_interactive
     config.thresholds.message_diff_weight = args.weight
 
     repo = config.repo
-    evaluation_result = EvaluationResult.from_file(args.er_filename,
+    if args.batch:
+        return rate_batch(config, args)
+
+    evaluation_result = EvaluationResult.from_file(args.er_filename[0],
                                                    config.d_false_positives)
 
     f_patch_groups, patch_groups =\
@@ -71,12 +140,17 @@ def rate(config, prog, argv):
              (('mailbox' if evaluation_result.is_mbox else 'patch stack'),
               evaluation_result.eval_type.name))
 
+    processes = 1
+    if args.cpu_factor > 0:
+        processes = max(1, int(cpu_count() * args.cpu_factor))
+
     evaluation_result.interactive_rating(repo, patch_groups,
                                          config.thresholds,
                                          args.resp_commit_date,
-                                         args.enable_pager)
+                                         args.enable_pager,
+                                         args.prefetch, processes)
 
-    patch_groups.to_file(f_patch_groups)
+    patch_groups.save(f_patch_groups)
     evaluation_result.fp.to_file(config.d_false_positives)
 
 
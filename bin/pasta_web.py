@@ -90,9 +90,8 @@ def view():
     commit = config.repo[id]
 
     if isinstance(commit, PatchMail):
-        filename = config.repo.mbox[id]
-        with open(filename, 'rb') as f:
-            return Response(f.read(), mimetype='text/plain')
+        raw = config.repo.mbox[id]
+        return Response(bytes(raw), mimetype='text/plain')
 
     fmt = '\n'.join(commit.format_message() + commit.diff.raw)
 
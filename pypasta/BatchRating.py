@@ -0,0 +1,404 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import numpy as np
+
+from logging import getLogger
+from multiprocessing import Pool
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .PatchEvaluation import EvaluationType
+
+log = getLogger(__name__[-15:])
+
+# The batch is shared with the worker processes of auto_accept
+_batch = None
+
+
+def _rate_components_helper(indices):
+    return _batch._rate_components(indices)
+
+
+class BatchRating:
+    """
+    Non-interactive rating of one or more evaluation results for many
+    thresholds at once.
+
+    Pairs of all results are kept as arrays. For each set of thresholds,
+    the accepted pairs are determined by a mask on those arrays, and the
+    classes of the initial clustering that are connected by accepted pairs
+    are merged in a copy of the clustering. Candidates of accepted upstream
+    pairs are tagged.
+
+    False positives and commit dates are checked against the initial
+    clustering, and only for pairs that are accepted by any of the
+    thresholds. Components of passing pairs that contain both ends of a
+    false positive are accepted pair by pair, as interactive_rating does, so
+    the result equals rating the results one after another.
+    """
+    def __init__(self, results, clustering, repo=None,
+                 respect_commitdate=False):
+        self.clustering = clustering
+        self.repo = repo
+        self.respect_commitdate = respect_commitdate
+
+        # Intern the hashes of all results
+        self.hashes = []
+        interned = dict()
+        columns = []
+        offset = 0
+        for i, result in enumerate(results):
+            hashes, origs, cands, msg, diff, dlr = result.columns()
+            for hash in hashes:
+                if hash not in interned:
+                    interned[hash] = len(self.hashes)
+                    self.hashes.append(hash)
+            local = np.array([interned[x] for x in hashes], dtype=np.int64)
+            columns.append((local[origs], local[cands], msg, diff, dlr,
+                            np.full(len(origs), i, dtype=np.int64),
+                            self._visiting_order(origs, msg + diff) + offset))
+            offset += len(origs)
+
+        self.origs, self.cands, self.msg, self.diff, self.dlr, \
+            self.result, self.order = [np.concatenate(x)
+                                       for x in zip(*columns)]
+        self.results = results
+        self.upstream = np.array([x.eval_type == EvaluationType.Upstream
+                                  for x in results], dtype=bool)[self.result]
+
+        # Pairs are excluded if they are rated against themselves. False
+        # positives and commit dates are checked on first acceptance.
+        self.excluded = self.origs == self.cands
+        self.checked = self.excluded.copy()
+        self.false_positive = np.zeros(len(self.origs), dtype=bool)
+        self.commit_date_mismatch = np.zeros(len(self.origs), dtype=bool)
+
+        # Each class of the clustering, and each hash that is not part of the
+        # clustering, is a node of the graph of accepted pairs. Remember one
+        # key of each node, it represents the node when merging classes.
+        lookup = clustering.lookup
+        nodes = dict()
+        self.representatives = []
+        for key, id in lookup.items():
+            if id not in nodes:
+                nodes[id] = len(self.representatives)
+                self.representatives.append(key)
+        node_of_hash = []
+        for hash in self.hashes:
+            if hash in lookup:
+                node_of_hash.append(nodes[lookup[hash]])
+            else:
+                node_of_hash.append(len(self.representatives))
+                self.representatives.append(hash)
+        node_of_hash = np.array(node_of_hash, dtype=np.int64)
+        self.orig_nodes = node_of_hash[self.origs]
+        self.cand_nodes = node_of_hash[self.cands]
+
+        self._lookup = lookup
+        self._nodes = nodes
+        self._interned = interned
+        self._node_of_hash = node_of_hash
+
+        log.info('Batch rating of %d pairs, %d classes' %
+                 (len(self.origs), len(self.representatives)))
+
+    @staticmethod
+    def _visiting_order(origs, ratings):
+        # interactive_rating visits the originals sorted by the rating of
+        # their first candidate, and their candidates in order. Pairs of the
+        # same original are adjacent.
+        order = np.empty(len(origs), dtype=np.int64)
+        if not len(origs):
+            return order
+
+        first = np.append(True, origs[1:] != origs[:-1])
+        group = np.cumsum(first) - 1
+        group_rank = np.empty(np.count_nonzero(first), dtype=np.int64)
+        group_rank[np.argsort(ratings[first], kind='stable')] = \
+            np.arange(len(group_rank))
+        order[np.lexsort((np.arange(len(origs)), group_rank[group]))] = \
+            np.arange(len(origs))
+        return order
+
+    def _node(self, key):
+        if key in self._lookup:
+            return self._nodes[self._lookup[key]]
+        if key in self._interned:
+            return int(self._node_of_hash[self._interned[key]])
+        return None
+
+    def _components(self, mask):
+        num_nodes = len(self.representatives)
+        origs = self.orig_nodes[mask]
+        cands = self.cand_nodes[mask]
+        graph = coo_matrix((np.ones(len(origs), dtype=np.int8),
+                            (origs, cands)), shape=(num_nodes, num_nodes))
+        _, labels = connected_components(graph, directed=False)
+        return origs, cands, labels
+
+    def conflicts(self, mask):
+        """
+        Returns the mask of all pairs whose origin is part of a component of
+        mask that contains both, the origin and the destination of a false
+        positive.
+
+        Merging the other components at once results in the same classes as
+        accepting their pairs one by one. Pairs of conflicting components must
+        be accepted one by one, as false positives exclude further pairs once
+        their classes grew.
+        """
+        _, _, labels = self._components(mask)
+
+        conflicting = set()
+        for result in self.results:
+            if not result.fp:
+                continue
+            for origin, destination in result.fp.pairs():
+                origin = self._node(origin)
+                destination = self._node(destination)
+                if origin is None or destination is None or \
+                   origin == destination:
+                    continue
+                if labels[origin] == labels[destination]:
+                    conflicting.add(labels[origin])
+
+        return np.isin(labels[self.orig_nodes], list(conflicting))
+
+    def _check(self, indices):
+        for i in indices:
+            result = self.results[self.result[i]]
+            orig = self.hashes[self.origs[i]]
+            cand = self.hashes[self.cands[i]]
+
+            if result.fp and \
+               result.fp.is_false_positive(self.clustering, orig, cand):
+                self.false_positive[i] = True
+                self.excluded[i] = True
+            elif self.respect_commitdate and \
+                 self.repo[orig].commit_date > self.repo[cand].commit_date:
+                self.commit_date_mismatch[i] = True
+                self.excluded[i] = True
+
+        self.checked[indices] = True
+
+    def related(self):
+        """
+        Returns the mask of all pairs that are related in the initial
+        clustering
+        """
+        return self.orig_nodes == self.cand_nodes
+
+    def passing(self, autoaccept, diff_lines_ratio, message_diff_weight):
+        """
+        Returns the mask of all pairs whose rating passes the given
+        thresholds, regardless of false positives and commit dates
+        """
+        # weight by message_diff_weight, as SimRating.weighted() does
+        rating = message_diff_weight * self.msg + \
+                 (1 - message_diff_weight) * self.diff
+        return (self.dlr >= diff_lines_ratio) & (rating >= autoaccept)
+
+    def accepted(self, autoaccept, diff_lines_ratio, message_diff_weight):
+        """
+        Returns the mask of all pairs that are accepted with the given
+        thresholds
+        """
+        mask = self.passing(autoaccept, diff_lines_ratio, message_diff_weight)
+
+        unchecked = np.flatnonzero(mask & ~self.checked)
+        if len(unchecked):
+            self._check(unchecked)
+
+        return mask & ~self.excluded
+
+    def rate(self, autoaccept, diff_lines_ratio, message_diff_weight):
+        """
+        Returns a copy of the clustering, with all pairs accepted that pass
+        the given thresholds
+        """
+        clustering = self.clustering.copy()
+        self.auto_accept(clustering, autoaccept, diff_lines_ratio,
+                         message_diff_weight)
+        return clustering
+
+    def merge(self, clustering, mask):
+        """
+        Merges all classes of clustering that are connected by the pairs of
+        mask, and tags the candidates of upstream pairs. The classes must not
+        have been split since the initial clustering.
+        """
+        groups, tags = self._fragments(mask)
+        for group in groups:
+            clustering.insert(*group)
+        for tag in tags:
+            clustering.tag(tag)
+
+    def _fragments(self, mask):
+        # Returns the groups of representatives that are merged by the pairs
+        # of mask, and the candidates that are tagged
+        if not mask.any():
+            return [], []
+
+        origs, cands, labels = self._components(mask)
+
+        # Only merge components that are touched by accepted pairs
+        touched = np.unique(np.concatenate((origs, cands)))
+        components = dict()
+        for node in touched.tolist():
+            components.setdefault(labels[node], []).append(node)
+        groups = [[self.representatives[x] for x in nodes]
+                  for nodes in components.values()]
+
+        tags = [self.hashes[x]
+                for x in np.unique(self.cands[mask & self.upstream]).tolist()]
+
+        return groups, tags
+
+    def _rate_components(self, indices):
+        # Accepts the pairs of indices, which must cover entire components of
+        # the graph of candidate pairs. Returns the resulting fragments of
+        # the clustering and statistics.
+        indices = indices[np.argsort(self.order[indices], kind='stable')]
+        self._check(indices[~self.checked[indices]])
+
+        # Conflicts are determined on all candidate pairs, not only on the
+        # accepted ones: tagging a class during acceptance lifts its false
+        # positives, so excluded pairs may become acceptable
+        candidates = np.zeros(len(self.origs), dtype=bool)
+        candidates[indices] = True
+        conflicting = self.conflicts(candidates)
+        bulk = indices[~conflicting[indices]]
+        accepted = candidates & ~self.excluded & ~conflicting
+
+        stats = dict(already_detected=0,
+                     already_false_positive=np.count_nonzero(
+                         self.false_positive[bulk]),
+                     skipped_by_commit_date=np.count_nonzero(
+                         self.commit_date_mismatch[bulk]),
+                     auto_accepted=np.count_nonzero(accepted))
+        groups, tags = self._fragments(accepted)
+
+        sequential = indices[conflicting[indices]]
+        if not len(sequential):
+            return groups, tags, stats
+
+        # Accept the pairs of conflicting components one by one, in the same
+        # order as interactive_rating does. Pairs are accepted on a copy of
+        # the initial clustering, and the resulting classes are returned as
+        # groups of representatives.
+        clustering = self.clustering.copy()
+        touched = set()
+        for i in sequential.tolist():
+            result = self.results[self.result[i]]
+            orig = self.hashes[self.origs[i]]
+            cand = self.hashes[self.cands[i]]
+
+            if clustering.is_related(orig, cand):
+                stats['already_detected'] += 1
+                continue
+
+            if result.fp and \
+               result.fp.is_false_positive(clustering, orig, cand):
+                stats['already_false_positive'] += 1
+                continue
+
+            if self.respect_commitdate and \
+               self.repo[orig].commit_date > self.repo[cand].commit_date:
+                stats['skipped_by_commit_date'] += 1
+                continue
+
+            stats['auto_accepted'] += 1
+            clustering.insert(orig, cand)
+            touched |= {self.orig_nodes[i], self.cand_nodes[i]}
+            # Tags affect further false positive checks
+            if self.upstream[i]:
+                clustering.tag(cand)
+                tags.append(cand)
+
+        classes = dict()
+        for node in sorted(touched):
+            representative = self.representatives[node]
+            classes.setdefault(clustering.get_equivalence_id(representative),
+                               []).append(representative)
+        groups += [x for x in classes.values() if len(x) > 1]
+
+        return groups, tags, stats
+
+    def auto_accept(self, clustering, autoaccept, diff_lines_ratio,
+                    message_diff_weight, processes=1):
+        """
+        Accepts all pairs that pass the given thresholds in clustering, with
+        the same result as accepting them one by one in interactive_rating.
+        clustering must equal the initial clustering, it is modified in
+        place. Returns the statistics of the rating.
+
+        Candidate pairs are partitioned into independent connected
+        components, which are rated in parallel by processes workers. Their
+        fragments are merged in a deterministic order.
+        """
+        global _batch
+
+        passing = self.passing(autoaccept, diff_lines_ratio,
+                               message_diff_weight) & (self.origs != self.cands)
+        related = passing & self.related()
+        passing &= ~related
+
+        # Distribute the components to the workers, largest ones first
+        indices = np.flatnonzero(passing)
+        _, _, labels = self._components(passing)
+        labels = labels[self.orig_nodes[indices]]
+        components = np.split(indices[np.argsort(labels, kind='stable')],
+                              np.flatnonzero(np.diff(np.sort(labels))) + 1)
+        components = [x for x in components if len(x)]
+        components.sort(key=len, reverse=True)
+
+        buckets = [[] for _ in range(max(1, min(processes, len(components))))]
+        load = [0] * len(buckets)
+        for component in components:
+            bucket = load.index(min(load))
+            buckets[bucket].append(component)
+            load[bucket] += len(component)
+        buckets = [np.concatenate(x) for x in buckets if x]
+
+        log.info('Auto-accepting %d pairs of %d components in %d buckets' %
+                 (len(indices), len(components), len(buckets)))
+        if len(buckets) > 1:
+            _batch = self
+            p = Pool(processes=len(buckets))
+            fragments = p.map(_rate_components_helper, buckets, chunksize=1)
+            p.close()
+            p.join()
+            _batch = None
+        else:
+            fragments = [self._rate_components(x) for x in buckets]
+
+        stats = dict(already_detected=np.count_nonzero(related),
+                     already_false_positive=0, skipped_by_commit_date=0,
+                     auto_accepted=0)
+        for groups, tags, bucket_stats in fragments:
+            for group in groups:
+                clustering.insert(*group)
+            for tag in tags:
+                clustering.tag(tag)
+            for key, value in bucket_stats.items():
+                stats[key] += value
+
+        return stats
+
+    def rate_grid(self, grid):
+        """
+        Rates all points (autoaccept, diff_lines_ratio, message_diff_weight)
+        of grid. Yields each point together with its resulting clustering.
+        """
+        for point in grid:
+            yield point, self.rate(*point)
@@ -10,30 +10,145 @@ This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
 
+import mmap
+import numpy as np
+import os
+import struct
+
 from logging import getLogger
 
 log = getLogger(__name__[-15:])
 
 
 class Cluster:
+    """
+    Equivalence classes, implemented as union-find structure with path
+    compression and union by size.
+
+    Besides its parent, each element points to its successor in a circular
+    list of all members of its class. Merging two classes splices their lists
+    in constant time. Member sets are materialised on demand, and are cached
+    until the class changes.
+
+    Clusters are stored as text, one class per line, or in a binary format
+    that holds the keys grouped by class, the class offsets and a bitmap of
+    tags. Both formats convert to each other without loss. Changes can be
+    saved as journal of operations next to such a snapshot.
+    """
     SEPARATOR = ' => '
 
+    # Binary format: magic, version, number of classes, number of keys,
+    # length of the key blob
+    MAGIC = b'PaStAClu'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIQQQ')
+
+    # Operations since the last snapshot are appended to a journal next to the
+    # snapshot. It is compacted once it exceeds this fraction of the snapshot.
+    JOURNAL_SUFFIX = '.journal'
+    JOURNAL_RATIO = 0.25
+
     def __init__(self):
-        self.classes = list()
-        self.lookup = dict()
+        # element -> parent element
+        self.parent = dict()
+        # root -> number of elements of the class
+        self.size = dict()
+        # element -> next element of the same class
+        self.next = dict()
+        # root -> class id. Insertion order of roots is the order of classes.
+        self.ids = dict()
+        # root -> materialised set of members
+        self._members = dict()
+        # element -> class id, built on demand and dropped whenever elements
+        # or class ids change
+        self._lookup = None
+        self._next_id = 0
         self.tags = set()
+        # Operations since the cluster was loaded resp. saved
+        self._operations = []
+        # Incremented whenever classes are split up
+        self.generation = 0
+        # If enabled by log_merges(): (old id, new id) for each merge of
+        # classes, and (key, id) for each key that enters the cluster
+        self.merges = None
+
+    def _find(self, elem):
+        parent = self.parent
+        root = elem
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while parent[elem] != root:
+            parent[elem], elem = root, parent[elem]
+        return root
+
+    def _members_of(self, root):
+        if root not in self._members:
+            members = set()
+            elem = root
+            while True:
+                members.add(elem)
+                elem = self.next[elem]
+                if elem == root:
+                    break
+            self._members[root] = members
+        return self._members[root]
+
+    def _union(self, a, b):
+        a = self._find(a)
+        b = self._find(b)
+        if a == b:
+            return a
+
+        # union by size, the larger class keeps the lower id
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        id = min(self.ids[a], self.ids[b])
+
+        self.parent[b] = a
+        self.size[a] += self.size.pop(b)
+        self.next[a], self.next[b] = self.next[b], self.next[a]
+        if self.merges is not None:
+            self.merges.append((max(self.ids[a], self.ids[b]), id))
+        self.ids.pop(b)
+        self.ids[a] = id
+
+        self._lookup = None
+        self._members.pop(a, None)
+        self._members.pop(b, None)
+
+        return a
+
+    def copy(self):
+        """
+        Returns an independent copy of the cluster. Operations and merges
+        are not carried over.
+        """
+        retval = Cluster()
+        retval.parent = self.parent.copy()
+        retval.size = self.size.copy()
+        retval.next = self.next.copy()
+        retval.ids = self.ids.copy()
+        retval._next_id = self._next_id
+        retval.tags = self.tags.copy()
+        return retval
 
-    def optimize(self):
-        # get optimized list by filtering orphaned elements
-        self.classes = list(filter(None, self.classes))
+    def log_merges(self):
+        """
+        Starts recording merges to self.merges. This allows to follow class
+        ids as long as classes are not split up, i.e., as long as
+        self.generation does not change.
+        """
+        if self.merges is None:
+            self.merges = []
 
-        # reset lookup table
-        self.lookup = dict()
+    def optimize(self):
+        # fully compress all paths
+        for elem in self.parent:
+            self._find(elem)
 
-        # recreate the lookup dictionary
-        for i, keylist in enumerate(self.classes):
-            for key in keylist:
-                self.lookup[key] = i
+    def _record(self, *operation):
+        self._operations.append(' '.join(str(x) for x in operation))
 
     def ripup_cluster(self, representative):
         """
@@ -41,21 +156,45 @@ class Cluster:
         cluster and reinserts them as single-element clusters
         :return: Elements of the former cluster
         """
-        id = self.lookup[representative]
-
-        elems = self.classes.pop(id)
+        self._record('ripup', representative)
+        return self._ripup_cluster(representative)
+
+    def _ripup_cluster(self, representative):
+        self.generation += 1
+        root = self._find(representative)
+        elems = set(self._members_of(root))
+
+        self._lookup = None
+        self._members.pop(root)
+        self.ids.pop(root)
+        self.size.pop(root)
         for elem in elems:
-            self.lookup.pop(elem)
+            del self.parent[elem]
+            del self.next[elem]
 
         for elem in elems:
-            self.insert_single(elem)
+            self._insert_single(elem)
 
         return elems
 
     def remove_key(self, key):
+        self._record('remove', key)
+        self._remove_key(key)
+
+    def _remove_key(self, key):
         self.tags.discard(key)
-        id = self.lookup.pop(key)
-        self.classes[id].remove(key)
+        others = self._ripup_cluster(key) - {key}
+
+        root = self._find(key)
+        del self.parent[key]
+        del self.next[key]
+        self._lookup = None
+        self.size.pop(root)
+        self.ids.pop(root)
+        self._members.pop(root, None)
+
+        if others:
+            self._insert(*others)
 
     def remove_single_element_clusters(self):
         single_element_clusters = set()
@@ -73,68 +212,72 @@ class Cluster:
         """
         Returns True, if _all_ elements are in the same equivalence class
         """
-        ids = {self.lookup.get(x, None) for x in elems}
-
-        if None in ids:
+        if not all(x in self.parent for x in elems):
             return False
 
-        return len(ids) == 1
+        return len({self._find(x) for x in elems}) == 1
 
     def is_unrelated(self, *elems):
         """
         Returns True, if _all_ elements are in their own class
         """
-        num_elems = len(elems)
-        ids = [self.lookup.get(x, None) for x in elems]
-        num_elems -= ids.count(None)
-        ids = set(ids)
-        ids.discard(None)
-
-        if len(ids) == num_elems:
-            return True
-        return False
+        roots = [self._find(x) for x in elems if x in self.parent]
+        return len(set(roots)) == len(roots)
 
     def insert_single(self, elem):
-        if elem in self.lookup:
-            return self.lookup[elem]
-
-        self.classes.append(set([elem]))
-        id = len(self.classes) - 1
-        self.lookup[elem] = id
+        self._record('insert', elem)
+        return self._insert_single(elem)
+
+    def _insert_single(self, elem):
+        if elem in self.parent:
+            return self.ids[self._find(elem)]
+
+        self._lookup = None
+        self.parent[elem] = elem
+        self.size[elem] = 1
+        self.next[elem] = elem
+        id = self._next_id
+        self._next_id += 1
+        self.ids[elem] = id
+        if self.merges is not None:
+            self.merges.append((elem, id))
 
         return id
 
-    def _merge_ids(self, *ids):
-        new_class = set()
-        new_id = min(ids)
-
-        for id in ids:
-            for elem in self.classes[id]:
-                self.lookup[elem] = new_id
-            new_class |= self.classes[id]
-            self.classes[id] = set()
-
-        self.classes[new_id] = new_class
-
-        # truncate empty trailing list elements
-        while not self.classes[-1]:
-            self.classes.pop()
-
-        return new_id
-
     def insert(self, *elems):
-        ids = [self.insert_single(elem) for elem in elems]
+        self._record('insert', *elems)
+        return self._insert(*elems)
 
-        # check if all elements are already in the same class
-        if len(set(ids)) == 1:
-            return ids[0]
+    def _insert(self, *elems):
+        for elem in elems:
+            self._insert_single(elem)
 
-        return self._merge_ids(*ids)
+        root = self._find(elems[0])
+        for elem in elems[1:]:
+            root = self._union(root, elem)
+
+        return self.ids[root]
 
     def get_equivalence_id(self, key):
-        return self.lookup[key]
+        return self.ids[self._find(key)]
+
+    @property
+    def lookup(self):
+        """
+        Dictionary of all elements and the id of their class. It is built once
+        and cached until elements are inserted or removed, or classes are
+        merged or split up. Tags don't affect it. Don't modify the returned
+        dictionary.
+        """
+        if self._lookup is None:
+            self._lookup = {x: self.ids[self._find(x)] for x in self.parent}
+        return self._lookup
 
     def tag(self, key, tag=True):
+        self._record('tag' if tag is True else 'untag', key)
+        self._tag(key, tag)
+
+    def _tag(self, key, tag=True):
         if tag is True:
             self.tags.add(key)
         else:
@@ -144,7 +287,7 @@ class Cluster:
         return key in self.tags
 
     def get_keys(self):
-        return set(self.lookup.keys())
+        return set(self.parent.keys())
 
     def get_cluster(self, key):
         """
@@ -152,7 +295,7 @@ class Cluster:
         """
         if key not in self:
             return None
-        return self.classes[self.lookup[key]].copy()
+        return self._members_of(self._find(key)).copy()
 
     def get_tagged(self, key=None):
         """
@@ -161,7 +304,7 @@ class Cluster:
         If key is not specified, this function returns all tags.
         """
         if key:
-            return self.tags.intersection(self.classes[self.lookup[key]])
+            return self.tags.intersection(self._members_of(self._find(key)))
         return self.tags
 
     def get_untagged(self, key=None):
@@ -171,18 +314,17 @@ class Cluster:
         If key is not specified, this function returns all untagged.
         """
         if key:
-            return self.classes[self.lookup[key]] - self.tags
-        return set(self.lookup.keys()) - self.tags
+            return self._members_of(self._find(key)) - self.tags
+        return set(self.parent.keys()) - self.tags
 
     def __getitem__(self, item):
-        if item in self.lookup:
-            id = self.get_equivalence_id(item)
-            return self.classes[id]
+        if item in self.parent:
+            return self._members_of(self._find(item))
 
         return None
 
     def __len__(self):
-        return len(self.classes)
+        return len(self.ids)
 
     def __str__(self):
         retval = str()
@@ -228,14 +370,12 @@ class Cluster:
 
     def __iter__(self):
         # iterate over all classes, and return all items
-        for elem in self.classes:
-            if not elem:
-                continue
-            yield elem
+        for root in list(self.ids.keys()):
+            yield self._members_of(root)
 
     def iter_untagged(self):
         # iterate over all classes, but return untagged items only
-        for elem in self.classes:
+        for elem in self:
             untagged = elem - self.tags
             if not untagged:
                 continue
@@ -253,38 +393,244 @@ class Cluster:
             yield untagged, tagged
 
     def __contains__(self, item):
-        return item in self.lookup
+        return item in self.parent
+
+    @staticmethod
+    def is_binary(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return f.read(len(Cluster.MAGIC)) == Cluster.MAGIC
+        except FileNotFoundError:
+            return False
+
+    def to_file(self, filename, binary=None):
+        """
+        Writes the cluster to filename. If binary is not specified, the format
+        of an existing file is kept, and new files are text files.
+        """
+        if binary is None:
+            binary = Cluster.is_binary(filename)
 
-    def to_file(self, filename):
         self.optimize()
-        with open(filename, 'w') as f:
-            f.write(str(self))
+        content = self._to_binary() if binary else str(self).encode()
+
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, filename)
+
+        # The new snapshot contains all journaled operations. An existing
+        # journal refers to the former snapshot, and is ignored on load, even
+        # if we get interrupted before removing it.
+        journal = Cluster.journal_filename(filename)
+        if os.path.isfile(journal):
+            os.remove(journal)
+        self._operations = []
+
+    @staticmethod
+    def journal_filename(filename):
+        return filename + Cluster.JOURNAL_SUFFIX
+
+    @staticmethod
+    def _snapshot_id(filename):
+        stat = os.stat(filename)
+        return 'snapshot %d %d' % (stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def _journal_id(journal):
+        with open(journal) as f:
+            return f.readline().rstrip('\n')
+
+    @staticmethod
+    def _truncate_journal(journal):
+        # Drop an incomplete last line of an interrupted write
+        with open(journal, 'r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            if not size:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            f.truncate(f.read().rfind(b'\n') + 1)
+
+    def save(self, filename):
+        """
+        Persists all operations since the cluster was loaded by appending them
+        to the journal of the snapshot filename. The journal is compacted to a
+        new snapshot once it exceeds a fraction of the size of the snapshot.
+        """
+        if not os.path.isfile(filename):
+            self.to_file(filename)
+            return
+
+        if not self._operations:
+            return
+
+        journal = Cluster.journal_filename(filename)
+        snapshot_id = Cluster._snapshot_id(filename)
+        content = ''.join(x + '\n' for x in self._operations)
+        if not os.path.isfile(journal):
+            content = snapshot_id + '\n' + content
+        elif Cluster._journal_id(journal) != snapshot_id:
+            # Operations of a stale journal would never be replayed
+            self.to_file(filename)
+            return
+        else:
+            Cluster._truncate_journal(journal)
+
+        with open(journal, 'a') as f:
+            f.write(content)
+        self._operations = []
+
+        if os.path.getsize(journal) > \
+           os.path.getsize(filename) * Cluster.JOURNAL_RATIO:
+            log.info('Compacting journal of %s' % filename)
+            self.to_file(filename)
+
+    def _replay(self, filename):
+        journal = Cluster.journal_filename(filename)
+        if not os.path.isfile(journal):
+            return 0
+
+        with open(journal) as f:
+            content = f.read()
+        # An incomplete last line stems from an interrupted write
+        operations = content.split('\n')[:-1]
+
+        if not operations or operations[0] != Cluster._snapshot_id(filename):
+            log.warning('Ignoring stale journal %s' % journal)
+            return 0
+
+        for operation in operations[1:]:
+            if not operation:
+                continue
+            operation, *keys = operation.split(' ')
+            if operation == 'insert':
+                self._insert(*keys)
+            elif operation in ('tag', 'untag'):
+                self._tag(keys[0], operation == 'tag')
+            elif keys[0] not in self:
+                continue
+            elif operation == 'remove':
+                self._remove_key(keys[0])
+            elif operation == 'ripup':
+                self._ripup_cluster(keys[0])
+
+        return len(operations) - 1
+
+    def _to_binary(self):
+        keys = []
+        class_offsets = [0]
+        for members in self:
+            keys += sorted(str(x) for x in members)
+            class_offsets.append(len(keys))
+
+        tags = {str(x) for x in self.tags}
+        tags = np.packbits(np.array([x in tags for x in keys], dtype=bool))
+        keys = '\n'.join(keys).encode()
+        class_offsets = np.array(class_offsets, dtype=np.uint64)
+
+        header = Cluster.HEADER.pack(Cluster.MAGIC, Cluster.VERSION,
+                                     len(class_offsets) - 1,
+                                     int(class_offsets[-1]), len(keys))
+        content = [header]
+        for array in [class_offsets.tobytes(), tags.tobytes(), keys]:
+            content.append(array)
+            # keep arrays 8-byte aligned
+            content.append(b'\0' * (-len(array) % 8))
+
+        return b''.join(content)
+
+    @staticmethod
+    def _from_binary(buf):
+        """
+        Creates the cluster from its binary representation. The union-find
+        structure is set up directly, so classes don't need to be merged.
+
+        :return: cluster, offset of the end of the binary representation
+        """
+        magic, version, num_classes, num_keys, keys_len = \
+            Cluster.HEADER.unpack_from(buf)
+        if magic != Cluster.MAGIC or version != Cluster.VERSION:
+            raise ValueError('Invalid cluster file')
+
+        offset = Cluster.HEADER.size
+        class_offsets = np.frombuffer(buf, np.uint64, num_classes + 1, offset)
+        offset += class_offsets.nbytes + (-class_offsets.nbytes % 8)
+        tags_len = (num_keys + 7) // 8
+        tags = np.unpackbits(np.frombuffer(buf, np.uint8, tags_len, offset))
+        offset += tags_len + (-tags_len % 8)
+        keys = bytes(buf[offset:offset + keys_len]).decode()
+        keys = keys.split('\n') if num_keys else []
+        offset += keys_len + (-keys_len % 8)
+
+        retval = Cluster()
+        if not num_keys:
+            return retval, offset
+
+        class_offsets = class_offsets.astype(np.int64)
+        sizes = np.diff(class_offsets)
+        first = class_offsets[:-1]
+
+        # The first member of each class is its root, and the members form a
+        # ring in the order of the file.
+        roots = np.repeat(first, sizes).tolist()
+        successors = np.arange(1, num_keys + 1)
+        successors[class_offsets[1:] - 1] = first
+
+        roots = [keys[x] for x in roots]
+        retval.parent = dict(zip(keys, roots))
+        retval.next = dict(zip(keys, [keys[x] for x in successors.tolist()]))
+        root_keys = [keys[x] for x in first.tolist()]
+        retval.size = dict(zip(root_keys, sizes.tolist()))
+        retval.ids = dict(zip(root_keys, range(num_classes)))
+        retval._next_id = num_classes
+        retval.tags = {keys[x] for x in np.flatnonzero(tags[:num_keys])}
+
+        return retval, offset
+
+    def _insert_lines(self, content):
+        content = list(filter(None, content.splitlines()))
+        content = [(lambda x: (x[0].split(' ') if x[0] else [],
+                               x[1].split(' ') if len(x) == 2 else []))
+                   (x.split(Cluster.SEPARATOR))
+                   for x in content]
+
+        for untagged, tagged in content:
+            self._insert(*(untagged + tagged))
+            for tag in tagged:
+                self._tag(tag)
 
     @staticmethod
     def from_file(filename, must_exist=False):
         retval = Cluster()
 
         try:
-            with open(filename, 'r') as f:
-                content = f.read()
+            with open(filename, 'rb') as f:
+                if f.read(len(Cluster.MAGIC)) == Cluster.MAGIC:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    f.seek(0)
+                    buf = f.read()
         except FileNotFoundError:
             log.warning('Equivalence class not found: %s' % filename)
             if must_exist:
                 raise
             return retval
 
-        if not (content and len(content)):
-            return retval
+        offset = 0
+        if buf[0:len(Cluster.MAGIC)] == Cluster.MAGIC:
+            retval, offset = Cluster._from_binary(buf)
 
-        content = list(filter(None, content.splitlines()))
-        content = [(lambda x: (x[0].split(' ') if x[0] else [],
-                               x[1].split(' ') if len(x) == 2 else []))
-                   (x.split(Cluster.SEPARATOR))
-                   for x in content]
+        # Text lines may follow the binary representation. They were appended
+        # (e.g., by mbox_watch) and are merged.
+        content = bytes(buf[offset:]).decode()
+        if content:
+            retval._insert_lines(content)
 
-        for untagged, tagged in content:
-            retval.insert(*(untagged + tagged))
-            for tag in tagged:
-                retval.tag(tag)
+        replayed = retval._replay(filename)
+        if replayed:
+            log.info('  ↪ replayed %d operations from journal' % replayed)
 
         return retval
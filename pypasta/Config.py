@@ -26,7 +26,9 @@ log = getLogger(__name__[-15:])
 class Thresholds:
     def __init__(self, autoaccept, interactive, diff_lines_ratio,
                  heading, filename, message_diff_weight,
-                 author_date_interval):
+                 author_date_interval, large_diff_files=0,
+                 large_diff_candidates=0, large_diff_mapping=0,
+                 shared_fingerprints=3):
         """
         :param autoaccept: Auto accept threshold. Ratings with at least this
                threshold will automatically be accepted.
@@ -44,6 +46,18 @@ class Thresholds:
                be considered for comparison, if the difference of their
                author_dates is within patch_time_window days. A value of 0
                means infinite days.
+        :param large_diff_files: Patches that affect more than this number of
+               files are considered as large diffs (e.g., tree-wide renames).
+               A value of 0 disables the large diff policy.
+        :param large_diff_candidates: Maximum number of patches a large
+               diff will be compared against, regardless of whether it is the
+               original or the candidate. A value of 0 means no limit.
+        :param large_diff_mapping: Maximum number of file pairs that are
+               compared when rating a large diff. A value of 0 means no limit.
+        :param shared_fingerprints: Used for winnowing preevaluation: Two
+               patches will only be considered for comparison, if they share
+               at least this number of fingerprints, or all fingerprints of
+               smaller patches.
         """
 
         # t_a
@@ -60,6 +74,12 @@ class Thresholds:
         self.diff_lines_ratio = diff_lines_ratio
         # ptw
         self.author_date_interval = author_date_interval
+        # ldf, ldc, ldm
+        self.large_diff_files = large_diff_files
+        self.large_diff_candidates = large_diff_candidates
+        self.large_diff_mapping = large_diff_mapping
+        # sf
+        self.shared_fingerprints = shared_fingerprints
 
 
 class Config:
@@ -154,7 +174,11 @@ class Config:
                                      float(pasta.get('HEADING_THRESHOLD')),
                                      float(pasta.get('FILENAME_THRESHOLD')),
                                      float(pasta.get('MESSAGE_DIFF_WEIGHT')),
-                                     int(pasta.get('AUTHOR_DATE_INTERVAL')))
+                                     int(pasta.get('AUTHOR_DATE_INTERVAL')),
+                                     int(pasta.get('LARGE_DIFF_FILES', 0)),
+                                     int(pasta.get('LARGE_DIFF_CANDIDATES', 0)),
+                                     int(pasta.get('LARGE_DIFF_MAPPING', 0)),
+                                     int(pasta.get('SHARED_FINGERPRINTS', 3)))
 
         self.patch_stack_definition = \
             PatchStackDefinition.parse_definition_file(self)
@@ -0,0 +1,318 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import numpy as np
+import os
+import pickle
+
+from array import array
+from logging import getLogger
+from statistics import mean
+
+from .PatchEvaluation import EvaluationResult, SimRating, SIM_MAPPED, \
+    SIM_IDENTICAL
+
+log = getLogger(__name__[-15:])
+
+
+class EvaluationRecord:
+    """
+    Records the intermediate similarities of all pairs of an evaluation: their
+    message rating, their diff lines ratio, and the similarities of all
+    compared file and hunk pairs. Those similarities don't depend on the
+    filename and heading thresholds, only the mapping of files and hunks
+    does. If the evaluation ran with loose thresholds, the evaluation result
+    of any stricter thresholds can be derived from the record without
+    comparing patches again.
+
+    Similarities are kept in flat arrays, with CSR-like offsets from pairs to
+    their files, from files to their hunks, and from hunks to their scores.
+
+    Results are derived exactly, with the following exceptions: large diffs
+    (the sampled file mapping of the recorded thresholds is reused),
+    candidates that were capped because of a large diff, and, when deriving
+    a filename threshold of 1.0 from a lower one, pairs of revert and
+    non-revert patches (they are never evaluated below 1.0). Ratings are
+    symmetric, so pairs are reported in both directions if the preevaluation
+    of the derived thresholds does so.
+    """
+    VERSION = 1
+
+    # Rejected by the diff lines ratio, the pair was not compared
+    FLAG_SHORTCUT = 1
+    # Handled by the large diff policy
+    FLAG_LARGE = 2
+    # Both patches affect at least one identical file
+    FLAG_SHARED = 4
+    # Candidate because of an equal subject
+    FLAG_SUBJECT = 8
+    # The reverse pair is a candidate of the evaluation as well
+    FLAG_SYMMETRIC = 16
+
+    def __init__(self, is_mbox, eval_type, thresholds, preevaluation):
+        self.version = EvaluationRecord.VERSION
+        self.is_mbox = is_mbox
+        self.eval_type = eval_type
+        self.preevaluation = preevaluation
+
+        # Recorded thresholds. Only stricter ones can be derived.
+        self.filename = thresholds.filename
+        self.heading = thresholds.heading
+        self.diff_lines_ratio = thresholds.diff_lines_ratio
+        self.author_date_interval = thresholds.author_date_interval
+
+        self.hashes = []
+        self._interned = dict()
+
+        # Pairs
+        self.origs = array('q')
+        self.cands = array('q')
+        self.msg = array('d')
+        self.dlr = array('d')
+        self.days = array('q')
+        # NaN, if unknown
+        self.max_file_sim = array('d')
+        self.flags = array('B')
+        self.file_offsets = array('q', [0])
+
+        # Files
+        self.file_sims = array('d')
+        self.file_flags = array('B')
+        self.heading_offsets = array('q', [0])
+
+        # Hunks
+        self.heading_sims = array('d')
+        self.heading_flags = array('B')
+        self.score_offsets = array('q', [0])
+        self.scores = array('B')
+
+        # Pairs that were not evaluated, like cherry picks or linked pairs.
+        # They are part of each derived result.
+        self.fixed = EvaluationResult()
+
+    def __len__(self):
+        return len(self.origs)
+
+    def _intern(self, hash):
+        if hash not in self._interned:
+            self._interned[hash] = len(self.hashes)
+            self.hashes.append(hash)
+        return self._interned[hash]
+
+    def add(self, orig, cand, rating, record, subject=False,
+            symmetric=False):
+        """
+        Adds the rating of a pair together with its record of
+        evaluate_commit_pair
+        """
+        if not record:
+            # The pair was not compared (e.g., a patch against itself)
+            self.add_fixed({orig: [(cand, rating)]})
+            return
+
+        flags = 0
+        if record.get('shortcut'):
+            flags |= EvaluationRecord.FLAG_SHORTCUT
+        if record.get('large'):
+            flags |= EvaluationRecord.FLAG_LARGE
+        if record['shared']:
+            flags |= EvaluationRecord.FLAG_SHARED
+        if subject:
+            flags |= EvaluationRecord.FLAG_SUBJECT
+        if symmetric:
+            flags |= EvaluationRecord.FLAG_SYMMETRIC
+
+        max_file_sim = record['max_file_sim']
+
+        self.origs.append(self._intern(orig))
+        self.cands.append(self._intern(cand))
+        self.msg.append(rating.msg)
+        self.dlr.append(rating.diff_lines_ratio)
+        self.days.append(record['days'])
+        self.max_file_sim.append(float('nan') if max_file_sim is None
+                                 else max_file_sim)
+        self.flags.append(flags)
+
+        for file_sim, file_flags, headings in record.get('files', []):
+            self.file_sims.append(file_sim)
+            self.file_flags.append(file_flags)
+            for heading_sim, heading_flags, scores in headings:
+                self.heading_sims.append(heading_sim)
+                self.heading_flags.append(heading_flags)
+                self.scores.extend(scores)
+                self.score_offsets.append(len(self.scores))
+            self.heading_offsets.append(len(self.heading_sims))
+        self.file_offsets.append(len(self.file_sims))
+
+    def add_fixed(self, result):
+        self.fixed.merge({orig: list(candidates)
+                          for orig, candidates in result.items()})
+
+    def to_file(self, filename):
+        state = dict(self.__dict__)
+        del state['_interned']
+
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def from_file(filename):
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+
+        if state.get('version') != EvaluationRecord.VERSION:
+            raise ValueError('Invalid evaluation record: %s' % filename)
+
+        record = EvaluationRecord.__new__(EvaluationRecord)
+        record.__dict__.update(state)
+        record._interned = {x: i for i, x in enumerate(record.hashes)}
+        return record
+
+    @staticmethod
+    def _mapped(sims, flags, threshold):
+        # Vectorised variant of PatchEvaluation.is_mapped
+        if threshold >= 1.0:
+            return (flags & SIM_IDENTICAL) != 0
+        return ((flags & SIM_MAPPED) != 0) & (sims >= threshold)
+
+    def candidates(self, filename):
+        """
+        Returns the mask of all pairs that are candidates of the
+        preevaluation at the given filename threshold
+        """
+        flags = np.frombuffer(self.flags, np.uint8)
+        if self.preevaluation != 'files':
+            return np.ones(len(flags), dtype=bool)
+
+        if filename >= 1.0:
+            mask = (flags & EvaluationRecord.FLAG_SHARED) != 0
+            if self.author_date_interval:
+                mask &= np.frombuffer(self.days, np.int64) < \
+                        self.author_date_interval
+        else:
+            max_file_sim = np.frombuffer(self.max_file_sim, np.float64)
+            mask = np.isnan(max_file_sim) | (max_file_sim >= filename)
+
+        return mask | ((flags & EvaluationRecord.FLAG_SUBJECT) != 0)
+
+    def diff_ratings(self, filename, heading):
+        """
+        Returns the diff ratings of all pairs at the given thresholds. Equals
+        PatchEvaluation.rate_similarities.
+        """
+        n = len(self)
+        file_offsets = np.frombuffer(self.file_offsets, np.int64)
+        heading_offsets = np.frombuffer(self.heading_offsets, np.int64)
+        score_offsets = np.frombuffer(self.score_offsets, np.int64)
+
+        num_files = len(self.file_sims)
+        num_headings = len(self.heading_sims)
+
+        file_pair = np.repeat(np.arange(n), np.diff(file_offsets))
+        heading_file = np.repeat(np.arange(num_files),
+                                 np.diff(heading_offsets))
+        score_heading = np.repeat(np.arange(num_headings),
+                                  np.diff(score_offsets))
+
+        file_mapped = self._mapped(np.frombuffer(self.file_sims, np.float64),
+                                   np.frombuffer(self.file_flags, np.uint8),
+                                   filename)
+        heading_mapped = self._mapped(
+            np.frombuffer(self.heading_sims, np.float64),
+            np.frombuffer(self.heading_flags, np.uint8), heading) & \
+            file_mapped[heading_file]
+
+        score_mask = heading_mapped[score_heading]
+        score_file = heading_file[score_heading][score_mask]
+        scores = np.frombuffer(self.scores, np.uint8)[score_mask]
+
+        # Sums of integer scores are exact, and so is the mean of each file
+        sums = np.bincount(score_file, weights=scores, minlength=num_files)
+        counts = np.bincount(score_file, minlength=num_files)
+        rated = counts > 0
+        file_means = sums[rated] / counts[rated]
+        rated_pairs = file_pair[rated]
+
+        # The mean over the files of a pair must be calculated in the same
+        # way as rate_similarities does, otherwise it differs in the last
+        # bits.
+        ratings = np.zeros(n)
+        if len(rated_pairs):
+            starts = np.flatnonzero(np.diff(rated_pairs)) + 1
+            for pair, means in zip(rated_pairs[np.append(0, starts)].tolist(),
+                                   np.split(file_means, starts)):
+                ratings[pair] = mean(means.tolist()) / 100
+
+        return ratings
+
+    def derive(self, filename, heading, diff_lines_ratio=None):
+        """
+        Derives the evaluation result of stricter filename, heading and diff
+        lines ratio thresholds
+        """
+        if diff_lines_ratio is None:
+            diff_lines_ratio = self.diff_lines_ratio
+
+        if filename < min(self.filename, 1.0) or heading < \
+           min(self.heading, 1.0) or diff_lines_ratio < self.diff_lines_ratio:
+            raise ValueError('Thresholds must not be looser than the recorded '
+                             'thresholds (tf: %0.2f, th: %0.2f, dlr: %0.2f)' %
+                             (self.filename, self.heading,
+                              self.diff_lines_ratio))
+
+        log.info('Deriving tf: %0.2f, th: %0.2f, dlr: %0.2f from %d pairs' %
+                 (filename, heading, diff_lines_ratio, len(self)))
+
+        flags = np.frombuffer(self.flags, np.uint8)
+        dlr = np.frombuffer(self.dlr, np.float64)
+        candidates = self.candidates(filename)
+        compared = ((flags & EvaluationRecord.FLAG_SHORTCUT) == 0) & \
+                   (dlr >= diff_lines_ratio)
+        diff = self.diff_ratings(filename, heading)
+
+        # Unlike the preevaluation of lower filename thresholds, the quick
+        # path of 1.0 doesn't skip pairs that were inserted the other way round
+        both_directions = self.preevaluation == 'files' and filename >= 1.0
+
+        retval = EvaluationResult(self.is_mbox, self.eval_type)
+        origs = np.frombuffer(self.origs, np.int64)
+        cands = np.frombuffer(self.cands, np.int64)
+        for i in np.flatnonzero(candidates).tolist():
+            if compared[i]:
+                rating = SimRating(self.msg[i], float(diff[i]), self.dlr[i])
+            else:
+                rating = SimRating(0, 0, self.dlr[i])
+
+            orig = self.hashes[origs[i]]
+            cand = self.hashes[cands[i]]
+            pairs = [(orig, cand)]
+            if both_directions and \
+               flags[i] & EvaluationRecord.FLAG_SYMMETRIC and \
+               flags[i] & EvaluationRecord.FLAG_SHARED:
+                pairs.append((cand, orig))
+
+            for orig, cand in pairs:
+                if orig not in retval:
+                    retval[orig] = []
+                retval[orig].append((cand, rating))
+
+        for orig in retval.keys():
+            retval[orig].sort(key=lambda x: x[1], reverse=True)
+
+        retval.merge({orig: list(candidates)
+                      for orig, candidates in self.fixed.items()})
+
+        log.info('  ↪ %d of %d pairs are candidates' %
+                 (np.count_nonzero(candidates), len(self)))
+        return retval
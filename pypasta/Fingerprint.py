@@ -0,0 +1,171 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import pickle
+import re
+
+from collections import Counter
+from logging import getLogger
+from zlib import crc32
+
+log = getLogger(__name__[-15:])
+
+TOKEN_REGEX = re.compile(r'\w+|[^\w\s]')
+
+
+def winnow(text, k, w):
+    """
+    Winnowing of a token stream: hash all k-grams of tokens and select the
+    minimum hash of each window of w consecutive k-gram hashes.
+
+    :param text: Normalised text, prefixed by a marker that distinguishes
+                 insertions from deletions
+    :param k: number of tokens per k-gram
+    :param w: window size
+    :return: set of fingerprints
+    """
+    tokens = TOKEN_REGEX.findall(text)
+    if not tokens:
+        return set()
+
+    # Short hunks still deserve a fingerprint
+    if len(tokens) <= k:
+        return {crc32(' '.join(tokens).encode())}
+
+    hashes = [crc32(' '.join(tokens[i:i+k]).encode())
+              for i in range(len(tokens) - k + 1)]
+    if len(hashes) <= w:
+        return {min(hashes)}
+
+    return {min(hashes[i:i+w]) for i in range(len(hashes) - w + 1)}
+
+
+def diff_fingerprints(diff, k, w):
+    """
+    Returns the fingerprints of the insertions and deletions of all hunks of
+    a diff
+    """
+    fingerprints = set()
+    for hunks in diff.patches.values():
+        for hunk in hunks.values():
+            if hunk.insertions:
+                fingerprints |= winnow('+ ' + ' '.join(hunk.insertions), k, w)
+            if hunk.deletions:
+                fingerprints |= winnow('- ' + ' '.join(hunk.deletions), k, w)
+    return fingerprints
+
+
+class FingerprintIndex:
+    """
+    An inverted index that maps winnowing fingerprints of diffs to commit
+    hashes resp. Message-IDs. Patches that were squashed or split only share
+    some of their hunks, and so they only share some of their fingerprints.
+
+    Fingerprints are only computed for patches that are inserted, i.e., if
+    winnowing preevaluation is used. They are kept next to the commit cache
+    file, and the file is only rewritten if patches were inserted since it
+    was loaded.
+    """
+    SUFFIX = '.fingerprints'
+
+    # Fingerprints of boilerplate code (e.g., 'return 0; }') appear in
+    # thousands of patches. They don't carry any information and are ignored
+    # on queries.
+    MAX_POSTINGS = 1000
+
+    def __init__(self, k=5, w=4, max_postings=MAX_POSTINGS):
+        self.k = k
+        self.w = w
+        self.max_postings = max_postings
+
+        self.postings = dict()
+        self.fingerprints = dict()
+        # True, if fingerprints were computed since the index was loaded
+        self.modified = False
+
+    @staticmethod
+    def filename(f_ccache):
+        return f_ccache + FingerprintIndex.SUFFIX
+
+    def get_fingerprints(self, repo, commit_hash):
+        if commit_hash in self.fingerprints:
+            return self.fingerprints[commit_hash]
+        return diff_fingerprints(repo[commit_hash].diff, self.k, self.w)
+
+    def _insert(self, commit_hash, fingerprints):
+        self.fingerprints[commit_hash] = fingerprints
+        for fingerprint in fingerprints:
+            if fingerprint not in self.postings:
+                self.postings[fingerprint] = set()
+            self.postings[fingerprint].add(commit_hash)
+
+    def insert(self, repo, commit_hash):
+        if commit_hash not in self.fingerprints:
+            self._insert(commit_hash,
+                         self.get_fingerprints(repo, commit_hash))
+            self.modified = True
+
+    def query(self, repo, commit_hash, min_shared):
+        """
+        Returns all indexed patches that share at least min_shared fingerprints
+        with commit_hash. Small patches only have a few fingerprints, so they
+        must share all of them at most.
+        """
+        fingerprints = self.get_fingerprints(repo, commit_hash)
+        min_shared = min(min_shared, len(fingerprints))
+
+        counter = Counter()
+        for fingerprint in fingerprints:
+            postings = self.postings.get(fingerprint)
+            if not postings or len(postings) > self.max_postings:
+                continue
+            counter.update(postings)
+
+        return {x for x, shared in counter.items() if shared >= min_shared}
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, commit_hash):
+        return commit_hash in self.fingerprints
+
+    def load(self, f_ccache):
+        filename = FingerprintIndex.filename(f_ccache)
+        if not os.path.isfile(filename):
+            return
+
+        with open(filename, 'rb') as f:
+            k, w, fingerprints = pickle.load(f)
+
+        # Fingerprints of other parameters are useless
+        if (k, w) != (self.k, self.w):
+            return
+
+        for commit_hash, this_fingerprints in fingerprints.items():
+            if commit_hash not in self.fingerprints:
+                self._insert(commit_hash, this_fingerprints)
+
+    def export(self, f_ccache, ccache):
+        if not self.modified:
+            return
+
+        # Fingerprints of evicted commits are dropped
+        fingerprints = {x: self.fingerprints[x] for x in ccache.keys()
+                        if x in self.fingerprints}
+
+        filename = FingerprintIndex.filename(f_ccache)
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump((self.k, self.w, fingerprints), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.tmp', filename)
+        self.modified = False
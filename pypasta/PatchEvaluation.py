@@ -10,14 +10,20 @@ This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
 import functools
+import mmap
+import numpy as np
 import os
 import pickle
+import struct
 
+from collections.abc import Mapping
 from enum import Enum
 from fuzzywuzzy import fuzz
 from multiprocessing import Pool, cpu_count
 from statistics import mean
+from time import time
 
+from .Series import SeriesIndex
 from .Util import *
 
 log = getLogger(__name__[-15:])
@@ -25,6 +31,10 @@ log = getLogger(__name__[-15:])
 # We need this global variable, as pygit2 Repository objects are not pickleable
 _tmp_repo = None
 
+# Flags of compared file and hunk pairs, cf. diff_similarities
+SIM_MAPPED = 1
+SIM_IDENTICAL = 2
+
 
 class EvaluationType(Enum):
     PatchStack = 1
@@ -42,6 +52,16 @@ class FalsePositives:
         self._false_positives = {}
         self._prefix = 'mbox-' if is_mbox else ''
 
+        # Index of the false positives by the ids of their classes in the
+        # equivalence class _indexed: origin id -> destination id -> origins,
+        # destination id -> origin ids, and origin id -> origins
+        self._indexed = None
+        self._generation = None
+        self._merges = 0
+        self._pairs = {}
+        self._reverse = {}
+        self._origins = {}
+
         if dir is None:
             return
 
@@ -74,49 +94,107 @@ class FalsePositives:
                 destinations = sorted(self._false_positives[origin])
                 f.write('%s %s\n' % (origin, ' '.join(destinations)))
 
+    @staticmethod
+    def _class_id(equivalence_class, key):
+        # Keys that are not part of the equivalence class stand for themselves
+        if key in equivalence_class:
+            return equivalence_class.get_equivalence_id(key)
+        return key
+
+    def _add(self, origin_id, destination_id, origin):
+        self._pairs.setdefault(origin_id, {}).setdefault(destination_id,
+                                                         set()).add(origin)
+        self._reverse.setdefault(destination_id, set()).add(origin_id)
+        self._origins.setdefault(origin_id, set()).add(origin)
+
+    def _rekey(self, old, new):
+        if old in self._origins:
+            self._origins.setdefault(new, set()).update(self._origins.pop(old))
+
+        if old in self._pairs:
+            destinations = self._pairs.setdefault(new, {})
+            for destination_id, origins in self._pairs.pop(old).items():
+                destinations.setdefault(destination_id, set()).update(origins)
+                reverse = self._reverse[destination_id]
+                reverse.discard(old)
+                reverse.add(new)
+
+        if old in self._reverse:
+            for origin_id in self._reverse.pop(old):
+                destinations = self._pairs[origin_id]
+                destinations.setdefault(new, set()).update(
+                    destinations.pop(old))
+                self._reverse.setdefault(new, set()).add(origin_id)
+
+    def _sync(self, equivalence_class):
+        """
+        Keeps the index of false positives consistent with the classes of the
+        equivalence class. Merges of classes are followed incrementally, the
+        index is rebuilt if classes were split up.
+        """
+        if equivalence_class is self._indexed and \
+           equivalence_class.generation == self._generation and \
+           equivalence_class.merges is not None:
+            merges = equivalence_class.merges
+            for old, new in merges[self._merges:]:
+                self._rekey(old, new)
+            self._merges = len(merges)
+            return
+
+        equivalence_class.log_merges()
+        self._indexed = equivalence_class
+        self._generation = equivalence_class.generation
+        self._merges = len(equivalence_class.merges)
+
+        self._pairs = {}
+        self._reverse = {}
+        self._origins = {}
+        for origin, destinations in self._false_positives.items():
+            origin_id = self._class_id(equivalence_class, origin)
+            for destination in destinations:
+                self._add(origin_id,
+                          self._class_id(equivalence_class, destination),
+                          origin)
+
+    def pairs(self):
+        """
+        Yields all pairs (origin, destination) of false positives
+        """
+        for origin, destinations in self._false_positives.items():
+            for destination in destinations:
+                yield origin, destination
+
     def mark(self, equivalence_class, origin, destination):
         if self.is_false_positive(equivalence_class, origin, destination):
             return
 
+        self._sync(equivalence_class)
+        origin_id = self._class_id(equivalence_class, origin)
+
         # try to find a alternative origin
-        for candidate in self._false_positives.keys():
-            if equivalence_class.is_related(origin, candidate):
-                origin = candidate
-                break
+        if origin_id in self._origins:
+            origin = min(self._origins[origin_id])
 
         if origin not in self._false_positives:
             self._false_positives[origin] = set()
 
         self._false_positives[origin].add(destination)
+        self._add(origin_id, self._class_id(equivalence_class, destination),
+                  origin)
 
     def is_false_positive(self, equivalence_class, origin, destination):
-        alt_origin = list(equivalence_class.get_untagged(origin) &\
-                     self._false_positives.keys())
-
-        if len(alt_origin) == 0:
+        if origin not in equivalence_class:
             return False
 
-        origin = alt_origin[0]
-        if len(alt_origin) > 1:
-            # merge those keys that are now equivalent
-            for sub in alt_origin[1:]:
-                self._false_positives[origin] |= self._false_positives[sub]
-                del self._false_positives[sub]
-
-        alt_destination = equivalence_class[destination]
-        if alt_destination is not None:
-            destination = alt_destination
-        else:
-            destination = set([destination])
-
-        fp_dsts = self._false_positives[origin]
-
-        intersect = destination & fp_dsts
-
-        if len(intersect) > 0:
-            return True
+        self._sync(equivalence_class)
+        origins = self._pairs.get(
+            self._class_id(equivalence_class, origin), {}).get(
+            self._class_id(equivalence_class, destination))
+        if not origins:
+            return False
 
-        return False
+        # Only untagged origins count
+        return any(not equivalence_class.has_tag(x) for x in origins)
 
 
 class SimRating:
@@ -142,6 +220,11 @@ class SimRating:
     def diff_lines_ratio(self):
         return self._diff_lines_ratio
 
+    def weighted(self, message_diff_weight):
+        # weight by message_diff_weight
+        return message_diff_weight * self.msg + \
+               (1 - message_diff_weight) * self.diff
+
     def __lt__(self, other):
         return self.msg + self.diff < other.msg + other.diff
 
@@ -173,30 +256,134 @@ class EvaluationResult(dict):
             else:
                 self[key] = value
 
-    def to_file(self, filename):
+    def to_file(self, filename, columnar=True):
+        """
+        Writes the result in the columnar format (see
+        ColumnarEvaluationResult), or, if columnar is not set, as pickle
+        """
         # Sort by SimRating
         for i in self.keys():
             self[i].sort(key=lambda x: x[1], reverse=True)
 
-        with open(filename, 'wb') as f:
-            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            if columnar:
+                self._to_columnar(f)
+            else:
+                pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+
+    def _to_columnar(self, f):
+        hashes = set(self.keys())
+        for candidates in self.values():
+            hashes |= {x[0] for x in candidates}
+        hashes = sorted(hashes)
+        interned = {x: i for i, x in enumerate(hashes)}
+
+        hashes = [x.encode() for x in hashes]
+        hash_offsets = np.zeros(len(hashes) + 1, dtype=np.uint64)
+        hash_offsets[1:] = np.cumsum([len(x) for x in hashes])
+        hashes = b''.join(hashes)
+
+        origs = np.array([interned[x] for x in self.keys()], dtype=np.uint32)
+        cand_offsets = np.zeros(len(origs) + 1, dtype=np.uint64)
+        cand_offsets[1:] = np.cumsum([len(x) for x in self.values()])
+
+        candidates = [x for candidates in self.values() for x in candidates]
+        cands = np.array([interned[x[0]] for x in candidates],
+                         dtype=np.uint32)
+        msg, diff, dlr = [np.array([getattr(x[1], attr) for x in candidates],
+                                   dtype=np.float32)
+                          for attr in ['msg', 'diff', 'diff_lines_ratio']]
+
+        f.write(ColumnarEvaluationResult.HEADER.pack(
+            ColumnarEvaluationResult.MAGIC, ColumnarEvaluationResult.VERSION,
+            -1 if self.is_mbox is None else int(self.is_mbox),
+            self.eval_type.value if self.eval_type else 0,
+            len(hash_offsets) - 1, len(origs), len(cands), len(hashes)))
+        for array in [hash_offsets, origs, cand_offsets, cands, msg, diff,
+                      dlr]:
+            f.write(array.tobytes())
+            # keep arrays 8-byte aligned
+            f.write(b'\0' * (-array.nbytes % 8))
+        f.write(hashes)
 
     def load_fp(self, fp_directory, must_exist):
         self.fp = FalsePositives(self.is_mbox, self.eval_type,
                                  fp_directory, must_exist)
 
+    def columns(self):
+        """
+        Returns the list of all hashes and, for each pair of original and
+        candidate, the index of the original and the candidate in that list,
+        and their message, diff and diff lines ratio as arrays
+        """
+        hashes = set(self.keys())
+        for candidates in self.values():
+            hashes |= {x[0] for x in candidates}
+        hashes = sorted(hashes)
+        interned = {x: i for i, x in enumerate(hashes)}
+
+        pairs = [(orig, cand, rating) for orig, candidates in self.items()
+                 for cand, rating in candidates]
+        origs = np.array([interned[x[0]] for x in pairs], dtype=np.int64)
+        cands = np.array([interned[x[1]] for x in pairs], dtype=np.int64)
+        msg, diff, dlr = [np.array([getattr(x[2], attr) for x in pairs],
+                                   dtype=np.float64)
+                          for attr in ['msg', 'diff', 'diff_lines_ratio']]
+
+        return hashes, origs, cands, msg, diff, dlr
+
+    @staticmethod
+    def is_columnar(filename):
+        if not os.path.isfile(filename):
+            return False
+        with open(filename, 'rb') as f:
+            magic = f.read(len(ColumnarEvaluationResult.MAGIC))
+        return magic == ColumnarEvaluationResult.MAGIC
+
     @staticmethod
     def from_file(filename, fp_directory=None, fp_must_exist=False):
+        """
+        Loads an evaluation result. Columnar results are mapped to memory and
+        returned as ColumnarEvaluationResult, pickled results are loaded as
+        EvaluationResult.
+        """
         log.info('Loading evaluation result')
         with open(filename, 'rb') as f:
-            ret = pickle.load(f)
+            if f.read(len(ColumnarEvaluationResult.MAGIC)) == \
+               ColumnarEvaluationResult.MAGIC:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                ret = ColumnarEvaluationResult.from_buffer(buf)
+            else:
+                f.seek(0)
+                ret = pickle.load(f)
         log.info('  ↪ done')
         ret.load_fp(fp_directory, fp_must_exist)
 
         return ret
 
     def interactive_rating(self, repo, clustering, thresholds,
-                           respect_commitdate, enable_pager):
+                           respect_commitdate, enable_pager,
+                           prefetch_depth=4, processes=1):
+        """
+        Rates all pairs of the result. Pairs above the autoaccept threshold
+        are accepted, pairs between the interactive and the autoaccept
+        threshold are presented to the user. prefetch_depth is the number of
+        pairs that are rendered ahead, processes the number of workers that
+        accept pairs above the autoaccept threshold.
+
+        All pairs above the autoaccept threshold are accepted before any
+        pair between the thresholds is checked. Hence, those pairs are
+        checked for relations, false positives and commit dates against the
+        classes that the user's decisions apply to. Previously, they were
+        checked against the classes at their position in the sorted result,
+        and pairs that became related later on were skipped before prompting
+        anyway. Only the false positive checks differ: a pair whose classes
+        are merged with a false positive by a later auto-accepted pair is no
+        longer presented, and a pair whose false positive is lifted by a
+        later tag is.
+        """
         already_false_positive = 0
         already_detected = 0
         auto_accepted = 0
@@ -212,11 +399,36 @@ class EvaluationResult(dict):
             if self.eval_type == EvaluationType.Upstream:
                 clustering.tag(cand)
 
-        # Convert the dictionary of evaluation results to a sorted list,
-        # sorted by its SimRating. First, get all items, but filter for
-        # relevant items with at leas one comparison result
-        sorted_er = [x for x in self.items() if len(x[1])]
-        sorted_er.sort(key=lambda x: x[1][0][1])
+        # Auto-accept pairs in bulk: the pairs above the autoaccept threshold
+        # form a graph, and its components are rated independently, in
+        # parallel if processes > 1.
+        # BatchRating imports this module, so import it lazily
+        from .BatchRating import BatchRating
+        batch = BatchRating([self], clustering, repo, respect_commitdate)
+        stats = batch.auto_accept(clustering, thresholds.autoaccept,
+                                  thresholds.diff_lines_ratio,
+                                  thresholds.message_diff_weight, processes)
+        already_detected += stats['already_detected']
+        already_false_positive += stats['already_false_positive']
+        skipped_by_commit_date += stats['skipped_by_commit_date']
+        auto_accepted += stats['auto_accepted']
+
+        # Without an interactive band, all remaining pairs are declined
+        if thresholds.interactive >= thresholds.autoaccept:
+            dlr = batch.dlr >= thresholds.diff_lines_ratio
+            skipped_by_dlr += np.count_nonzero(~dlr)
+            auto_declined += np.count_nonzero(
+                dlr & (batch.origs != batch.cands) &
+                ~batch.passing(thresholds.autoaccept,
+                               thresholds.diff_lines_ratio,
+                               thresholds.message_diff_weight))
+            sorted_er = []
+        else:
+            # Convert the dictionary of evaluation results to a sorted list,
+            # sorted by its SimRating. First, get all items, but filter for
+            # relevant items with at leas one comparison result
+            sorted_er = [x for x in self.items() if len(x[1])]
+            sorted_er.sort(key=lambda x: x[1][0][1])
 
         filtered_er = dict()
 
@@ -231,6 +443,17 @@ class EvaluationResult(dict):
                 if cand_commit_hash == orig_commit_hash:
                     continue
 
+                rating = sim_rating.weighted(thresholds.message_diff_weight)
+
+                # Auto-accepted pairs were already merged in bulk, all checks
+                # below see the final classes of the automatic stage
+                if rating >= thresholds.autoaccept:
+                    continue
+                # maybe we can automatically drop it away?
+                elif rating < thresholds.interactive:
+                    auto_declined += 1
+                    continue
+
                 # check if those two patches are already related
                 if clustering.is_related(orig_commit_hash,
                                          cand_commit_hash):
@@ -251,20 +474,6 @@ class EvaluationResult(dict):
                         skipped_by_commit_date += 1
                         continue
 
-                # weight by message_diff_weight
-                rating = thresholds.message_diff_weight * sim_rating.msg +\
-                         (1-thresholds.message_diff_weight) * sim_rating.diff
-
-                # maybe we can autoaccept the patch?
-                if rating >= thresholds.autoaccept:
-                    auto_accepted += 1
-                    accept(orig_commit_hash, cand_commit_hash)
-                    continue
-                # or even automatically drop it away?
-                elif rating < thresholds.interactive:
-                    auto_declined += 1
-                    continue
-
                 # ok, so we have a proper candidate, queue it.
                 if orig_commit_hash not in filtered_er:
                     filtered_er[orig_commit_hash] = list()
@@ -290,39 +499,38 @@ class EvaluationResult(dict):
                 clustering.optimize()
                 return
 
-        halt_save = False
-        for orig, cands in filtered_er.items():
-            if halt_save:
+        # Pairs are rendered in the background while the user rates. Pairs
+        # that became related in the meanwhile are skipped.
+        pending = [(orig, cand, rating) for orig, cands in filtered_er.items()
+                   for cand, rating in cands]
+        columns, _ = shutil.get_terminal_size()
+        render = lambda x: format_commits(repo, x[0], x[1], columns)
+        related = lambda x: clustering.is_related(x[0], x[1])
+
+        for (orig, cand, rating), text in prefetch(render, pending,
+                                                   prefetch_depth, related):
+            pager(text, enable_pager)
+            print('Rating: %3.2f' % rating)
+            print('(y)ay or (n)ay or (s)kip?  '
+                  'To abort: halt and (d)iscard, (h)alt and save')
+
+            yns = ''
+            while yns not in {'y', 'n', 's', 'd', 'h'}:
+                yns = getch()
+
+            if yns == 'y':
+                accept(orig, cand)
+                accepted += 1
+            elif yns == 'n':
+                self.fp.mark(clustering, orig, cand)
+                declined += 1
+            elif yns == 's':
+                skipped += 1
+            elif yns == 'd':
+                quit()
+            elif yns == 'h':
                 break
 
-            for cand, rating in cands:
-                # check if those two patches are already related
-                if clustering.is_related(orig, cand):
-                    continue
-
-                show_commits(repo, orig, cand, enable_pager)
-                print('Rating: %3.2f' % rating)
-                print('(y)ay or (n)ay or (s)kip?  '
-                      'To abort: halt and (d)iscard, (h)alt and save')
-
-                yns = ''
-                while yns not in {'y', 'n', 's', 'd', 'h'}:
-                    yns = getch()
-
-                if yns == 'y':
-                    accept(orig, cand)
-                    accepted += 1
-                elif yns == 'n':
-                    self.fp.mark(clustering, orig, cand)
-                    declined += 1
-                elif yns == 's':
-                    skipped += 1
-                elif yns == 'd':
-                    quit()
-                elif yns == 'h':
-                    halt_save = True
-                    break
-
         clustering.optimize()
 
         log.info('Final stats:')
@@ -331,6 +539,135 @@ class EvaluationResult(dict):
         log.info(' Skipped: %d' % skipped)
 
 
+def float32_to_float(value):
+    # The shortest decimal representation of a float32 value, e.g., 0.9
+    # instead of 0.8999999761581421, so ratings compare to thresholds as they
+    # did before they were stored
+    return float(str(value))
+
+
+class ColumnarEvaluationResult(Mapping):
+    """
+    Read-only evaluation result that is mapped to memory.
+
+    All hashes are interned. The candidates of each original are stored
+    consecutively (CSR-like: cand_offsets[i] to cand_offsets[i+1] for the
+    i-th original), together with their message, diff and diff lines ratios
+    as float32 arrays. Lists of (hash, SimRating) tuples are only created on
+    access, so the result provides the same interface as EvaluationResult.
+    """
+    MAGIC = b'PaStAEvR'
+    VERSION = 1
+    # magic, version, is_mbox (-1: unknown), eval_type (0: unknown), number
+    # of hashes, originals and candidates, length of the hash blob
+    HEADER = struct.Struct('<8sIbbxxQQQQ')
+
+    def __init__(self, is_mbox, eval_type, hash_offsets, hashes, origs,
+                 cand_offsets, cands, msg, diff, dlr):
+        self.is_mbox = is_mbox
+        self.eval_type = eval_type
+        self.hash_offsets = hash_offsets
+        self.hashes = hashes
+        self.origs = origs
+        self.cand_offsets = cand_offsets
+        self.cands = cands
+        self.msg = msg
+        self.diff = diff
+        self.dlr = dlr
+        self.fp = None
+
+        # hash of original -> row, created on demand
+        self._rows = None
+
+    @staticmethod
+    def from_buffer(buf):
+        magic, version, is_mbox, eval_type, n_hashes, n_origs, n_cands, \
+            hashes_len = ColumnarEvaluationResult.HEADER.unpack_from(buf)
+        if magic != ColumnarEvaluationResult.MAGIC or \
+           version != ColumnarEvaluationResult.VERSION:
+            raise ValueError('Invalid evaluation result')
+
+        offset = ColumnarEvaluationResult.HEADER.size
+        arrays = []
+        for dtype, count in [(np.uint64, n_hashes + 1), (np.uint32, n_origs),
+                             (np.uint64, n_origs + 1), (np.uint32, n_cands),
+                             (np.float32, n_cands), (np.float32, n_cands),
+                             (np.float32, n_cands)]:
+            array = np.frombuffer(buf, dtype, count, offset)
+            arrays.append(array)
+            offset += array.nbytes + (-array.nbytes % 8)
+        hashes = np.frombuffer(buf, np.uint8, hashes_len, offset)
+
+        hash_offsets, origs, cand_offsets, cands, msg, diff, dlr = arrays
+        return ColumnarEvaluationResult(
+            None if is_mbox < 0 else bool(is_mbox),
+            EvaluationType(eval_type) if eval_type else None, hash_offsets,
+            hashes, origs, cand_offsets, cands, msg, diff, dlr)
+
+    def get_hash(self, i):
+        return bytes(self.hashes[self.hash_offsets[i]:
+                                 self.hash_offsets[i + 1]]).decode()
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = {self.get_hash(x): row
+                          for row, x in enumerate(self.origs)}
+        return self._rows
+
+    def candidates(self, row):
+        lo = int(self.cand_offsets[row])
+        hi = int(self.cand_offsets[row + 1])
+        return [(self.get_hash(cand),
+                 SimRating(float32_to_float(msg), float32_to_float(diff),
+                           float32_to_float(dlr)))
+                for cand, msg, diff, dlr in zip(self.cands[lo:hi],
+                                                self.msg[lo:hi],
+                                                self.diff[lo:hi],
+                                                self.dlr[lo:hi])]
+
+    def __getitem__(self, key):
+        return self.candidates(self.rows[key])
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __iter__(self):
+        for orig in self.origs:
+            yield self.get_hash(orig)
+
+    def __len__(self):
+        return len(self.origs)
+
+    def columns(self):
+        """
+        See EvaluationResult.columns()
+        """
+        hashes = [self.get_hash(i) for i in range(len(self.hash_offsets) - 1)]
+        origs = np.repeat(self.origs.astype(np.int64),
+                          np.diff(self.cand_offsets.astype(np.int64)))
+
+        # Same as float32_to_float, for all ratings at once. Ratings are
+        # ratios of small numbers and repeat a lot, so only convert each
+        # distinct value once.
+        def widen(array):
+            values, inverse = np.unique(array, return_inverse=True)
+            return values.astype(str).astype(np.float64)[inverse]
+
+        msg, diff, dlr = [widen(x) for x in [self.msg, self.diff, self.dlr]]
+
+        return hashes, origs, self.cands.astype(np.int64), msg, diff, dlr
+
+    def to_evaluation_result(self):
+        retval = EvaluationResult(self.is_mbox, self.eval_type)
+        for row, orig in enumerate(self.origs):
+            retval[self.get_hash(orig)] = self.candidates(row)
+        return retval
+
+    load_fp = EvaluationResult.load_fp
+    interactive_rating = EvaluationResult.interactive_rating
+
+
 def best_string_mapping(threshold, left_list, right_list):
     """
     This function tries to find the closest mapping with the best weight of two lists of strings.
@@ -348,15 +685,31 @@ def best_string_mapping(threshold, left_list, right_list):
     As a[{0,1,2}] == b[{0,1,2}], those values will automatically be mapped. Additionally, a[2] will also be mapped to
     b[3], if the threshold is low enough (cf. 0.5).
     """
+    mapping, _ = string_similarities(threshold, left_list, right_list)
+    return set(mapping.keys())
+
+
+def string_similarities(threshold, left_list, right_list):
+    """
+    Returns the mapping of best_string_mapping as a dictionary that maps each
+    pair to its similarity, together with the highest similarity of all
+    compared pairs (None, if strings were only compared for equality).
 
+    Each string is mapped to its most similar counterpart, so the mapping of a
+    stricter threshold consists of all pairs of this mapping that pass the
+    stricter threshold.
+    """
     if threshold >= 1.0:
-        ret = set()
+        ret = dict()
         for left in left_list:
             if left in right_list:
-                ret.add((left, left))
-        return ret
+                ret[(left, left)] = 1
+        return ret, None
+
+    max_sim = 0
 
     def injective_map(ll, rl, inverse_result=False):
+        nonlocal max_sim
         ret = dict()
         for l_entry in ll:
             for r_entry in rl:
@@ -368,6 +721,8 @@ def best_string_mapping(threshold, left_list, right_list):
                 else:
                     sim = fuzz.token_sort_ratio(l_entry, r_entry) / 100
 
+                if sim > max_sim:
+                    max_sim = sim
                 if sim < threshold:
                     continue
 
@@ -377,14 +732,106 @@ def best_string_mapping(threshold, left_list, right_list):
                         continue
 
                 ret[l_entry] = r_entry, sim
-        return {(r, l) if inverse_result else (l, r) for l, (r, _) in ret.items()}
+        return {((r, l) if inverse_result else (l, r)): sim
+                for l, (r, sim) in ret.items()}
 
-    return injective_map(left_list, right_list) | injective_map(right_list, left_list, True)
+    mapping = injective_map(left_list, right_list)
+    mapping.update(injective_map(right_list, left_list, True))
+    return mapping, max_sim
 
 
-def rate_diffs(thresholds, l_diff, r_diff):
-    filename_compare = best_string_mapping(thresholds.filename, l_diff.patches.keys(), r_diff.patches.keys())
-    levenshteins = []
+def is_large_diff(thresholds, diff):
+    """
+    Returns True, if the diff falls under the large diff policy
+    """
+    return bool(thresholds.large_diff_files and
+                len(diff.affected) > thresholds.large_diff_files)
+
+
+def sample_sorted(elems, bound):
+    """
+    Deterministically picks at most bound evenly distributed elements of the
+    sorted list of elems. A bound of 0 means no limit.
+    """
+    elems = sorted(elems)
+    if bound and len(elems) > bound:
+        step = len(elems) / bound
+        elems = [elems[int(i * step)] for i in range(bound)]
+    return elems
+
+
+def bounded_file_mapping(thresholds, left_files, right_files):
+    """
+    File mapping for large diffs. Exact filename matches are cheap, so they are
+    determined first. The quadratic fuzzy mapping is only run on a bounded
+    sample of the remaining files, and the overall number of mapped file pairs
+    is limited by thresholds.large_diff_mapping.
+
+    Like string_similarities, the mapping is a dictionary of pairs and their
+    similarity.
+    """
+    bound = thresholds.large_diff_mapping
+    mapping, _ = string_similarities(1.0, left_files, right_files)
+
+    if thresholds.filename < 1.0:
+        left_rest = sample_sorted(left_files - {l for l, _ in mapping}, bound)
+        right_rest = sample_sorted(right_files - {r for _, r in mapping}, bound)
+        fuzzy, _ = string_similarities(thresholds.filename,
+                                       left_rest, right_rest)
+        mapping.update(fuzzy)
+
+    return {x: mapping[x] for x in sample_sorted(mapping, bound)}
+
+
+def similarity_flags(left, right):
+    if left == right:
+        return SIM_MAPPED | SIM_IDENTICAL
+    return SIM_MAPPED
+
+
+def is_mapped(sim, flags, threshold):
+    """
+    Returns True, if a recorded file or hunk pair is mapped at threshold, cf.
+    string_similarities
+    """
+    if threshold >= 1.0:
+        return bool(flags & SIM_IDENTICAL)
+    return bool(flags & SIM_MAPPED) and sim >= threshold
+
+
+def diff_similarities(thresholds, l_diff, r_diff, record=None):
+    """
+    Compares the files and hunks of two diffs. Returns all mapped file pairs
+    as list of tuples (similarity, flags, headings), where headings is a list
+    of their mapped hunk pairs as tuples (similarity, flags, scores). scores
+    are the similarities of the deletions and insertions of the hunk pair.
+
+    If record is a dictionary, pairs of files and hunks with identical names
+    are compared as well, even if they are not part of the mapping, and the
+    highest similarity of all compared filenames is stored in
+    record['max_file_sim']. This allows to apply any stricter filename and
+    heading thresholds afterwards, cf. rate_similarities.
+    """
+    if is_large_diff(thresholds, l_diff) or is_large_diff(thresholds, r_diff):
+        filename_compare = bounded_file_mapping(thresholds,
+                                                l_diff.patches.keys(),
+                                                r_diff.patches.keys())
+        max_file_sim = None
+        large = True
+    else:
+        filename_compare, max_file_sim = \
+            string_similarities(thresholds.filename,
+                                l_diff.patches.keys(), r_diff.patches.keys())
+        large = False
+
+    def with_identical(mapping, left, right):
+        mapping = {x: (sim, similarity_flags(*x))
+                   for x, sim in mapping.items()}
+        if record is not None:
+            for name in left & right:
+                if (name, name) not in mapping:
+                    mapping[(name, name)] = 1, SIM_IDENTICAL
+        return mapping
 
     def compare_hunks(left, right):
         # This case happens for example, if both hunks remove empty newlines
@@ -395,24 +842,59 @@ def rate_diffs(thresholds, l_diff, r_diff):
             return 100
         return fuzz.token_sort_ratio(left, right)
 
-    for l_filename, r_filename in filename_compare:
+    files = []
+    filename_compare = with_identical(filename_compare,
+                                      l_diff.patches.keys(),
+                                      r_diff.patches.keys())
+    for (l_filename, r_filename), (file_sim, file_flags) in \
+            filename_compare.items():
         l_hunks = l_diff.patches[l_filename]
         r_hunks = r_diff.patches[r_filename]
 
-        levenshtein = []
-        hunk_compare = best_string_mapping(thresholds.heading,
-                                           l_hunks.keys(), r_hunks.keys())
+        hunk_compare, _ = string_similarities(thresholds.heading,
+                                              l_hunks.keys(), r_hunks.keys())
+        hunk_compare = with_identical(hunk_compare,
+                                      l_hunks.keys(), r_hunks.keys())
 
-        for l_hunk_heading, r_hunk_heading in hunk_compare:
+        headings = []
+        for (l_hunk_heading, r_hunk_heading), (hunk_sim, hunk_flags) in \
+                hunk_compare.items():
             lhunk = l_hunks[l_hunk_heading]
             rhunk = r_hunks[r_hunk_heading]
 
+            scores = []
             if lhunk.deletions and rhunk.deletions:
-                levenshtein.append(compare_hunks(lhunk.deletions,
-                                                 rhunk.deletions))
+                scores.append(compare_hunks(lhunk.deletions,
+                                            rhunk.deletions))
             if lhunk.insertions and rhunk.insertions:
-                levenshtein.append(compare_hunks(lhunk.insertions,
-                                                 rhunk.insertions))
+                scores.append(compare_hunks(lhunk.insertions,
+                                            rhunk.insertions))
+            headings.append((hunk_sim, hunk_flags, scores))
+
+        files.append((file_sim, file_flags, headings))
+
+    if record is not None:
+        record['max_file_sim'] = max_file_sim
+        record['large'] = large
+
+    return files
+
+
+def rate_similarities(files, filename_threshold, heading_threshold):
+    """
+    Rates the file and hunk similarities of diff_similarities. Only pairs of
+    files and hunks that are mapped at the given thresholds are taken into
+    account.
+    """
+    levenshteins = []
+    for file_sim, file_flags, headings in files:
+        if not is_mapped(file_sim, file_flags, filename_threshold):
+            continue
+
+        levenshtein = []
+        for hunk_sim, hunk_flags, scores in headings:
+            if is_mapped(hunk_sim, hunk_flags, heading_threshold):
+                levenshtein += scores
 
         if levenshtein:
             levenshteins.append(mean(levenshtein))
@@ -420,33 +902,58 @@ def rate_diffs(thresholds, l_diff, r_diff):
     if not levenshteins:
         levenshteins = [0]
 
-    diff_rating = mean(levenshteins) / 100
+    return mean(levenshteins) / 100
 
-    return diff_rating
 
+def rate_diffs(thresholds, l_diff, r_diff, record=None):
+    files = diff_similarities(thresholds, l_diff, r_diff, record)
+    if record is not None:
+        record['files'] = files
 
-def evaluate_patch_pair(thresholds, lhs, rhs):
+    return rate_similarities(files, thresholds.filename, thresholds.heading)
+
+
+def evaluate_patch_pair(thresholds, lhs, rhs, record=None):
+    """
+    Rates a pair of patches. If record is a dictionary, it receives all
+    intermediate similarities of the pair, cf. EvaluationRecord.
+    """
     left_message, left_diff = lhs
     right_message, right_diff = rhs
 
     left_diff_lines = left_diff.lines
     right_diff_lines = right_diff.lines
 
+    if record is not None:
+        record['shared'] = bool(left_diff.affected & right_diff.affected)
+
     diff_lines_ratio = min(left_diff_lines, right_diff_lines) / \
                        max(left_diff_lines, right_diff_lines)
     if diff_lines_ratio < thresholds.diff_lines_ratio:
+        if record is not None:
+            # The filename similarity is still required to decide whether the
+            # pair is a candidate at stricter thresholds
+            record['shortcut'] = True
+            record['max_file_sim'] = None
+            if not (is_large_diff(thresholds, left_diff) or
+                    is_large_diff(thresholds, right_diff)):
+                _, record['max_file_sim'] = \
+                    string_similarities(thresholds.filename,
+                                        left_diff.affected,
+                                        right_diff.affected)
         return SimRating(0, 0, diff_lines_ratio)
 
     # get rating of message
     msg_rating = fuzz.token_sort_ratio(left_message, right_message) / 100
 
     # get rating of diff
-    diff_rating = rate_diffs(thresholds, left_diff, right_diff)
+    diff_rating = rate_diffs(thresholds, left_diff, right_diff, record)
 
     return SimRating(msg_rating, diff_rating, diff_lines_ratio)
 
 
-def evaluate_commit_pair(repo, thresholds, lhs_commit_hash, rhs_commit_hash):
+def evaluate_commit_pair(repo, thresholds, lhs_commit_hash, rhs_commit_hash,
+                         record=None):
     # Return identical similarity for equivalent commits
     if lhs_commit_hash == rhs_commit_hash:
         return SimRating(1, 1, 1)
@@ -454,29 +961,46 @@ def evaluate_commit_pair(repo, thresholds, lhs_commit_hash, rhs_commit_hash):
     lhs = repo[lhs_commit_hash]
     rhs = repo[rhs_commit_hash]
 
+    if record is not None:
+        record['days'] = abs((rhs.author_date - lhs.author_date).days)
+
     lhs = lhs.message, lhs.diff
     rhs = rhs.message, rhs.diff
 
-    return evaluate_patch_pair(thresholds, lhs, rhs)
+    return evaluate_patch_pair(thresholds, lhs, rhs, record)
 
 
-def _evaluate_commit_pair_helper(thresholds, lhs_commit_hash, rhs_commit_hash):
-    return evaluate_commit_pair(_tmp_repo, thresholds, lhs_commit_hash, rhs_commit_hash)
+def _evaluate_commit_pair_helper(thresholds, lhs_commit_hash, rhs_commit_hash,
+                                 record=None):
+    return evaluate_commit_pair(_tmp_repo, thresholds, lhs_commit_hash,
+                                rhs_commit_hash, record)
 
 
-def _evaluation_helper(thresholds, l_r, verbose=False):
+def _evaluation_helper(thresholds, l_r, verbose=False, large=False,
+                       record=False):
     left, right = l_r
     if verbose:
         print('Comparing 1 patch against %d patches' % len(right))
 
-    f = functools.partial(_evaluate_commit_pair_helper, thresholds, left)
-    results = list(map(f, right))
-    results = list(zip(right, results))
+    results = []
+    records = [] if record else None
+    for cand in right:
+        start = time()
+        this_record = dict() if record else None
+        rating = _evaluate_commit_pair_helper(thresholds, left, cand,
+                                              this_record)
+        # Log timings of all pairs that were handled by the large diff policy
+        if large or is_large_diff(thresholds, _tmp_repo[cand].diff):
+            log.info('  Large diff %s <-> %s took %0.2fs' %
+                     (left, cand, time() - start))
+        results.append((cand, rating))
+        if record:
+            records.append((cand, rating, this_record))
 
     # sort SimRating
     results.sort(key=lambda x: x[1], reverse=True)
 
-    return left, results
+    return left, results, records
 
 
 def preevaluate_filenames(thresholds, right_files, left_file):
@@ -490,26 +1014,223 @@ def preevaluate_filenames(thresholds, right_files, left_file):
     return left_file, candidates
 
 
-def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, parallelise=True):
+def cap_large_diff_candidates(repo, thresholds, preeval_result):
+    """
+    Large diffs touch almost everything, and so they have huge candidate lists.
+    Only keep the thresholds.large_diff_candidates candidates that share most
+    files with a large diff. This applies to both sides: a large candidate is
+    only compared against that many original patches as well.
+    """
+    cap = thresholds.large_diff_candidates
+    if not (thresholds.large_diff_files and cap):
+        return preeval_result
+
+    def ranked(hash, others):
+        affected = repo[hash].diff.affected
+        return sorted(others, key=lambda x:
+                      (-len(affected & repo[x].diff.affected), x))
+
+    capped = 0
+    for left_hash, right_hashes in preeval_result.items():
+        if len(right_hashes) <= cap or \
+           not is_large_diff(thresholds, repo[left_hash].diff):
+            continue
+
+        preeval_result[left_hash] = set(ranked(left_hash, right_hashes)[:cap])
+        capped += 1
+
+    left_hashes = dict()
+    for left_hash, right_hashes in preeval_result.items():
+        for right_hash in right_hashes:
+            left_hashes.setdefault(right_hash, set()).add(left_hash)
+
+    for right_hash, this_left_hashes in left_hashes.items():
+        if len(this_left_hashes) <= cap or \
+           not is_large_diff(thresholds, repo[right_hash].diff):
+            continue
+
+        for left_hash in ranked(right_hash, this_left_hashes)[cap:]:
+            preeval_result[left_hash].discard(right_hash)
+        capped += 1
+
+    for left_hash in [x for x, y in preeval_result.items() if not y]:
+        del preeval_result[left_hash]
+
+    log.info('Capped candidates of %d large diffs to %d candidates' %
+             (capped, cap))
+    return preeval_result
+
+
+def add_candidate(repo, thresholds, preeval_result, left_hash, right_hash):
+    """
+    Adds right_hash to the candidates of left_hash, unless the pair is
+    filtered or was already inserted the other way round
+    """
+    # no comparisons against itself
+    if left_hash == right_hash:
+        return
+
+    left = repo[left_hash]
+    right = repo[right_hash]
+    # don't compare revert patches
+    if left.is_revert != right.is_revert:
+        return
+    if thresholds.author_date_interval and \
+       abs((right.author_date - left.author_date).days) >= \
+       thresholds.author_date_interval:
+        return
+    # check if this wasn't already inserted the other way round
+    if right_hash in preeval_result and \
+       left_hash in preeval_result[right_hash]:
+        return
+    if left_hash not in preeval_result:
+        preeval_result[left_hash] = set()
+    preeval_result[left_hash].add(right_hash)
+
+
+def preevaluate_fingerprints(repo, thresholds, left_hashes, right_hashes):
+    """
+    Preevaluation based on a winnowing fingerprint index: only consider
+    patches for comparison that share at least thresholds.shared_fingerprints
+    fingerprints of their hunks. In contrast to the file overlap, this also
+    finds squashed or split patches, and it is more selective.
+    """
+    # The index of the repository covers all cached commits and mails. Only
+    # the fingerprints of patches that were not cached yet are computed.
+    index = repo.fingerprints
+    right_hashes = set(right_hashes)
+    log.info('Updating fingerprint index...')
+    for right_hash in right_hashes:
+        index.insert(repo, right_hash)
+    log.info('  ↪ done. Indexed %d patches with %d fingerprints' %
+             (len(index), len(index.postings)))
+
+    log.info('Creating preevaluation result...')
+    preeval_result = {}
+    for left_hash in left_hashes:
+        this_right_hashes = index.query(repo, left_hash,
+                                        thresholds.shared_fingerprints)
+        for right_hash in this_right_hashes & right_hashes:
+            add_candidate(repo, thresholds, preeval_result,
+                          left_hash, right_hash)
+
+    return cap_large_diff_candidates(repo, thresholds, preeval_result)
+
+
+def preevaluate_series(repo, thresholds, left_hashes, right_hashes):
+    """
+    Preevaluation for mailing lists: only compare patches of linked revisions
+    of the same patch series. Patches are inserted in series order, and each
+    patch only gets the corresponding patches of the other revisions as
+    candidates.
+    """
+    left_hashes = set(left_hashes)
+    right_hashes = set(right_hashes)
+    index = SeriesIndex.from_repo(repo, left_hashes | right_hashes)
+
+    log.info('Creating preevaluation result...')
+    preeval_result = {}
+    for lhs, rhs in index.candidates():
+        if lhs in left_hashes and rhs in right_hashes:
+            add_candidate(repo, thresholds, preeval_result, lhs, rhs)
+        elif rhs in left_hashes and lhs in right_hashes:
+            add_candidate(repo, thresholds, preeval_result, rhs, lhs)
+
+    return cap_large_diff_candidates(repo, thresholds, preeval_result)
+
+
+def preevaluate_subjects(repo, thresholds, left_hashes, right_hashes,
+                         preeval_result, autolink=False, subject_pairs=None):
+    """
+    Adds all pairs of patches with equal normalised subjects to the
+    preevaluation result. If autolink is set, pairs that have the same diff
+    digest as well are not evaluated, but are linked with a perfect rating.
+    If subject_pairs is a set, it receives all pairs that were added.
+
+    :return: EvaluationResult of the linked pairs
+    """
+    log.info('Searching for patches with equal subjects...')
+    linked = dict()
+    num_subjects = 0
+    for left_hash, right_hash, same_diff in \
+            repo.subjects.candidates(repo, left_hashes, right_hashes):
+        if autolink and same_diff:
+            add_candidate(repo, thresholds, linked, left_hash, right_hash)
+        else:
+            add_candidate(repo, thresholds, preeval_result,
+                          left_hash, right_hash)
+            if subject_pairs is not None:
+                subject_pairs.add((left_hash, right_hash))
+            num_subjects += 1
+
+    # Linked pairs must not be evaluated again
+    retval = dict()
+    for left_hash, right_hashes in linked.items():
+        for right_hash in right_hashes:
+            for lhs, rhs in [(left_hash, right_hash), (right_hash, left_hash)]:
+                if lhs in preeval_result:
+                    preeval_result[lhs].discard(rhs)
+                    if not preeval_result[lhs]:
+                        del preeval_result[lhs]
+        retval[left_hash] = [(x, SimRating(1, 1, 1)) for x in right_hashes]
+
+    log.info('  ↪ %d candidates with equal subjects, %d linked pairs' %
+             (num_subjects, sum(len(x) for x in retval.values())))
+    return retval
+
+
+def file_commit_map(repo, hashes, ret=None):
+    """
+    Maps affected files to commit hashes resp. mailing list Message-IDs. If
+    ret is given, hashes are added to that map.
+    """
+    if ret is None:
+        ret = {}
+    for hash in hashes:
+        files = repo[hash].diff.affected
+        for file in files:
+            if file not in ret:
+                ret[file] = set()
+            ret[file] |= set([hash])
+    return ret
+
+
+def file_commit_map_discard(repo, file_map, hashes):
+    """
+    Removes hashes from a map of file_commit_map
+    """
+    for hash in hashes:
+        for file in repo[hash].diff.affected:
+            if file in file_map:
+                file_map[file].discard(hash)
+                if not file_map[file]:
+                    del file_map[file]
+
+
+def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes,
+                            parallelise=True, preevaluation='files',
+                            right_files=None):
+    """
+    right_files is an optional file_commit_map of right_hashes that is kept
+    by the caller, e.g., across several evaluations against the same
+    candidates
+    """
     cpu_factor = 0.5
 
+    if preevaluation == 'winnowing':
+        return preevaluate_fingerprints(repo, thresholds,
+                                        left_hashes, right_hashes)
+    elif preevaluation == 'series':
+        return preevaluate_series(repo, thresholds, left_hashes, right_hashes)
+
     # Create two dictionaries - one for mails, one for commits that map
     # affected files to commit hashes resp. mailing list Message-IDs
-    def file_commit_map(hashes):
-        ret = {}
-        for hash in hashes:
-            files = repo[hash].diff.affected
-            for file in files:
-                if file not in ret:
-                    ret[file] = set()
-                ret[file] |= set([hash])
-        return ret
-
     log.info('Creating file maps...')
-    left_files = file_commit_map(left_hashes)
+    left_files = file_commit_map(repo, left_hashes)
     left_filenames = list(left_files.keys())
 
-    right_files = file_commit_map(right_hashes)
+    if right_files is None:
+        right_files = file_commit_map(repo, right_hashes)
     right_filenames = list(right_files.keys())
 
     preeval_result = {}
@@ -536,7 +1257,7 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
                        thresholds.author_date_interval}
             if len(this_right_hashes):
                 preeval_result[left_hash] = this_right_hashes
-        return preeval_result
+        return cap_large_diff_candidates(repo, thresholds, preeval_result)
 
     # Otherwise, take the long path...
     log.info('Mapping filenames...')
@@ -574,13 +1295,15 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
                     preeval_result[left_hash] = set()
                 preeval_result[left_hash] |= set([right_hash])
 
-    return preeval_result
+    return cap_large_diff_candidates(repo, thresholds, preeval_result)
 
 
 def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
                          original_hashes, candidate_hashes,
                          parallelise=False, verbose=False,
-                         cpu_factor=1):
+                         cpu_factor=1, preevaluation='files',
+                         subjects=False, autolink=False, record=None,
+                         candidate_files=None):
     """
     Evaluates two list of original and candidate hashes against each other
     :param repo: repository
@@ -592,6 +1315,16 @@ def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
     :param parallelise: Parallelise evaluation
     :param verbose: Verbose output
     :param cpu_factor: number of threads to be spawned is the number of CPUs*cpu_factor
+    :param preevaluation: preevaluation strategy: 'files' (file overlap),
+                          'winnowing' (shared fingerprints) or 'series'
+                          (revisions of patch series, mailboxes only)
+    :param subjects: Additionally compare patches with equal subjects
+    :param autolink: Link patches with equal subjects and diffs without
+                     evaluating them
+    :param record: EvaluationRecord that receives the intermediate
+                   similarities of all pairs
+    :param candidate_files: file_commit_map of candidate_hashes, if the caller
+                            keeps one
     :return: a dictionary with originals as keys and a list of potential candidates as value
     """
 
@@ -611,20 +1344,43 @@ def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
           % (len(original_hashes), len(candidate_hashes)))
 
     # Bind thresholds to evaluation
-    f_eval = functools.partial(_evaluation_helper, thresholds, verbose=verbose)
+    f_eval = functools.partial(_evaluation_helper, thresholds, verbose=verbose,
+                               record=record is not None)
 
     if verbose:
         log.info('Running preevaluation.')
     preeval_result = preevaluate_commit_list(repo, thresholds,
                                              original_hashes, candidate_hashes,
-                                             parallelise=parallelise)
+                                             parallelise=parallelise,
+                                             preevaluation=preevaluation,
+                                             right_files=candidate_files)
     if verbose:
         log.info('  ↪ done')
 
+    linked = dict()
+    subject_pairs = set()
+    if subjects or autolink:
+        linked = preevaluate_subjects(repo, thresholds, original_hashes,
+                                      candidate_hashes, preeval_result,
+                                      autolink, subject_pairs)
+
     original_comparisons = len(original_hashes)*len(candidate_hashes)
     preeval_comparisons = sum([len(x) for x in preeval_result.values()])
     print_reduction('Preevaluation', original_comparisons, preeval_comparisons)
 
+    # Route large diffs to a dedicated queue. They are distributed one by one,
+    # so that they can't stall a whole chunk of regular evaluations. This
+    # includes patches that have a large diff as candidate.
+    large = {x: preeval_result.pop(x) for x in list(preeval_result.keys())
+             if is_large_diff(thresholds, repo[x].diff) or
+             any(is_large_diff(thresholds, repo[y].diff)
+                 for y in preeval_result[x])}
+    if large:
+        log.info('Routing %d large diffs to a dedicated queue' % len(large))
+    f_large = functools.partial(_evaluation_helper, thresholds,
+                                verbose=verbose, large=True,
+                                record=record is not None)
+
     global _tmp_repo
     _tmp_repo = repo
 
@@ -632,14 +1388,30 @@ def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
     if parallelise:
         p = Pool(processes=processes, maxtasksperchild=1)
         result = p.map(f_eval, preeval_result.items(), chunksize=50)
+        result += p.map(f_large, large.items(), chunksize=1)
         p.close()
         p.join()
     else:
         result = list(map(f_eval, preeval_result.items()))
+        result += list(map(f_large, large.items()))
 
     _tmp_repo = None
 
-    for orig, evaluation in result:
+    if record is not None:
+        original_hashes = set(original_hashes)
+        candidate_hashes = set(candidate_hashes)
+
+    for orig, evaluation, records in result:
         retval[orig] = evaluation
+        if record is not None:
+            for cand, rating, this_record in records:
+                record.add(orig, cand, rating, this_record,
+                           subject=(orig, cand) in subject_pairs or
+                                   (cand, orig) in subject_pairs,
+                           symmetric=cand in original_hashes and
+                                     orig in candidate_hashes)
+    retval.merge(linked)
+    if record is not None:
+        record.add_fixed(linked)
 
     return retval
@@ -17,26 +17,55 @@ import quopri
 import re
 
 from email.charset import CHARSETS
+from email.parser import BytesHeaderParser
 from logging import getLogger
+from multiprocessing import Pool, cpu_count
 
+from .MboxIndex import MboxIndex, date_str_to_int, date_to_int, file_stat
+from .MboxPack import MailPack
 from .MessageDiff import MessageDiff
+from .PublicInbox import PublicInbox
 
 log = getLogger(__name__[-15:])
 
 MAIL_FROM_REGEX = re.compile(r'(.*) <(.*)>')
 PATCH_SUBJECT_REGEX = re.compile(r'\[.*\]:? ?(.*)')
+SUBJECT_TAG_REGEX = re.compile(r'\[([^\]]*)\]')
+SERIES_VERSION_REGEX = re.compile(r'\bv(\d+)\b', re.IGNORECASE)
+SERIES_NUMBER_REGEX = re.compile(r'\b(\d+)/(\d+)\b')
+MESSAGE_ID_REGEX = re.compile(r'<[^>]+>')
+
+# Byte patterns for the fast path of the mail parser. They are matched against
+# the raw mail, so no email.message tree has to be built.
+MAIL_HEADER_END_REGEX = re.compile(rb'\n\r?\n')
+MAIL_DIFF_BOUNDARY_REGEX = re.compile(rb'^(?:diff |--- a/)', re.MULTILINE)
+FAST_PATH_ENCODINGS = {'7bit', '8bit'}
+
+# We need this global variable for parallel validation of mails
+_tmp_mbox = None
 
 
 class PatchMail(MessageDiff):
-    def __init__(self, filename):
-        with open(filename, 'rb') as f:
-            mail = email.message_from_binary_file(f)
+    def __init__(self, raw):
+        """
+        :param raw: raw mail, any bytes-like object (see Mbox.__getitem__)
+        """
+        mail, content = parse_mail(raw)
 
         # Simply name it commit_hash, otherwise we would have to refactor
         # tons of code.
         self.commit_hash = mail['Message-ID']
         self.mail_subject = mail['Subject']
 
+        # Threading and series information. Series are told apart by their
+        # thread, and by the version and patch number in the subject, e.g.,
+        # '[PATCH v3 2/7]'.
+        self.in_reply_to = next(iter(parse_message_ids(mail['In-Reply-To'])),
+                                None)
+        self.references = parse_message_ids(mail['References'])
+        self.series_version, self.series_number, self.series_total = \
+            parse_series_tag(self.mail_subject)
+
         # we need timezone aware datetimes due to the fact, that most of all
         # emails contain timezone aware timestamps. There's an issue with
         # timezone unaware timestamps: they can't be compared to timezone aware
@@ -57,19 +86,7 @@ class PatchMail(MessageDiff):
         if date.tzinfo is None:
             date = date.replace(tzinfo=datetime.timezone.utc)
 
-        payload = mail.get_payload()
-
-        # Check encoding and decode
-        cte = mail['Content-Transfer-Encoding']
-        if cte == 'QUOTED-PRINTABLE':
-            charset = mail.get_content_charset()
-            if charset not in CHARSETS:
-                charset = 'ascii'
-            payload = quopri.decodestring(payload)
-            payload = payload.decode(charset, errors='ignore')
-
-        # MAY RAISE AN ERROR, FORBID RETURN NULL
-        msg, annotation, diff = parse_payload(payload)
+        msg, annotation, diff = content
 
         # reconstruct commit message
         subject = self.mail_subject
@@ -95,6 +112,47 @@ class PatchMail(MessageDiff):
         return super(PatchMail, self).format_message(custom)
 
 
+def parse_message_ids(header):
+    if not header:
+        return []
+    return MESSAGE_ID_REGEX.findall(str(header))
+
+
+def parse_series_tag(subject):
+    """
+    Parses the version and the patch number of the tag of a patch subject.
+    '[PATCH v3 2/7] foo' returns (3, 2, 7). Unversioned patches are version
+    1, and patches that are not part of a series return None as number and
+    total.
+    """
+    version = 1
+    number = total = None
+
+    match = SUBJECT_TAG_REGEX.match(str(subject or '').lstrip())
+    if match:
+        tag = match.group(1)
+        version_match = SERIES_VERSION_REGEX.search(tag)
+        if version_match:
+            version = int(version_match.group(1))
+        number_match = SERIES_NUMBER_REGEX.search(tag)
+        if number_match:
+            number = int(number_match.group(1))
+            total = int(number_match.group(2))
+
+    return version, number, total
+
+
+def normalize_subject(subject):
+    """
+    Strips the patch tag of a subject, and normalises case and whitespaces
+    """
+    subject = str(subject or '')
+    match = PATCH_SUBJECT_REGEX.match(subject)
+    if match:
+        subject = match.group(1)
+    return ' '.join(subject.casefold().split())
+
+
 def parse_single_message(mail):
     # Before using splitlines(), we have to replace ASCII \f by sth. else, like
     # a whitespace. Otherwise weird things happen.
@@ -128,6 +186,133 @@ def parse_single_message(mail):
     return None
 
 
+def split_message(lines):
+    """
+    Splits the lines preceding the diff into the message and the (optional)
+    annotation below the '---' line
+    """
+    message = []
+    annotation = None
+
+    for line in lines:
+        if annotation is None and line.startswith('---'):
+            annotation = list()
+            # Skip this line, we're not interested in the --- line.
+            continue
+
+        if annotation is not None:
+            annotation.append(line)
+        else:
+            message.append(line)
+
+    return message, annotation
+
+
+def validate_mail(buf):
+    """
+    Cheap check if a raw mail is a patch: only the headers are parsed, and the
+    body is scanned for a diff boundary, but nothing is decoded.
+
+    This is a necessary condition for PatchMail to succeed. Mails that pass
+    may still turn out to be invalid when they are fully parsed.
+    """
+    header_end = MAIL_HEADER_END_REGEX.search(buf)
+    if not header_end:
+        return False
+
+    headers = BytesHeaderParser().parsebytes(
+        bytes(buf[0:header_end.start() + 1]))
+    if not (headers['Message-ID'] and headers['Subject'] and headers['From']):
+        return False
+
+    return MAIL_DIFF_BOUNDARY_REGEX.search(buf, header_end.end()) is not None
+
+
+def _validate_mail_subst(message_id):
+    try:
+        return message_id, validate_mail(_tmp_mbox[message_id])
+    except Exception as e:
+        log.warning('Unable to validate mail %s: %s' % (message_id, str(e)))
+        return message_id, False
+
+
+def decode_lines(buf, charset):
+    try:
+        buf = str(buf, charset, errors='replace')
+    except LookupError:
+        buf = str(buf, 'ascii', errors='replace')
+
+    # See parse_single_message
+    return buf.replace('\f', ' ').splitlines()
+
+
+def parse_mail_fast(buf):
+    """
+    Fast path for plain-text patch mails. buf may be any bytes-like object
+    (bytes, mmap, memoryview). Headers and the diff boundary are located by
+    their byte offsets, and only the body slices are decoded.
+
+    Returns None if the mail must be parsed by the email module, e.g., if it is
+    a multipart or an encoded message.
+    """
+    header_end = MAIL_HEADER_END_REGEX.search(buf)
+    if not header_end:
+        return None
+
+    mail = BytesHeaderParser().parsebytes(bytes(buf[0:header_end.start() + 1]))
+    if mail.get_content_maintype() != 'text':
+        return None
+
+    cte = mail['Content-Transfer-Encoding']
+    if cte is not None and cte.strip().lower() not in FAST_PATH_ENCODINGS:
+        return None
+
+    body = header_end.end()
+    boundary = MAIL_DIFF_BOUNDARY_REGEX.search(buf, body)
+    if not boundary:
+        raise TypeError('Unable to split mail to msg and diff')
+    boundary = boundary.start()
+
+    # Non-ASCII characters are decoded the same way as
+    # email.message.Message.get_payload() would do it
+    charset = mail.get_content_charset('ascii')
+    msg, annotation = split_message(decode_lines(buf[body:boundary], charset))
+    diff = decode_lines(buf[boundary:len(buf)], charset)
+
+    strip_trailing_newlines(msg)
+    strip_trailing_newlines(annotation)
+
+    return mail, (msg, annotation, diff)
+
+
+def parse_mail_slow(buf):
+    mail = email.message_from_bytes(bytes(buf))
+    payload = mail.get_payload()
+
+    # Check encoding and decode
+    cte = mail['Content-Transfer-Encoding']
+    if cte == 'QUOTED-PRINTABLE':
+        charset = mail.get_content_charset()
+        if charset not in CHARSETS:
+            charset = 'ascii'
+        payload = quopri.decodestring(payload)
+        payload = payload.decode(charset, errors='ignore')
+
+    # MAY RAISE AN ERROR, FORBID RETURN NULL
+    return mail, parse_payload(payload)
+
+
+def parse_mail(buf):
+    """
+    Parses a raw mail and returns its headers as well as the tuple
+    (message, annotation, diff).
+    """
+    retval = parse_mail_fast(buf)
+    if retval is None:
+        retval = parse_mail_slow(buf)
+    return retval
+
+
 def parse_list(payload):
     if len(payload) == 1:
         retval = parse_single_message(payload[0].get_payload())
@@ -150,11 +335,12 @@ def parse_list(payload):
     return None
 
 
-def parse_payload(payload):
-    def strip_trailing_newlines(string):
-        if string is not None and len(string) and string[-1] == '':
-            string.pop()
+def strip_trailing_newlines(string):
+    if string is not None and len(string) and string[-1] == '':
+        string.pop()
+
 
+def parse_payload(payload):
     if isinstance(payload, list):
         retval = parse_list(payload)
     elif isinstance(payload, str):
@@ -174,77 +360,263 @@ def parse_payload(payload):
     return msg, annotation, diff
 
 
+def is_terminated(filename):
+    # Checks if the last line of a non-empty file is complete
+    with open(filename, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
 class Mbox:
     def __init__(self, d_mbox):
         self.d_mbox = d_mbox
         self.f_mbox_lists = os.path.join(d_mbox, 'lists')
         self.f_mbox_index = os.path.join(d_mbox, 'index')
         self.f_mbox_invalid = os.path.join(d_mbox, 'invalid')
+        self.f_mbox_index_bin = os.path.join(d_mbox, 'index.bin')
+        self.f_mbox_journal = os.path.join(d_mbox, 'invalid.journal')
+        self.f_mbox_validated = os.path.join(d_mbox, 'validated')
+
+        if not os.path.isfile(self.f_mbox_index):
+            raise FileNotFoundError(self.f_mbox_index)
+
+        # packs and public-inbox repositories are opened on demand
+        self.packs = dict()
+        self.public_inbox = PublicInbox(d_mbox)
+        # Mails that were imported after the binary index was built:
+        # Message-ID -> (date_str, md5, lists)
+        self.recent = dict()
+        # Lists of indexed mails that were imported after the binary index
+        # was built: Message-ID -> lists
+        self.recent_lists = dict()
 
         log.info('Loading Mailbox')
-        lists = dict()
-        for message_id, list_name in Mbox._load_file(self.f_mbox_lists):
-            if message_id not in lists:
-                lists[message_id] = set()
-            lists[message_id].add(list_name)
-        log.info('  ↪ loaded mail-to-list mappings: %s mappings' % len(lists))
-
-        self.index = Mbox._load_index(self.f_mbox_index, lists)
-        log.info('  ↪ loaded mail index: found %d mails', len(self.index))
-        self.invalid = Mbox._load_index(self.f_mbox_invalid, lists, False)
+        self.index, entries, lists = \
+            MboxIndex.load(self.f_mbox_index_bin, self.f_mbox_index,
+                           self.f_mbox_invalid, self.f_mbox_lists)
+        for date_str, message_id, md5 in entries:
+            self._add_recent(date_str, message_id, md5)
+        for message_id, listname in lists:
+            self._add_list(message_id, listname)
+        if entries or lists:
+            log.info('  ↪ loaded %d appended mails and %d list mappings' %
+                     (len(entries), len(lists)))
+        journal = self._merge(self.f_mbox_journal, MboxIndex.FLAG_INVALID)
+        if journal:
+            log.info('  ↪ merged %d invalidations from journal' % journal)
+        self._merge(self.f_mbox_validated, MboxIndex.FLAG_VALIDATED)
+        num_invalid = self.index.num_flagged(MboxIndex.FLAG_INVALID)
+        log.info('  ↪ loaded mail index: found %d mails',
+                 len(self.index) - num_invalid)
         log.info('  ↪ loaded invalid mail index: found %d invalid mails'
-                 % len(self.invalid))
-
-    @staticmethod
-    def _load_index(filename, lists, must_exist=True):
-        content = Mbox._load_file(filename, must_exist)
-        return {x[1]: (datetime.datetime.strptime(x[0], "%Y/%m/%d"),
-                       x[0], x[2], lists[x[1]]) for x in content}
+                 % num_invalid)
 
-    @staticmethod
-    def _load_file(filename, must_exist=True):
-        if not os.path.isfile(filename) and must_exist is False:
-            return []
+    def _merge(self, filename, flag):
+        """
+        Sets flag for all Message-IDs that are listed in filename
+        """
+        if not os.path.isfile(filename):
+            return 0
 
         with open(filename) as f:
-            f = f.read().split('\n')
-            # last element is empty
-            f.pop()
-        f = [tuple(x.split(' ')) for x in f]
-
-        return f
+            message_ids = f.read().split('\n')
+
+        # The last line might be incomplete, if an update got interrupted. It
+        # doesn't match any Message-ID and is ignored.
+        merged = 0
+        for message_id in message_ids:
+            row = self.index.find(message_id) if message_id else None
+            if row is not None:
+                self.index.set_flag(row, flag)
+                merged += 1
+            elif message_id in self.recent and flag & MboxIndex.FLAG_INVALID:
+                del self.recent[message_id]
+                merged += 1
+
+        return merged
+
+    def _flag(self, filename, message_ids, flag):
+        lines = []
+        for message_id in message_ids:
+            row = self.index.find(message_id)
+            if row is not None:
+                self.index.set_flag(row, flag)
+                lines.append(message_id + '\n')
+            elif message_id in self.recent:
+                # Recent mails are flagged once the index is reloaded
+                if flag & MboxIndex.FLAG_INVALID:
+                    del self.recent[message_id]
+                lines.append(message_id + '\n')
+
+        if not lines:
+            return
+
+        with open(filename, 'a') as f:
+            # Terminate an incomplete last line of an interrupted run
+            if f.tell() and not is_terminated(filename):
+                lines.insert(0, '\n')
+            f.write(''.join(lines))
+
+    def _find_valid(self, message_id):
+        row = self.index.find(message_id)
+        if row is None or not self.index.is_valid(row):
+            raise KeyError(message_id)
+        return row
+
+    def _get_pack(self, year, month):
+        key = year, month
+        if key not in self.packs:
+            f_pack = MailPack.filename(self.d_mbox, year, month)
+            self.packs[key] = MailPack(f_pack) if os.path.isfile(f_pack) \
+                              else None
+        return self.packs[key]
 
     def __getitem__(self, message_id):
-        _, date_str, md5, _ = self.index[message_id]
-        return os.path.join(self.d_mbox, date_str, md5)
+        """
+        Returns the raw mail as bytes-like object. Packed mails are returned
+        as memoryview of their pack, mails of public-inboxes are read from
+        their git blob.
+        """
+        if message_id in self.recent:
+            date_str, md5, _ = self.recent[message_id]
+        else:
+            row = self._find_valid(message_id)
+            date_str = self.index.get_date_str(row)
+            md5 = self.index.get_md5(row)
+
+        year, month, _ = date_str.split('/')
+        pack = self._get_pack(year, month)
+        if pack and md5 in pack:
+            return pack[md5]
+
+        if md5 in self.public_inbox:
+            return self.public_inbox[md5]
+
+        with open(os.path.join(self.d_mbox, date_str, md5), 'rb') as f:
+            return f.read()
 
     def __contains__(self, item):
-        return item in self.index
+        if item in self.recent:
+            return True
+        row = self.index.find(item)
+        return row is not None and self.index.is_valid(row)
 
     def message_ids(self, time_window=None):
         if time_window:
-            return [x[0] for x in self.index.items()
-                    if time_window[0] <= x[1][0] <= time_window[1]]
+            rows = self.index.rows(*time_window)
         else:
-            return self.index.keys()
+            rows = range(len(self.index))
+
+        retval = [self.index.get_message_id(x) for x in rows
+                  if self.index.is_valid(x)]
+
+        for message_id, (date_str, _, _) in self.recent.items():
+            if time_window:
+                date = date_str_to_int(date_str)
+                mindate, maxdate = time_window
+                if (mindate and date < date_to_int(mindate)) or \
+                   (maxdate and date > date_to_int(maxdate)):
+                    continue
+            retval.append(message_id)
+
+        return retval
 
     def get_lists(self, message_id):
-        return self.index[message_id][3]
+        if message_id in self.recent:
+            return set(self.recent[message_id][2])
+        return self.index.get_lists(self._find_valid(message_id)) | \
+               self.recent_lists.get(message_id, set())
+
+    def _add_recent(self, date_str, message_id, md5):
+        if self.index.find(message_id) is None and \
+           message_id not in self.recent:
+            self.recent[message_id] = date_str, md5, set()
+
+    def _add_list(self, message_id, listname):
+        if message_id in self.recent:
+            self.recent[message_id][2].add(listname)
+        elif self.index.find(message_id) is not None:
+            self.recent_lists.setdefault(message_id, set()).add(listname)
+
+    def add_mails(self, mails, listname):
+        """
+        Makes mails that were imported while the mailbox is loaded available
+        without reloading the index.
+
+        :param mails: list of tuples (date_str, message_id, md5)
+        """
+        for date_str, message_id, md5 in mails:
+            self._add_recent(date_str, message_id, md5)
+            self._add_list(message_id, listname)
 
     def invalidate(self, invalid):
-        def write_index(filename, foo):
-            with open(filename, 'w') as f:
-                ret = ['%s %s %s' % (x[1][1], x[0], x[1][2]) for x in foo]
-                ret = '\n'.join(ret) + '\n'
-                f.write(ret)
-
-        for message_id in invalid:
-            self.invalid[message_id] = self.index.pop(message_id)
-
-        invalid = sorted(self.invalid.items())
-        valid = sorted(self.index.items())
-
-        if len(valid):
-            write_index(self.f_mbox_index, valid)
-        if len(invalid):
-            write_index(self.f_mbox_invalid, invalid)
+        """
+        Marks mails as invalid. Invalidations are appended to a journal that is
+        merged when loading the mailbox, and compact() writes them back to the
+        index.
+        """
+        self._flag(self.f_mbox_journal, invalid, MboxIndex.FLAG_INVALID)
+
+    def validate(self, message_ids, parallelise=True, cpu_factor=1):
+        """
+        Validates mails with validate_mail(). Verdicts are recorded: invalid
+        mails are invalidated, and valid mails are appended to the validated
+        file, so they are not checked again.
+
+        :return: set of valid mails, set of invalid mails
+        """
+        # Recent mails can't be flagged before the index is rebuilt, they are
+        # always validated
+        message_ids = set(message_ids)
+        worklist = {x for x in message_ids if x in self.recent or
+                    not self.index.is_validated(self._find_valid(x))}
+        valid = message_ids - worklist
+        log.info('Validating %d/%d mails' % (len(worklist), len(message_ids)))
+        if not worklist:
+            return valid, set()
+
+        num_cpus = int(cpu_factor * cpu_count())
+        global _tmp_mbox
+        _tmp_mbox = self
+        if parallelise and num_cpus > 1:
+            p = Pool(num_cpus)
+            result = p.map(_validate_mail_subst, worklist, chunksize=1000)
+            p.close()
+            p.join()
+        else:
+            result = list(map(_validate_mail_subst, worklist))
+        _tmp_mbox = None
+
+        invalid = {x for x, verdict in result if not verdict}
+        validated = worklist - invalid
+
+        self.invalidate(invalid)
+        self._flag(self.f_mbox_validated, validated, MboxIndex.FLAG_VALIDATED)
+        log.info('  ↪ done. %d invalid mails' % len(invalid))
+
+        return valid | validated, invalid
+
+    def compact(self):
+        """
+        Rewrites the index files, including all journaled invalidations, and
+        drops the journal. All files are replaced atomically, and the journal
+        is removed last, so interrupting a compaction is harmless.
+        """
+        # Rebuild the index from the text files, so that it contains recent
+        # mails as well
+        if self.recent or self.recent_lists:
+            self.index = MboxIndex.from_text(self.f_mbox_index,
+                                             self.f_mbox_invalid,
+                                             self.f_mbox_lists)
+            self.recent = dict()
+            self.recent_lists = dict()
+            self._merge(self.f_mbox_journal, MboxIndex.FLAG_INVALID)
+            self._merge(self.f_mbox_validated, MboxIndex.FLAG_VALIDATED)
+
+        self.index.to_text(self.f_mbox_index, self.f_mbox_invalid)
+        self.index.to_file(self.f_mbox_index_bin,
+                           [file_stat(x) for x in [self.f_mbox_index,
+                                                   self.f_mbox_invalid,
+                                                   self.f_mbox_lists]])
+        if os.path.isfile(self.f_mbox_journal):
+            os.remove(self.f_mbox_journal)
@@ -0,0 +1,411 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import email
+import functools
+import hashlib
+import mailbox
+import os
+import pygit2
+import sqlite3
+
+from email.parser import BytesHeaderParser
+from logging import getLogger
+from multiprocessing import Pool, cpu_count
+from time import time
+
+from .Mbox import MAIL_HEADER_END_REGEX, is_terminated
+from .PublicInbox import PublicInbox
+
+log = getLogger(__name__[-15:])
+
+_epochs = dict()
+
+
+def parse_mail_date(headers, header):
+    """
+    Returns the date of a mail as 'YYYY/MM/DD' in local time, or None if the
+    header can't be parsed
+    """
+    try:
+        date = email.utils.parsedate_to_datetime(headers[header])
+    except:
+        return None
+
+    if date.year < 1970:
+        return None
+
+    # Like date(1), convert timezone aware dates to local time
+    if date.tzinfo is not None:
+        date = date.astimezone()
+
+    return date.strftime('%Y/%m/%d')
+
+
+def parse_mail_location(raw):
+    """
+    Parses the headers of a raw mail only once and determines its location
+    inside the mailbox
+
+    :return: tuple (date_str, message_id, md5)
+    """
+    header_end = MAIL_HEADER_END_REGEX.search(raw)
+    if header_end:
+        raw = raw[0:header_end.start() + 1]
+    headers = BytesHeaderParser().parsebytes(raw)
+
+    message_id = headers['Message-ID']
+    if not message_id:
+        raise ValueError('Unable to parse Message ID')
+    # Message-IDs are space separated in the index. Folded headers may
+    # contain whitespaces.
+    message_id = ''.join(str(message_id).split())
+    try:
+        md5 = hashlib.md5(message_id.encode('ascii')).hexdigest()
+    except UnicodeEncodeError:
+        raise ValueError('Invalid Message ID: %s' % message_id)
+
+    # Try to get a valid mail date, and fall back to the NNTP date
+    date_str = parse_mail_date(headers, 'Date') or \
+               parse_mail_date(headers, 'NNTP-Posting-Date')
+    if date_str is None:
+        raise ValueError('Unable to parse date of %s' % message_id)
+
+    return date_str, message_id, md5
+
+
+def _import_mail(d_mbox, digests, mail):
+    """
+    Sorts one single mail into the mailbox. mail is either the raw mail or
+    the name of a file that contains the mail.
+    """
+    try:
+        if isinstance(mail, str):
+            with open(mail, 'rb') as f:
+                raw = f.read()
+        else:
+            raw = mail
+
+        date_str, message_id, md5 = parse_mail_location(raw)
+
+        # Known mails may already be packed. Don't write them again.
+        if digests.has_digest(md5):
+            return date_str, message_id, md5
+
+        d_dst = os.path.join(d_mbox, date_str)
+        f_dst = os.path.join(d_dst, md5)
+        os.makedirs(d_dst, exist_ok=True)
+        if not os.path.isfile(f_dst):
+            with open(f_dst, 'wb') as f:
+                f.write(raw)
+    except Exception as e:
+        log.warning('Unable to import mail: %s' % str(e))
+        return None
+
+    return date_str, message_id, md5
+
+
+def _import_chunk(d_mbox, mails):
+    # SQLite connections must not be shared across fork(). Workers open
+    # their own connection for each chunk of mails.
+    digests = MailDigests(d_mbox)
+    try:
+        return [_import_mail(d_mbox, digests, x) for x in mails]
+    finally:
+        digests.close()
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _import_blob(location):
+    """
+    Determines the location of a mail that is stored as blob inside an epoch
+    repository of a public-inbox. The mail is not copied to the mailbox.
+    """
+    path, oid = location
+    try:
+        if path not in _epochs:
+            _epochs[path] = pygit2.Repository(path)
+        raw = _epochs[path][oid].data
+        return parse_mail_location(raw) + location
+    except Exception as e:
+        log.warning('Unable to import mail %s: %s' % (oid, str(e)))
+        return None
+
+
+def iter_mails(source):
+    """
+    Yields the raw mails of a Unix mbox file, or the filenames of all mails in
+    a directory (e.g., a Maildir)
+    """
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for file in files:
+                yield os.path.join(root, file)
+    else:
+        mbox = mailbox.mbox(source, create=False)
+        for key in mbox.iterkeys():
+            yield mbox.get_bytes(key)
+        mbox.close()
+
+
+class MailDigests:
+    """
+    Persistent index of the digests of all known mails (valid as well as
+    invalid ones) and of all known mail-to-list mappings. Duplicate checks
+    during imports are index lookups instead of scans of the text files.
+
+    The index is a SQLite database, so updates are atomic: they become
+    visible on commit() only.
+    """
+    FILENAME = 'digests.db'
+
+    def __init__(self, d_mbox):
+        filename = os.path.join(d_mbox, MailDigests.FILENAME)
+        bootstrap = not os.path.isfile(filename)
+
+        self._db = sqlite3.connect(filename)
+        self._db.execute('CREATE TABLE IF NOT EXISTS digests '
+                         '(md5 TEXT PRIMARY KEY) WITHOUT ROWID')
+        self._db.execute('CREATE TABLE IF NOT EXISTS lists '
+                         '(message_id TEXT, list TEXT, '
+                         'PRIMARY KEY (message_id, list)) WITHOUT ROWID')
+
+        if bootstrap:
+            self._bootstrap(d_mbox)
+
+    def _bootstrap(self, d_mbox):
+        log.info('Creating digest index from existing mailbox')
+        for name in ['index', 'invalid']:
+            entries = load_lines(os.path.join(d_mbox, name))
+            self.add_digests([x.split(' ')[2] for x in entries])
+        lists = load_lines(os.path.join(d_mbox, 'lists'))
+        self.add_lists([tuple(x.split(' ')) for x in lists])
+        self.commit()
+
+    def has_digest(self, md5):
+        return self._db.execute('SELECT 1 FROM digests WHERE md5 = ?',
+                                (md5,)).fetchone() is not None
+
+    def has_list(self, message_id, listname):
+        return self._db.execute('SELECT 1 FROM lists '
+                                'WHERE message_id = ? AND list = ?',
+                                (message_id, listname)).fetchone() is not None
+
+    def add_digests(self, digests):
+        self._db.executemany('INSERT OR IGNORE INTO digests VALUES (?)',
+                             ((x,) for x in digests))
+
+    def add_lists(self, lists):
+        self._db.executemany('INSERT OR IGNORE INTO lists VALUES (?, ?)',
+                             lists)
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def load_lines(filename):
+    if not os.path.isfile(filename):
+        return set()
+    with open(filename) as f:
+        return set(filter(None, f.read().split('\n')))
+
+
+def append_lines(filename, lines):
+    # Append all lines with one single write. Only new lines are appended
+    # (see MailDigests), loading the mailbox sorts them.
+    if not lines:
+        return
+
+    with open(filename, 'a') as f:
+        buf = ''.join(x + '\n' for x in sorted(lines))
+        # Terminate an incomplete last line of an interrupted import
+        if f.tell() and not is_terminated(filename):
+            buf = '\n' + buf
+        f.write(buf)
+
+
+def _prepare_mailbox(d_mbox):
+    os.makedirs(d_mbox, exist_ok=True)
+    for name in ['lists', 'index', 'invalid']:
+        open(os.path.join(d_mbox, name), 'a').close()
+
+
+def _collect_results(results, listname, digests):
+    """
+    Collects the locations of imported mails, and sorts out those mails and
+    mail-to-list mappings that are already known.
+
+    :return: number of processed mails, number of failed mails, dictionary
+             md5 -> result of all new mails, set of new list mappings
+    """
+    processed = failed = 0
+    new_index = dict()
+    new_lists = set()
+
+    for result in results:
+        processed += 1
+        if result is None:
+            failed += 1
+            continue
+
+        _, message_id, md5 = result[0:3]
+        if not digests.has_list(message_id, listname):
+            new_lists.add((message_id, listname))
+        if md5 not in new_index and not digests.has_digest(md5):
+            new_index[md5] = result
+
+    return processed, failed, new_index, new_lists
+
+
+def _update_mailbox(d_mbox, digests, new_index, new_lists):
+    append_lines(os.path.join(d_mbox, 'lists'),
+                 {'%s %s' % x for x in new_lists})
+    append_lines(os.path.join(d_mbox, 'index'),
+                 {'%s %s %s' % x[0:3] for x in new_index.values()})
+
+    # Record the new digests only after the mailbox files were updated. If
+    # we get interrupted in between, the next import simply catches up.
+    digests.add_lists(new_lists)
+    digests.add_digests(new_index.keys())
+    digests.commit()
+
+
+def _log_results(start, processed, failed, new_index, new_lists):
+    duration = time() - start
+    log.info('  ↪ done. Processed %d mails in %0.2fs (%0.2f mails/s)' %
+             (processed, duration, processed / duration if duration else 0))
+    log.info('  ↪ %d new mails, %d new list mappings, %d failed' %
+             (len(new_index), len(new_lists), failed))
+
+
+def import_mails(d_mbox, listname, source, cpu_factor=1.0):
+    """
+    Imports all mails of a Unix mbox file or a Maildir to the mailbox d_mbox.
+
+    Mails are sorted to d_mbox/YYYY/MM/DD/md5(Message-ID). Only mails and
+    mail-to-list mappings that are not yet known are appended to the index
+    and lists files, each with one single write.
+
+    :return: number of new mails, number of mails that failed
+    """
+    _prepare_mailbox(d_mbox)
+    # Create the digest index before forking, but don't keep it open
+    MailDigests(d_mbox).close()
+
+    processes = max(1, int(cpu_count() * cpu_factor))
+    log.info('Importing mails from %s with %d processes' % (source, processes))
+    start = time()
+
+    p = Pool(processes)
+    digests = MailDigests(d_mbox)
+    chunks = p.imap_unordered(functools.partial(_import_chunk, d_mbox),
+                              iter_chunks(iter_mails(source), 100))
+    processed, failed, new_index, new_lists = _collect_results(
+        (x for chunk in chunks for x in chunk), listname, digests)
+    p.close()
+    p.join()
+
+    _update_mailbox(d_mbox, digests, new_index, new_lists)
+    digests.close()
+
+    _log_results(start, processed, failed, new_index, new_lists)
+
+    return len(new_index), failed
+
+
+def import_mail_batch(d_mbox, listname, mails):
+    """
+    Imports a few mails in-process, e.g., mails that were just delivered.
+    mails is a list of raw mails or filenames.
+
+    :return: list of tuples (date_str, message_id, md5) of new mails,
+             number of mails that failed
+    """
+    _prepare_mailbox(d_mbox)
+    digests = MailDigests(d_mbox)
+
+    _, failed, new_index, new_lists = _collect_results(
+        (_import_mail(d_mbox, digests, x) for x in mails), listname, digests)
+
+    _update_mailbox(d_mbox, digests, new_index, new_lists)
+    digests.close()
+
+    return [x[0:3] for x in new_index.values()], failed
+
+
+def import_public_inbox(d_mbox, listname, inbox, cpu_factor=1.0):
+    """
+    Imports a public-inbox (v2) archive to the mailbox d_mbox. Mails are read
+    from the blobs of the epoch repositories, and are not copied.
+
+    Only commits that were added since the last import of an epoch are
+    walked. The tips of the epochs are recorded after the mailbox was
+    updated, so an interrupted import is simply repeated.
+
+    :return: number of new mails, number of mails that failed
+    """
+    _prepare_mailbox(d_mbox)
+    # Create the digest index before forking, but don't keep it open
+    MailDigests(d_mbox).close()
+    store = PublicInbox(d_mbox)
+
+    epochs = PublicInbox.find_epochs(inbox)
+    tips = dict()
+
+    def locations():
+        for path in epochs:
+            epoch = store.epoch_number(path)
+            tip, blobs = PublicInbox.new_mails(path, store.epochs[epoch][1])
+            log.info('  ↪ scanning epoch %s' % path)
+            for oid in blobs:
+                yield path, oid
+            tips[epoch] = tip
+
+    processes = max(1, int(cpu_count() * cpu_factor))
+    log.info('Importing public-inbox %s (%d epochs) with %d processes' %
+             (inbox, len(epochs), processes))
+    start = time()
+
+    p = Pool(processes)
+    digests = MailDigests(d_mbox)
+    processed, failed, new_index, new_lists = _collect_results(
+        p.imap_unordered(_import_blob, locations(), chunksize=100),
+        listname, digests)
+    p.close()
+    p.join()
+
+    # Mails must be locatable before they show up in the index
+    store.add_blobs([(md5, oid, store.epoch_number(path))
+                     for md5, (_, _, _, path, oid) in new_index.items()])
+    _update_mailbox(d_mbox, digests, new_index, new_lists)
+    digests.close()
+
+    for epoch, tip in tips.items():
+        store.epochs[epoch][1] = tip
+    store.write_epochs()
+
+    _log_results(start, processed, failed, new_index, new_lists)
+
+    return len(new_index), failed
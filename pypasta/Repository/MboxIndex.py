@@ -0,0 +1,334 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import hashlib
+import mmap
+import numpy as np
+import os
+import struct
+
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+
+def date_to_int(date):
+    """
+    Converts a date to its YYYYMMDD integer representation. Those integers
+    have the same order as the dates.
+    """
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def date_str_to_int(date_str):
+    # date_str: 'YYYY/MM/DD'
+    return int(date_str.replace('/', ''))
+
+
+def int_to_date_str(date):
+    return '%04d/%02d/%02d' % (date // 10000, date // 100 % 100, date % 100)
+
+
+def message_id_key(message_id):
+    return int.from_bytes(hashlib.md5(message_id.encode()).digest()[0:8],
+                          'little')
+
+
+def file_stat(filename):
+    if not os.path.isfile(filename):
+        return 0, 0, 0
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def read_lines(filename, fields, offset=0):
+    """
+    Returns the lines of filename, starting at offset, split to fields.
+    Incomplete lines of interrupted updates don't have the expected number of
+    fields and are dropped.
+    """
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        lines = f.read().decode().split('\n')
+    lines = [x.split(' ') for x in lines if x]
+    return [x for x in lines if len(x) == fields]
+
+
+class MboxIndex:
+    """
+    Compact binary index of the mailbox. Entries are sorted by date, so time
+    windows can be answered by bisection. Message-IDs are located by
+    bisection of their hashes, and list names are interned.
+
+    The binary index is a cache of the text files index, invalid and lists.
+    Those files remain the primary source. Imports only append to the index
+    and lists files, appended lines are loaded on top of the binary index.
+    The binary index is rebuilt if the files were rewritten, or if the
+    appended lines grew too large.
+    """
+    MAGIC = b'PaStAIdx'
+    VERSION = 2
+    # magic, version, entries, list references, length of Message-ID blob,
+    # length of list name blob, (size, mtime, inode) of the index, invalid
+    # and lists files.
+    HEADER = struct.Struct('<8sIIQQQ' + 'QQQ' * 3)
+
+    # Rebuild the binary index, once the appended lines exceed this fraction
+    # of the indexed text files
+    MAX_APPENDED = 0.1
+
+    FLAG_INVALID = 1
+    # Headers and diff boundary of the mail were checked by validate_mail()
+    FLAG_VALIDATED = 2
+
+    def __init__(self, dates, flags, md5s, id_offsets, id_keys, id_order,
+                 list_offsets, list_refs, ids, list_names, stats=None):
+        # YYYYMMDD integers, sorted
+        self.dates = dates
+        self.flags = flags
+        # raw md5 digests, one row per entry
+        self.md5s = md5s
+        # Message-IDs of all entries, concatenated to one blob
+        self.id_offsets = id_offsets
+        self.ids = ids
+        # Sorted Message-ID hashes, and the entry they point to
+        self.id_keys = id_keys
+        self.id_order = id_order
+        # Lists of the entries: CSR-like offsets into list_refs, which refer
+        # to interned list names
+        self.list_offsets = list_offsets
+        self.list_refs = list_refs
+        self.list_names = list_names
+
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.dates)
+
+    def get_message_id(self, row):
+        return bytes(self.ids[self.id_offsets[row]:
+                              self.id_offsets[row + 1]]).decode()
+
+    def get_date_str(self, row):
+        return int_to_date_str(int(self.dates[row]))
+
+    def get_md5(self, row):
+        return bytes(self.md5s[row]).hex()
+
+    def get_lists(self, row):
+        refs = self.list_refs[self.list_offsets[row]:self.list_offsets[row + 1]]
+        return {self.list_names[x] for x in refs}
+
+    def is_valid(self, row):
+        return not self.flags[row] & MboxIndex.FLAG_INVALID
+
+    def is_validated(self, row):
+        return bool(self.flags[row] & MboxIndex.FLAG_VALIDATED)
+
+    def find(self, message_id):
+        """
+        Returns the row of message_id, or None
+        """
+        key = message_id_key(message_id)
+        pos = int(np.searchsorted(self.id_keys, np.uint64(key)))
+        while pos < len(self.id_keys) and self.id_keys[pos] == key:
+            row = int(self.id_order[pos])
+            if self.get_message_id(row) == message_id:
+                return row
+            pos += 1
+        return None
+
+    def rows(self, mindate=None, maxdate=None):
+        """
+        Returns the range of rows with mindate <= date <= maxdate
+        """
+        lo = 0
+        hi = len(self.dates)
+        if mindate is not None:
+            lo = int(np.searchsorted(self.dates, date_to_int(mindate), 'left'))
+        if maxdate is not None:
+            hi = int(np.searchsorted(self.dates, date_to_int(maxdate), 'right'))
+        return range(lo, hi)
+
+    def set_flag(self, row, flag):
+        if not self.flags.flags.writeable:
+            self.flags = self.flags.copy()
+        self.flags[row] |= flag
+
+    def num_flagged(self, flag):
+        return int(np.count_nonzero(self.flags & flag))
+
+    def to_text(self, f_index, f_invalid):
+        index = []
+        invalid = []
+        for row in range(len(self)):
+            line = '%s %s %s\n' % (self.get_date_str(row),
+                                   self.get_message_id(row),
+                                   self.get_md5(row))
+            if self.is_valid(row):
+                index.append(line)
+            else:
+                invalid.append(line)
+
+        # Write invalid entries first. If we get interrupted in between, an
+        # entry may be listed in both files, and invalid entries take
+        # precedence when loading.
+        for filename, lines in [(f_invalid, invalid), (f_index, index)]:
+            if not lines:
+                continue
+            with open(filename + '.tmp', 'w') as f:
+                f.write(''.join(sorted(lines)))
+            os.replace(filename + '.tmp', filename)
+
+    def to_file(self, filename, stats):
+        self.stats = stats
+        list_names = '\n'.join(self.list_names).encode()
+        header = MboxIndex.HEADER.pack(MboxIndex.MAGIC, MboxIndex.VERSION,
+                                       len(self), len(self.list_refs),
+                                       len(self.ids), len(list_names),
+                                       *[x for stat in stats for x in stat])
+
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            for array in [self.dates, self.flags, self.md5s, self.id_offsets,
+                          self.id_keys, self.id_order, self.list_offsets,
+                          self.list_refs, self.ids]:
+                f.write(np.ascontiguousarray(array).tobytes())
+                # keep arrays 8-byte aligned
+                f.write(b'\0' * (-array.nbytes % 8))
+            f.write(list_names)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def from_file(filename):
+        with open(filename, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n, n_refs, ids_len, names_len, *stats = \
+            MboxIndex.HEADER.unpack_from(buf)
+        if magic != MboxIndex.MAGIC or version != MboxIndex.VERSION:
+            raise ValueError('Invalid mailbox index: %s' % filename)
+
+        offset = MboxIndex.HEADER.size
+        arrays = []
+        for dtype, count in [(np.int32, n), (np.uint8, n), (np.uint8, n * 16),
+                             (np.uint64, n + 1), (np.uint64, n),
+                             (np.uint32, n), (np.uint64, n + 1),
+                             (np.uint16, n_refs), (np.uint8, ids_len)]:
+            array = np.frombuffer(buf, dtype, count, offset)
+            arrays.append(array)
+            offset += array.nbytes + (-array.nbytes % 8)
+
+        list_names = bytes(buf[offset:offset + names_len]).decode()
+        list_names = list_names.split('\n') if list_names else []
+
+        dates, flags, md5s, id_offsets, id_keys, id_order, list_offsets, \
+            list_refs, ids = arrays
+        md5s = md5s.reshape((n, 16))
+        stats = list(zip(stats[0::3], stats[1::3], stats[2::3]))
+
+        return MboxIndex(dates, flags, md5s, id_offsets, id_keys, id_order,
+                         list_offsets, list_refs, ids, list_names, stats)
+
+    @staticmethod
+    def from_text(f_index, f_invalid, f_lists):
+        lists = dict()
+        for message_id, list_name in read_lines(f_lists, 2):
+            if message_id not in lists:
+                lists[message_id] = set()
+            lists[message_id].add(list_name)
+
+        entries = dict()
+        for flag, filename in [(0, f_index),
+                               (MboxIndex.FLAG_INVALID, f_invalid)]:
+            for date_str, message_id, md5 in read_lines(filename, 3):
+                entries[message_id] = date_str_to_int(date_str), md5, flag
+
+        rows = sorted((date, message_id, md5, flag) for
+                      message_id, (date, md5, flag) in entries.items())
+        n = len(rows)
+
+        dates = np.array([x[0] for x in rows], dtype=np.int32)
+        flags = np.array([x[3] for x in rows], dtype=np.uint8)
+        md5s = np.frombuffer(b''.join(bytes.fromhex(x[2]) for x in rows),
+                             dtype=np.uint8).reshape((n, 16))
+
+        ids = [x[1].encode() for x in rows]
+        id_offsets = np.zeros(n + 1, dtype=np.uint64)
+        id_offsets[1:] = np.cumsum([len(x) for x in ids])
+        ids = np.frombuffer(b''.join(ids), dtype=np.uint8)
+
+        keys = np.array([message_id_key(x[1]) for x in rows], dtype=np.uint64)
+        id_order = np.argsort(keys, kind='stable').astype(np.uint32)
+        id_keys = keys[id_order]
+
+        list_names = sorted(set().union(*lists.values()))
+        interned = {name: i for i, name in enumerate(list_names)}
+        refs = [sorted(interned[name] for name in lists.get(x[1], []))
+                for x in rows]
+        list_offsets = np.zeros(n + 1, dtype=np.uint64)
+        list_offsets[1:] = np.cumsum([len(x) for x in refs])
+        list_refs = np.array([x for ref in refs for x in ref], dtype=np.uint16)
+
+        return MboxIndex(dates, flags, md5s, id_offsets, id_keys, id_order,
+                         list_offsets, list_refs, ids, list_names)
+
+    @staticmethod
+    def _appended(stats, indexed):
+        # Returns the offsets of the lines that were appended to the index
+        # and lists files since the binary index was built, or None, if any
+        # file was rewritten.
+        (index, invalid, lists), (old_index, old_invalid, old_lists) = \
+            stats, indexed
+        if invalid != old_invalid:
+            return None
+        for new, old in [(index, old_index), (lists, old_lists)]:
+            if new[2] != old[2] or new[0] < old[0]:
+                return None
+
+        appended = index[0] - old_index[0] + lists[0] - old_lists[0]
+        if appended > MboxIndex.MAX_APPENDED * (old_index[0] + old_lists[0]):
+            return None
+
+        return old_index[0], old_lists[0]
+
+    @staticmethod
+    def load(filename, f_index, f_invalid, f_lists):
+        """
+        Loads the binary index, and rebuilds it if any of the text files
+        was rewritten in the meanwhile.
+
+        :return: the index, the entries and the list mappings that were
+                 appended to the index and lists files since the index was
+                 built
+        """
+        stats = [file_stat(x) for x in [f_index, f_invalid, f_lists]]
+        if os.path.isfile(filename):
+            try:
+                index = MboxIndex.from_file(filename)
+                offsets = MboxIndex._appended(stats, index.stats)
+                if offsets is not None:
+                    index_offset, lists_offset = offsets
+                    return index, read_lines(f_index, 3, index_offset), \
+                           read_lines(f_lists, 2, lists_offset)
+                log.info('  ↪ mailbox index is outdated')
+            except Exception as e:
+                log.warning('  ↪ unable to load mailbox index: %s' % str(e))
+
+        log.info('  ↪ creating mailbox index')
+        index = MboxIndex.from_text(f_index, f_invalid, f_lists)
+        index.to_file(filename, stats)
+
+        return index, [], []
@@ -0,0 +1,135 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import mmap
+import os
+import re
+import struct
+
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+MD5_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+
+class MailPack:
+    """
+    A pack is the concatenation of all raw mails of one month of the mailbox:
+    d_mbox/YYYY/MM.pack. Its index d_mbox/YYYY/MM.pack.idx holds a record
+    (md5, offset, length) for each mail inside the pack.
+
+    The pack is mapped to memory on first use, and mails are returned as
+    memoryviews of the mapping.
+    """
+    SUFFIX = '.pack'
+    INDEX_SUFFIX = '.pack.idx'
+    RECORD = struct.Struct('<16sQQ')
+
+    def __init__(self, f_pack):
+        self.f_pack = f_pack
+        self.f_index = f_pack[0:-len(MailPack.SUFFIX)] + MailPack.INDEX_SUFFIX
+        self._index = None
+        self._buf = None
+
+    @staticmethod
+    def filename(d_mbox, year, month):
+        return os.path.join(d_mbox, year, month + MailPack.SUFFIX)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = MailPack.load_index(self.f_index)
+        return self._index
+
+    @staticmethod
+    def load_index(f_index):
+        if not os.path.isfile(f_index):
+            return dict()
+
+        with open(f_index, 'rb') as f:
+            content = f.read()
+        return {md5.hex(): (offset, length) for md5, offset, length in
+                MailPack.RECORD.iter_unpack(content)}
+
+    @staticmethod
+    def write_index(f_index, index):
+        tmp = f_index + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(MailPack.RECORD.pack(bytes.fromhex(md5), *loc)
+                             for md5, loc in sorted(index.items())))
+        os.replace(tmp, f_index)
+
+    def __contains__(self, md5):
+        return md5 in self.index
+
+    def __getitem__(self, md5):
+        offset, length = self.index[md5]
+        if self._buf is None:
+            with open(self.f_pack, 'rb') as f:
+                self._buf = memoryview(mmap.mmap(f.fileno(), 0,
+                                                 access=mmap.ACCESS_READ))
+        return self._buf[offset:offset + length]
+
+    @staticmethod
+    def pack_month(d_mbox, year, month, keep=False):
+        """
+        Moves all single mail files of d_mbox/YYYY/MM/DD/ to the pack of that
+        month. Mails that are already packed are skipped.
+
+        The pack is appended first, and its index is replaced atomically
+        afterwards. Mail files are only removed once they are referenced by
+        the index.
+
+        :return: number of newly packed mails
+        """
+        d_month = os.path.join(d_mbox, year, month)
+        f_pack = MailPack.filename(d_mbox, year, month)
+        pack = MailPack(f_pack)
+        index = pack.index
+
+        files = []
+        for day in sorted(os.listdir(d_month)):
+            d_day = os.path.join(d_month, day)
+            if not os.path.isdir(d_day):
+                continue
+            files += [(x, os.path.join(d_day, x))
+                      for x in sorted(os.listdir(d_day)) if MD5_REGEX.match(x)]
+
+        packed = 0
+        with open(f_pack, 'ab') as f:
+            offset = f.tell()
+            for md5, filename in files:
+                if md5 in index:
+                    continue
+                with open(filename, 'rb') as mail:
+                    raw = mail.read()
+                f.write(raw)
+                index[md5] = offset, len(raw)
+                offset += len(raw)
+                packed += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        MailPack.write_index(pack.f_index, index)
+
+        if not keep:
+            for _, filename in files:
+                os.remove(filename)
+            for day in os.listdir(d_month):
+                d_day = os.path.join(d_month, day)
+                if os.path.isdir(d_day) and not os.listdir(d_day):
+                    os.rmdir(d_day)
+            if not os.listdir(d_month):
+                os.rmdir(d_month)
+
+        return packed
@@ -44,9 +44,9 @@ class Diff:
     LINE_IDENTIFIER_NEWLINE = '\\'
 
     def __init__(self, diff):
-        # we pop from the list until it is empty. Copy it first, to prevent its
-        # deletion
-        self.raw = list(diff)
+        # The diff is only walked by index and never modified, so there's no
+        # need to copy it.
+        self.raw = diff
         self.patches = {}
         self.affected = set()
 
@@ -58,26 +58,30 @@ class Diff:
         if diff and Diff.EXCLUDE_CC_REGEX.match(diff[0]):
             return
 
-        while len(diff):
-            self.footer = len(diff)
+        i = 0
+        length = len(diff)
+        while i < length:
+            self.footer = length - i
 
             # Consume till the first occurence of '--- '
-            while len(diff):
-                minus = diff.pop(0)
+            while i < length:
+                minus = diff[i]
+                i += 1
                 if Diff.FILE_SEPARATOR_MINUS_REGEX.match(minus):
                     break
-            if len(diff) == 0:
+            if i == length:
                 break
 
             self.footer = 0
             minus = Diff.FILE_SEPARATOR_MINUS_REGEX.match(minus).group(1)
-            plus = Diff.FILE_SEPARATOR_PLUS_REGEX.match(diff.pop(0)).group(
-                1)
+            plus = Diff.FILE_SEPARATOR_PLUS_REGEX.match(diff[i]).group(1)
+            i += 1
 
             filename = Diff.get_filename(minus, plus)
 
-            while len(diff) and Diff.HUNK_REGEX.match(diff[0]):
-                hunk = Diff.HUNK_REGEX.match(diff.pop(0))
+            while i < length and Diff.HUNK_REGEX.match(diff[i]):
+                hunk = Diff.HUNK_REGEX.match(diff[i])
+                i += 1
 
                 # l_start = int(hunk.group(1))
                 l_lines = 1
@@ -99,7 +103,8 @@ class Diff:
                 context = []
 
                 while not (del_cntr == l_lines and add_cntr == r_lines):
-                    line = diff.pop(0)
+                    line = diff[i]
+                    i += 1
 
                     # Assume an empty string to be an invariant newline
                     # (this happens quite often when parsing mails)
@@ -0,0 +1,191 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import mmap
+import numpy as np
+import os
+import pygit2
+import re
+
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+EPOCH_REGEX = re.compile(r'^(\d+)\.git$')
+
+
+class PublicInbox:
+    """
+    Mails of public-inbox archives (v2 layout) stay inside their git
+    repositories, and are read from there on demand. Each commit of an epoch
+    repository (inbox/git/N.git) adds one single mail as blob 'm'.
+
+    d_mbox/public-inbox/epochs lists all known epoch repositories together
+    with the last imported commit. d_mbox/public-inbox/blobs.idx holds a
+    record (md5, blob id, epoch) for each mail, sorted by md5, so it can be
+    mapped to memory and bisected.
+    """
+    DIRNAME = 'public-inbox'
+    RECORD = np.dtype([('md5', 'S16'), ('oid', 'S20'), ('epoch', '<u4')])
+
+    def __init__(self, d_mbox):
+        self.d_pi = os.path.join(d_mbox, PublicInbox.DIRNAME)
+        self.f_epochs = os.path.join(self.d_pi, 'epochs')
+        self.f_blobs = os.path.join(self.d_pi, 'blobs.idx')
+
+        self._epochs = None
+        self._blobs = None
+        self._repos = dict()
+
+    @staticmethod
+    def find_epochs(inbox):
+        """
+        Returns the paths of all epoch repositories of a public-inbox, ordered
+        by their epoch number
+        """
+        d_git = os.path.join(inbox, 'git')
+        if not os.path.isdir(d_git):
+            raise FileNotFoundError('Not a public-inbox (v2): %s' % inbox)
+
+        epochs = []
+        for name in os.listdir(d_git):
+            match = EPOCH_REGEX.match(name)
+            if match:
+                epochs.append((int(match.group(1)),
+                               os.path.realpath(os.path.join(d_git, name))))
+        return [path for _, path in sorted(epochs)]
+
+    @property
+    def epochs(self):
+        """
+        List of [path, tip] of all known epochs. The position in the list is
+        the number that is used for the epoch in the blob index.
+        """
+        if self._epochs is None:
+            self._epochs = []
+            if os.path.isfile(self.f_epochs):
+                with open(self.f_epochs) as f:
+                    for line in filter(None, f.read().split('\n')):
+                        tip, path = line.split(' ', 1)
+                        self._epochs.append([path, tip if tip != '-' else None])
+        return self._epochs
+
+    def epoch_number(self, path):
+        for i, (epoch, _) in enumerate(self.epochs):
+            if epoch == path:
+                return i
+
+        self.epochs.append([path, None])
+        return len(self.epochs) - 1
+
+    def write_epochs(self):
+        os.makedirs(self.d_pi, exist_ok=True)
+        tmp = self.f_epochs + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(''.join('%s %s\n' % (tip or '-', path)
+                            for path, tip in self.epochs))
+        os.replace(tmp, self.f_epochs)
+
+    @property
+    def blobs(self):
+        if self._blobs is None:
+            self._blobs = PublicInbox.load_blobs(self.f_blobs)
+        return self._blobs
+
+    @staticmethod
+    def load_blobs(f_blobs):
+        if not os.path.isfile(f_blobs) or not os.path.getsize(f_blobs):
+            return np.zeros(0, dtype=PublicInbox.RECORD)
+
+        with open(f_blobs, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return np.frombuffer(buf, dtype=PublicInbox.RECORD)
+
+    def add_blobs(self, blobs):
+        """
+        Merges new records (md5, oid, epoch) into the blob index. The index is
+        replaced atomically.
+        """
+        if not blobs:
+            return
+
+        new = np.array([(bytes.fromhex(md5), bytes.fromhex(oid), epoch)
+                        for md5, oid, epoch in blobs],
+                       dtype=PublicInbox.RECORD)
+        merged = np.concatenate((self.blobs, new))
+        merged = merged[np.argsort(merged['md5'], kind='stable')]
+
+        os.makedirs(self.d_pi, exist_ok=True)
+        tmp = self.f_blobs + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(merged.tobytes())
+        os.replace(tmp, self.f_blobs)
+        self._blobs = None
+
+    def _find(self, md5):
+        key = bytes.fromhex(md5)
+        blobs = self.blobs
+        pos = int(np.searchsorted(blobs['md5'], np.bytes_(key)))
+        if pos < len(blobs) and blobs[pos:pos + 1].tobytes()[0:16] == key:
+            return pos
+        return None
+
+    def __contains__(self, md5):
+        return self._find(md5) is not None
+
+    def _get_repo(self, epoch):
+        if epoch not in self._repos:
+            self._repos[epoch] = pygit2.Repository(self.epochs[epoch][0])
+        return self._repos[epoch]
+
+    def __getitem__(self, md5):
+        pos = self._find(md5)
+        if pos is None:
+            raise KeyError(md5)
+
+        record = self.blobs[pos:pos + 1].tobytes()
+        oid = pygit2.Oid(raw=record[16:36])
+        epoch = int(self.blobs['epoch'][pos])
+        return self._get_repo(epoch)[oid].data
+
+    @staticmethod
+    def new_mails(path, last_tip):
+        """
+        Walks all commits of an epoch repository that are not reachable from
+        last_tip, oldest first.
+
+        :return: the current tip, and a generator of the blob ids of all new
+                 mails
+        """
+        repo = pygit2.Repository(path)
+        if repo.head_is_unborn:
+            return last_tip, iter([])
+        tip = repo.head.target
+
+        walker = repo.walk(tip, pygit2.GIT_SORT_TOPOLOGICAL |
+                                pygit2.GIT_SORT_REVERSE)
+        if last_tip:
+            # The history of an epoch gets rewritten if mails are purged
+            if repo.get(last_tip) is None:
+                log.warning('  ↪ %s: last tip %s vanished, rescanning epoch' %
+                            (path, last_tip))
+            else:
+                walker.hide(last_tip)
+
+        def blobs():
+            for commit in walker:
+                # Commits that only delete mails have a 'd' instead of 'm'
+                tree = commit.tree
+                if 'm' in tree:
+                    yield str(tree['m'].id)
+
+        return str(tip), blobs()
@@ -21,6 +21,8 @@ from multiprocessing import Pool, cpu_count
 
 from .MessageDiff import MessageDiff
 from .Mbox import Mbox, PatchMail
+from .SubjectIndex import SubjectIndex
+from ..Fingerprint import FingerprintIndex
 from ..Util import fix_encoding
 
 log = getLogger(__name__[-15:])
@@ -82,6 +84,8 @@ class Repository:
         self.ccache = {}
         self.repo = pygit2.Repository(repo_location)
         self.mbox = None
+        self.subjects = SubjectIndex()
+        self.fingerprints = FingerprintIndex()
 
     def _inject_commits(self, commit_dict):
         for key, val in commit_dict.items():
@@ -131,6 +135,8 @@ class Repository:
                 this_commits = pickle.load(f)
                 log.info('  ↪ Loaded %d commits from cache file' % len(this_commits))
             self._inject_commits(this_commits)
+            self.subjects.load(f_ccache)
+            self.fingerprints.load(f_ccache)
             return set(this_commits.keys())
         except FileNotFoundError:
             if must_exist:
@@ -142,6 +148,8 @@ class Repository:
         log.info('Writing %d commits to cache file' % len(self.ccache))
         with open(f_ccache, 'wb') as f:
             pickle.dump(self.ccache, f, pickle.HIGHEST_PROTOCOL)
+        self.subjects.export(f_ccache, self.ccache)
+        self.fingerprints.export(f_ccache, self.ccache)
 
     def cache_evict_except(self, commit_except):
         victims = self.ccache.keys() - commit_except
@@ -0,0 +1,108 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import hashlib
+import os
+import pickle
+
+from logging import getLogger
+
+from .Mbox import normalize_subject
+
+log = getLogger(__name__[-15:])
+
+
+def diff_digest(diff):
+    """
+    Digest of the insertions and deletions of a diff. Line numbers and
+    context lines are ignored, so rebased patches have the same digest.
+    """
+    md5 = hashlib.md5()
+    for filename in sorted(diff.patches.keys()):
+        md5.update(('%s\n' % filename).encode())
+        for hunk in diff.patches[filename].values():
+            md5.update(''.join('-%s\n' % x for x in hunk.deletions).encode())
+            md5.update(''.join('+%s\n' % x for x in hunk.insertions).encode())
+    return md5.hexdigest()
+
+
+class SubjectIndex:
+    """
+    Maps commit hashes resp. Message-IDs to their normalised subject and the
+    digest of their diff. The index is kept next to the commit cache file and
+    is updated whenever the cache is exported, so it is available without
+    loading the patches themselves.
+    """
+    SUFFIX = '.subjects'
+
+    # Generic subjects (e.g., 'Update MAINTAINERS') are shared by lots of
+    # unrelated patches. Don't propose candidates for them.
+    MAX_POSTINGS = 100
+
+    def __init__(self):
+        self.entries = dict()
+
+    @staticmethod
+    def filename(f_ccache):
+        return f_ccache + SubjectIndex.SUFFIX
+
+    def insert(self, commit_hash, commit):
+        self.entries[commit_hash] = normalize_subject(commit.subject), \
+                                    diff_digest(commit.diff)
+
+    def update(self, ccache):
+        for commit_hash, commit in ccache.items():
+            if commit_hash not in self.entries:
+                self.insert(commit_hash, commit)
+
+    def get(self, repo, commit_hash):
+        if commit_hash not in self.entries:
+            self.insert(commit_hash, repo[commit_hash])
+        return self.entries[commit_hash]
+
+    def candidates(self, repo, left_hashes, right_hashes):
+        """
+        Yields all pairs (left, right, same_diff) of patches with equal
+        normalised subjects. same_diff is True if their diff digest matches
+        as well.
+        """
+        postings = dict()
+        for right_hash in right_hashes:
+            subject, digest = self.get(repo, right_hash)
+            if subject:
+                postings.setdefault(subject, []).append((right_hash, digest))
+
+        for left_hash in left_hashes:
+            subject, digest = self.get(repo, left_hash)
+            rights = postings.get(subject)
+            if not rights or len(rights) > SubjectIndex.MAX_POSTINGS:
+                continue
+            for right_hash, right_digest in rights:
+                if right_hash != left_hash:
+                    yield left_hash, right_hash, digest == right_digest
+
+    def load(self, f_ccache):
+        filename = SubjectIndex.filename(f_ccache)
+        if not os.path.isfile(filename):
+            return
+
+        with open(filename, 'rb') as f:
+            self.entries.update(pickle.load(f))
+
+    def export(self, f_ccache, ccache):
+        self.update(ccache)
+        entries = {x: self.entries[x] for x in ccache.keys()}
+
+        filename = SubjectIndex.filename(f_ccache)
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.tmp', filename)
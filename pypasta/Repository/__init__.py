@@ -12,3 +12,4 @@ the COPYING file in the top-level directory.
 
 from .Repository import Repository, Commit
 from .Mbox import PatchMail, Mbox
+from .MboxImport import import_mails, import_mail_batch, import_public_inbox
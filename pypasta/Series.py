@@ -0,0 +1,160 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2018
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+from logging import getLogger
+
+from .Repository.Mbox import normalize_subject
+
+log = getLogger(__name__[-15:])
+
+
+def series_info(patch):
+    """
+    Returns thread root, version, number and total of a patch mail. Mails of
+    caches that were created before series information was recorded simply
+    form their own single-patch series.
+    """
+    references = getattr(patch, 'references', None) or []
+    in_reply_to = getattr(patch, 'in_reply_to', None)
+
+    # The first reference is the root of the thread. Patches of a series
+    # reply to the cover letter resp. to the first patch.
+    if references:
+        root = references[0]
+    elif in_reply_to:
+        root = in_reply_to
+    else:
+        root = patch.commit_hash
+
+    return root, getattr(patch, 'series_version', 1), \
+        getattr(patch, 'series_number', None), \
+        getattr(patch, 'series_total', None)
+
+
+class Series:
+    def __init__(self, root, version, author_email):
+        self.root = root
+        self.version = version
+        self.author_email = author_email
+        self.total = None
+        self.date = None
+        # patch number -> list of Message-IDs
+        self.patches = dict()
+        # Message-ID -> normalised subject
+        self.subjects = dict()
+
+    def insert(self, message_id, patch, number, total):
+        number = number or 1
+        if number not in self.patches:
+            self.patches[number] = []
+        self.patches[number].append(message_id)
+        self.subjects[message_id] = normalize_subject(patch.subject)
+
+        if total:
+            self.total = max(self.total or 0, total)
+        if self.date is None or patch.author_date < self.date:
+            self.date = patch.author_date
+
+    def __iter__(self):
+        for number in sorted(self.patches):
+            for message_id in self.patches[number]:
+                yield number, message_id
+
+
+class SeriesIndex:
+    """
+    Groups patch mails to series by their thread and the version of their
+    subject tag. Revisions of a series are linked if they are sent by the same
+    author, and if they are part of the same thread or share the subject of at
+    least one patch. Patches of other authors that reply to a series don't
+    belong to it.
+
+    Patches of linked revisions are proposed as candidates in series order:
+    patch k of a revision is compared with patch k of the other revisions.
+    Patches that were moved within the series are still found by their
+    subject.
+    """
+    def __init__(self):
+        self.series = dict()
+        self.revisions = []
+
+    def insert(self, repo, message_id):
+        patch = repo[message_id]
+        root, version, number, total = series_info(patch)
+        key = root, version, patch.author_email
+        if key not in self.series:
+            self.series[key] = Series(root, version, patch.author_email)
+        self.series[key].insert(message_id, patch, number, total)
+
+    def link(self):
+        keys = list(self.series.keys())
+        parent = list(range(len(keys)))
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        def union(links):
+            for members in links.values():
+                for other in members[1:]:
+                    parent[find(other)] = find(members[0])
+
+        by_root = dict()
+        by_subject = dict()
+        for i, key in enumerate(keys):
+            series = self.series[key]
+            by_root.setdefault((series.root, series.author_email),
+                               []).append(i)
+            for subject in set(series.subjects.values()):
+                by_subject.setdefault((series.author_email, subject),
+                                      []).append(i)
+        union(by_root)
+        union(by_subject)
+
+        groups = dict()
+        for i, key in enumerate(keys):
+            groups.setdefault(find(i), []).append(self.series[key])
+
+        # Order revisions by their version and date
+        self.revisions = [sorted(x, key=lambda s: (s.version, s.date))
+                          for x in groups.values() if len(x) > 1]
+        self.revisions.sort(key=lambda x: x[0].date)
+
+    def candidates(self):
+        """
+        Yields pairs of Message-IDs of linked revisions in series order
+        """
+        for revisions in self.revisions:
+            for i, lhs in enumerate(revisions):
+                for rhs in revisions[i+1:]:
+                    for l_number, l_id in lhs:
+                        for r_number, r_id in rhs:
+                            if l_number == r_number or \
+                               lhs.subjects[l_id] == rhs.subjects[r_id]:
+                                yield l_id, r_id
+
+    def __len__(self):
+        return len(self.series)
+
+    @staticmethod
+    def from_repo(repo, message_ids):
+        log.info('Creating series index...')
+        index = SeriesIndex()
+        for message_id in message_ids:
+            index.insert(repo, message_id)
+        index.link()
+        log.info('  ↪ done. Found %d series, %d of them have revisions' %
+                 (len(index), sum(len(x) for x in index.revisions)))
+
+        return index
@@ -17,7 +17,10 @@ import shutil
 import subprocess
 import sys
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import zip_longest
 from logging import getLogger
 
 from .Cluster import Cluster
@@ -134,17 +137,21 @@ def show_commit(repo, hash, enable_pager=True):
     pager('\n'.join(content), enable_pager)
 
 
-def show_commits(repo, left_hash, right_hash, enable_pager=True):
+def format_commits(repo, left_hash, right_hash, columns=None):
+    """
+    Formats two commits side by side. columns defaults to the width of the
+    terminal.
+    """
     def side_by_side(left, right, split_length):
         ret = []
-        while len(left) or len(right):
+        for l, r in zip_longest(left, right, fillvalue=None):
             line = ''
-            if len(left):
-                line = left.pop(0).expandtabs(6)[0:split_length]
+            if l is not None:
+                line = l.expandtabs(6)[0:split_length]
             line = line.ljust(split_length)
             line += ' | '
-            if len(right):
-                line += right.pop(0).expandtabs(6)[0:split_length]
+            if r is not None:
+                line += r.expandtabs(6)[0:split_length]
             ret.append(line)
         return ret
 
@@ -160,7 +167,8 @@ def show_commits(repo, left_hash, right_hash, enable_pager=True):
     left_diff, left_footer = left_commit.diff.split_footer()
     right_diff, right_footer = right_commit.diff.split_footer()
 
-    columns, _ = shutil.get_terminal_size()
+    if columns is None:
+        columns, _ = shutil.get_terminal_size()
     maxlen = int((columns-3)/2)
 
     split_length = max(map(len, left_diff + left_message))
@@ -177,7 +185,53 @@ def show_commits(repo, left_hash, right_hash, enable_pager=True):
                              split_length) + separator
     text += side_by_side(left_diff, right_diff, split_length) + separator
     text += side_by_side(left_footer, right_footer, split_length) + separator
-    pager('\n'.join(text), enable_pager)
+    return '\n'.join(text)
+
+
+def show_commits(repo, left_hash, right_hash, enable_pager=True):
+    pager(format_commits(repo, left_hash, right_hash), enable_pager)
+
+
+def prefetch(function, items, depth, skip=None):
+    """
+    Yields (item, function(item)) for all items. A background thread
+    evaluates function for up to depth items (including the current one),
+    while the caller handles the current item. Items for which skip(item)
+    returns True are skipped. skip is called in the calling thread whenever
+    the caller resumes, so items can be skipped because of the outcome of
+    previous items.
+    """
+    skip = skip or (lambda x: False)
+    depth = max(depth, 1)
+    items = iter(items)
+    window = deque()
+    executor = ThreadPoolExecutor(max_workers=1)
+    end = object()
+
+    def fill():
+        while len(window) < depth:
+            item = next(items, end)
+            if item is end:
+                return
+            if not skip(item):
+                window.append((item, executor.submit(function, item)))
+
+    try:
+        fill()
+        while window:
+            item, future = window.popleft()
+            yield item, future.result()
+
+            # Drop queued items that became obsolete in the meanwhile
+            for queued in list(window):
+                if skip(queued[0]):
+                    queued[1].cancel()
+                    window.remove(queued)
+            fill()
+    finally:
+        for _, future in window:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 
 def get_first_upstream(repo, patch_groups, commit):
@@ -20,8 +20,12 @@ from .Repository import *
 from .Config import Config
 from .Cluster import Cluster
 from .PatchEvaluation import EvaluationResult, EvaluationType,\
-    evaluate_commit_list, SimRating, evaluate_commit_pair
+    ColumnarEvaluationResult, evaluate_commit_list, SimRating,\
+    evaluate_commit_pair, FalsePositives, file_commit_map,\
+    file_commit_map_discard
 from .Config import Thresholds
+from .BatchRating import BatchRating
+from .EvaluationRecord import EvaluationRecord
 from .Util import format_date_ymd, load_commit_hashes, get_date_selector,\
     getch, show_commit, show_commits, parse_date_ymd, get_first_upstream
 from .PatchDynamics import PatchFlow, PatchComposition
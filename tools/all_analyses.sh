@@ -20,11 +20,6 @@ details.
 
 import numpy as np
 import os
-import pathlib
-from queue import Queue
-from multiprocessing import cpu_count
-from threading import Thread
-from time import sleep
 
 pretend = False
 
@@ -42,9 +37,6 @@ ground_truth = '%s/%s' % (path, '2012-05-mbox-result.groundtruth')
 def zarange(start, stop, step):
 	return np.append(np.arange(start, stop, step), 0)
 
-workers_rate = int(cpu_count())
-workers_compare = int(cpu_count())
-
 range_tf = np.arange(1.0, 0.59, -0.05)
 range_th = np.arange(1.0, 0.1, -0.05)
 range_ta = np.arange(1.0, 0.59, -0.01)
@@ -60,19 +52,6 @@ print('num results: %u' % (len(range_tf) * len(range_th) * len(range_ta) *
 			   len(range_dlr) * len(range_w)))
 quit()
 
-def queue_fill(queue):
-	i = 0
-	for tf in range_tf:
-		for th in range_th:
-			for ta in range_ta:
-				for dlr in range_dlr:
-					for w in range_w:
-						queue.put((tf, th, ta, dlr, w))
-						i = i + 1
-						# if i == 20000:
-						# 	return i
-	return i
-
 def pg_filename(tf, th, ta, dlr, w):
 	res_path = path + 'RES/tf-%0.3f/th-%0.3f/ta-%0.3f/dlr-%0.3f/' % (tf, th, ta, dlr)
 	return res_path, 'w-%0.3f' % w
@@ -85,130 +64,73 @@ def er_filename(tf, th, upstream):
 
 	return path + 'ER/evaluation-%sresult-%0.2f-%0.2f.pkl' % (upstream, tf, th)
 
-def er_filename_lock(tf, th, upstream):
-	return er_filename(tf, th, upstream) + '.lock'
-
-def parallelise(maxsize, task):
-	queue = Queue(maxsize=workers_rate)
-	threads = []
-	for i in range(maxsize):
-		t = Thread(target=task, args=(queue,))
-		t.start()
-		threads.append(t)
-
-	i = queue_fill(queue)
-	print('put %d items' % i)
-
-	queue.join()
+def record_filename(upstream):
+	if upstream:
+		upstream = 'upstream-'
+	else:
+		upstream = ''
 
-	for i in range(maxsize):
-		queue.put(None)
-	for t in threads:
-		t.join()
+	return path + 'ER/evaluation-%srecord.pkl' % upstream
 
 ##### ANALYSIS PHASE BEGINS HERE ######
+# Patches are only compared once with the loosest thresholds. The intermediate
+# similarities are recorded, and the results of all stricter (tf, th) are
+# derived from the record.
 for upstream in [False, True]:
-	for tf in range_tf:
-		for th in range_th:
-
-			destination = er_filename(tf, th, upstream)
-			lock = er_filename_lock(tf, th, upstream)
-			if os.path.isfile(destination):
-				print('ER exists for tf %0.2f th %0.2f. Skipping...' % (tf, th))
-				continue
-			if os.path.isfile(lock):
-				print('Lock exists for tf %0.2f th %0.2f. Skipping...' % (tf, th))
-				continue
+	record = record_filename(upstream)
+	if os.path.isfile(record):
+		print('Record exists. Skipping analysis...')
+	else:
+		if upstream:
+			mode = 'upstream'
+		else:
+			mode = 'rep'
 
-			call(['touch', lock])
-			if upstream:
-				mode = 'upstream'
-			else:
-				mode = 'rep'
+		call(['./pasta', 'analyse', '-mbox', mode, '-tf', '%0.2f' % min(range_tf), '-th', '%0.2f' % min(range_th), '-er', record + '.result', '-record', record])
 
-			call(['./pasta', 'analyse', '-mbox', mode, '-tf', '%0.2f' % tf, '-th', '%0.2f' % th, '-er', destination])
-			call(['rm', lock])
+	# The record is loaded once for all (tf, th)
+	destination = er_filename(0, 0, upstream).replace('0.00-0.00', '%0.2f-%0.2f')
+	call(['./pasta', 'derive_result', record, '-tf'] + ['%0.2f' % x for x in range_tf] + ['-th'] + ['%0.2f' % x for x in range_th] + ['-er', destination])
 
 #### RATE PHASE BEGINS HERE ######
-def worker_rate(q):
-	while True:
-		item = q.get()
-		if item is None:
-			break
-		tf, th, ta, dlr, w = item
-
-		print('Working on %0.3f %0.3f %0.3f %0.3f %0.3f' % item)
-		result_dir, filename = pg_filename(tf, th, ta, dlr, w)
-		result_destination = result_dir + filename
-		result_destination_intermediate = result_destination + '.lock'
-
-		if not os.path.isdir(result_dir):
-			pathlib.Path(result_dir).mkdir(parents=True, exist_ok=True)
-
-		if os.path.isfile(result_destination):
-			print('Result %s exists. Skipping...' % result_destination)
-			q.task_done()
-			continue
-
-		if os.path.isfile(result_destination_intermediate):
-			print('Lock for result %s exists. Skipping...' % result_destination_intermediate)
-			q.task_done()
-			continue
-
+# Patch stack and upstream results of each (tf, th) are rated together for all
+# combinations of ta, dlr and w in one single run. Results are written to
+# RES/tf-X/th-Y/ta-Z/dlr-U/w-V, existing results are skipped.
+def fmt(range):
+	return ['%0.3f' % x for x in range]
+
+for tf in range_tf:
+	for th in range_th:
 		er_stack = er_filename(tf, th, False)
 		er_upstream = er_filename(tf, th, True)
 
 		if not os.path.isfile(er_stack) or not os.path.isfile(er_upstream):
 			print('Stack or Upstream result not found. Skipping')
-			q.task_done()
 			continue
 
-		thresholds = ['-ta', '%0.3f' % ta, '-dlr', '%0.3f' % dlr, '-w', '%0.3f' % w]
-		err = call(['cp', '-av', pg_template, result_destination_intermediate])
-		if err:
-			q.task_done()
-			continue
-		err = call(['./pasta', 'rate', '-er', er_stack, '-pg', result_destination_intermediate] + thresholds)
+		result_dir = path + 'RES/tf-%0.3f/th-%0.3f' % (tf, th)
+		err = call(['./pasta', 'rate', '-batch', result_dir, '-pg', pg_template, '-er', er_stack, er_upstream, '-grid-ta'] + fmt(range_ta) + ['-grid-dlr'] + fmt(range_dlr) + ['-grid-weight'] + fmt(range_w))
 		if err:
-			print('error rating')
-			q.task_done()
-			continue
-		err = call(['./pasta', 'rate', '-er', er_upstream, '-pg', result_destination_intermediate] + thresholds)
-		if err:
-			print('error rating upstream')
-			q.task_done()
-			continue
-		err = call(['mv', result_destination_intermediate, result_destination])
-		if err:
-			print('error moving')
-			q.task_done()
-			continue
-
-		q.task_done()
-
-#parallelise(workers_rate, worker_rate)
-#quit()
+			print('error rating tf %0.3f th %0.3f' % (tf, th))
 
 #### Compare_eqclasses phase begins here ####
 
-def worker_compare(q):
-	while True:
-		item = q.get()
-		if item is None:
-			break
-		tf, th, ta, dlr, w = item
-
-		result_dir, filename = pg_filename(tf, th, ta, dlr, w)
-		result_destination = result_dir + filename
-		comp_destination = result_destination + '.comp'
-
-		if os.path.isfile(comp_destination):
-			print('%s already exists. Skipping...' % comp_destination)
-			q.task_done()
-			continue
-
-		call(['./pasta', 'compare_eqclasses', '-ar', '-mi', '-nmi', '-pur', '-fm', '-f', comp_destination, ground_truth, result_destination])
-
-		q.task_done()
-
-parallelise(workers_compare, worker_compare)
+def results():
+	for tf in range_tf:
+		for th in range_th:
+			for ta in range_ta:
+				for dlr in range_dlr:
+					for w in range_w:
+						result_dir, filename = pg_filename(tf, th, ta, dlr, w)
+						result_destination = result_dir + filename
+						if os.path.isfile(result_destination):
+							yield result_destination
+
+# Compare all results in one batch. The ground truth is only loaded once, and
+# the result is one table with a row for each parameter tuple.
+results_list = path + 'RES/results'
+comparison = path + 'RES/comparison.tsv'
+with open(results_list, 'w') as f:
+	f.write(''.join(x + '\n' for x in results()))
+
+call(['./pasta', 'compare_clusters', '-ar', '-mi', '-nmi', '-pur', '-fm', '-pr', '-cpu', '1', '-batch', results_list, '-f', comparison, ground_truth])